@@ -0,0 +1,36 @@
+from collections import namedtuple
+
+from computer import memory
+from computer.machine import ENGINES, start_of_variables
+from language.translator import translate_text
+
+DEFAULT_ENGINE = "fast"
+
+# Final state of the machine: output, counters, data stack without TOS, TOS and memory words by address
+RunResult = namedtuple("RunResult", "output instruction_count ticks stack top_of_stack memory")
+
+
+def translate(source, optimize=False, fuse=False):
+    """Машинный код программы в памяти, без файлов"""
+    return translate_text(source, optimize=optimize, fuse=fuse)
+
+
+def run(program, stdin="", engine=DEFAULT_ENGINE, instruction_limit=memory.INSTRUCTION_LIMIT, optimize=False, fuse=False):
+    """Транслирует и исполняет программу в памяти, без файлов, stdout и настройки логирования.
+
+    program — исходник, список инструкций транслятора или MachineImage, stdin — строка или итерируемый набор строк.
+    Ввод обрезается по краям, как у machine.py. Ошибки исполнения пробрасываются исключениями из exceptions.py.
+    """
+    code = translate(program, optimize, fuse) if isinstance(program, str) else program
+    data_path = memory.DataPath(code, memory.InputDevice.from_chunks(stdin, strip=True), start_of_variables(code))
+    control = ENGINES[engine](data_path)
+    control.instruction_limit = instruction_limit
+    output, instruction_count, ticks = control.run_machine()
+    return RunResult(
+        output,
+        instruction_count,
+        ticks,
+        tuple(data_path.data_stack.stack),
+        data_path.top_of_stack,
+        tuple(data_path.memory.data),
+    )
@@ -0,0 +1,77 @@
+import random
+import sys
+
+sys.path.append(".")
+
+VARIABLES = 16
+PROCEDURES = 8
+OPERATIONS = ["+", "-", "*"]
+
+
+class ProgramGenerator:
+    """Синтетическая программа заданного числа строк: присваивания, арифметика, ветвления, циклы, процедуры"""
+
+    def __init__(self, lines, seed=0):
+        self.lines = lines
+        self.random = random.Random(seed)
+        self.output = []
+        self.loop_counter = 0
+        # Procedure bodies do not call procedures, a procedure cannot call itself
+        self.in_procedure = False
+
+    def variable(self):
+        return f"v{self.random.randrange(VARIABLES)}"
+
+    def statement(self, depth):
+        choice = self.random.randrange(10 if depth < 2 else 6)
+        if choice < 2:
+            self.output.append(f"{self.random.randrange(100)} {self.variable()} !")
+        elif choice < 4:
+            self.output.extend([f"{self.variable()} @", f"{self.variable()} @", self.random.choice(OPERATIONS), f"{self.random.randrange(1, 50)}", "swap", "mod", f"{self.variable()} !"])
+        elif choice < 5 or self.in_procedure and choice < 6:
+            self.output.extend([f"{self.variable()} @", "."])
+        elif choice < 6:
+            self.output.append(f"p{self.random.randrange(PROCEDURES)}")
+        elif choice < 8:
+            self.output.extend([f"{self.variable()} @", f"{self.random.randrange(50)}", ">", "if"])
+            self.block(depth + 1)
+            if self.random.random() < 0.5:
+                self.output.append("else")
+                self.block(depth + 1, nested=False)
+            self.output.append("endif")
+        else:
+            counter = f"c{self.loop_counter}"
+            self.loop_counter += 1
+            self.output.extend([f"{self.random.randrange(1, 4)} {counter} !", "begin"])
+            self.block(depth + 1)
+            self.output.extend([f"{counter} @", "1", "swap", "-", f"{counter} !", "0", f"{counter} @", ">", "until"])
+
+    def block(self, depth, nested=True):
+        for _ in range(self.random.randrange(1, 4)):
+            self.statement(depth if nested else 2)
+
+    def generate(self):
+        for variable in range(VARIABLES):
+            self.output.append(f"{variable} v{variable} !")
+        self.in_procedure = True
+        for procedure in range(PROCEDURES):
+            self.output.append(f": p{procedure}")
+            body_start = len(self.output)
+            while len(self.output) - body_start < 6:
+                self.statement(2)
+            self.output.append(";")
+        self.in_procedure = False
+        while len(self.output) < self.lines:
+            self.statement(0)
+        self.output.append("exit")
+        return "\n".join(self.output) + "\n"
+
+
+def generate_program(lines, seed=0):
+    return ProgramGenerator(lines, seed).generate()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        sys.exit("usage: generate_program.py <lines> [seed]")
+    sys.stdout.write(generate_program(int(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) == 3 else 0))
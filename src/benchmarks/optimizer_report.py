@@ -0,0 +1,64 @@
+import logging
+import os
+import sys
+
+sys.path.append(".")
+
+from computer import memory
+from computer.fast_engine import FastEngine
+from language.instruction import find_start_of_variables, parse_instructions, dump_instructions
+from language.translator import translate_text
+
+EXAMPLES_DIRECTORY = os.path.join(os.path.dirname(__file__), "..", "..", "examples")
+
+
+def example_programs(directory=EXAMPLES_DIRECTORY):
+    """Пары (имя, исходник, ввод) программ из examples/: исходник <name>, ввод <name>_input"""
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if "_" in name or not os.path.isfile(path):
+            continue
+        with open(path, encoding="utf-8") as file:
+            source = file.read()
+        input_path = path + "_input"
+        stdin = ""
+        if os.path.exists(input_path):
+            with open(input_path, encoding="utf-8") as file:
+                stdin = file.read()
+        yield name, source, stdin
+
+
+def run(machine_code, stdin):
+    # The JSON round trip gives the same instructions machine.py loads from a file
+    code = parse_instructions(dump_instructions(machine_code))
+    control = FastEngine(memory.DataPath(code, memory.InputDevice.from_text(stdin), find_start_of_variables(code)))
+    return control.run_machine()
+
+
+def code_size(machine_code):
+    return sum(1 for instruction in machine_code if "opcode" in instruction)
+
+
+VARIANTS = {"optimize": {"optimize": True}, "fuse": {"fuse": True}, "optimize+fuse": {"optimize": True, "fuse": True}}
+
+
+def main(directory=EXAMPLES_DIRECTORY):
+    logging.getLogger().setLevel(logging.ERROR)
+    print(f"{'program':<12} {'variant':<14} {'code':>11} {'instructions':>15} {'ticks':>17} {'saved ticks':>12}")
+    for name, source, stdin in example_programs(directory):
+        plain = translate_text(source)
+        plain_output, plain_count, plain_ticks = run(plain, stdin)
+        for variant, options in VARIANTS.items():
+            optimized = translate_text(source, **options)
+            optimized_output, optimized_count, optimized_ticks = run(optimized, stdin)
+            if plain_output != optimized_output:
+                sys.exit(f"{name}: {variant} program prints different output")
+            saved = (plain_ticks - optimized_ticks) / plain_ticks * 100 if plain_ticks else 0
+            print(
+                f"{name:<12} {variant:<14} {code_size(plain):>5}->{code_size(optimized):<5} {plain_count:>7}->{optimized_count:<7} "
+                f"{plain_ticks:>8}->{optimized_ticks:<8} {saved:>11.1f}%"
+            )
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
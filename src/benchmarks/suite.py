@@ -0,0 +1,231 @@
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(".")
+
+from benchmarks.optimizer_report import example_programs
+from computer import machine, memory
+from language.instruction import find_start_of_variables
+from language.translator import translate_text
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baseline.json")
+DEFAULT_ENGINE = "fast"
+DEFAULT_TOLERANCE = 0.3
+REPEATS = 3
+# Scaled workloads run far past the golden programs, so the limit is raised for them
+INSTRUCTION_LIMIT = 100_000_000
+# Timing differences below this are noise on any host
+MIN_SECONDS = 0.005
+# Throughput of shorter runs is mostly noise as well
+MIN_THROUGHPUT_SECONDS = 0.05
+
+CAT_SOURCE = "begin\n    #\n    dup\n    emit\n    0 =\nuntil\nexit\n"
+CAT_INPUT_SIZE = 20_000
+FACTORIAL_SOURCE = """1 result !
+1 counter !
+{count} count !
+begin
+    result @
+    counter @
+    *
+    1000003
+    swap
+    mod
+    result !
+    counter @
+    1
+    +
+    counter !
+    counter @
+    count @
+    >
+until
+result @
+.
+exit
+"""
+FACTORIAL_ITERATIONS = 20_000
+# The same factorial with the counter in the loop registers
+FACTORIAL_DO_SOURCE = """1 result !
+{limit} 1 do
+    result @
+    i *
+    1000003
+    swap
+    mod
+    result !
+loop
+result @
+.
+exit
+"""
+STRING_LITERALS = 200
+# Count, then the numbers: read with #num and summed
+SUM_NUMBERS_SOURCE = """#num
+count !
+0 sum !
+begin
+    #num
+    sum @
+    +
+    sum !
+    1
+    count @
+    -
+    count !
+    count @
+    0
+    =
+until
+sum @
+.
+exit
+"""
+SUM_NUMBERS_COUNT = 5_000
+
+# Metric -> True when a bigger value is better, instruction and tick counts are exact and compared without tolerance
+METRICS = {
+    "translate_seconds": False,
+    "run_seconds": False,
+    "ticks_per_second": True,
+    "peak_rss_kb": False,
+    "instructions": False,
+    "ticks": False,
+}
+EXACT_METRICS = {"instructions", "ticks"}
+TIME_METRICS = {"translate_seconds", "run_seconds"}
+
+
+def workloads():
+    """Имя -> (исходник, ввод): программы из examples/ и масштабированные синтетические нагрузки"""
+    result = {name: (source, stdin) for name, source, stdin in example_programs()}
+    result["cat_long"] = (CAT_SOURCE, "abcdefgh" * (CAT_INPUT_SIZE // 8))
+    result["factorial_loop"] = (FACTORIAL_SOURCE.format(count=FACTORIAL_ITERATIONS), "")
+    result["factorial_do"] = (FACTORIAL_DO_SOURCE.format(limit=FACTORIAL_ITERATIONS + 1), "")
+    result["string_literals"] = ("".join(f'." string {number}"\n' for number in range(STRING_LITERALS)) + "exit\n", "")
+    result["sum_numbers"] = (SUM_NUMBERS_SOURCE, f"{SUM_NUMBERS_COUNT}\n" + " ".join(str(number * 7919) for number in range(SUM_NUMBERS_COUNT)))
+    return result
+
+
+def best_time(function, repeats):
+    best = None
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def execute(machine_code, stdin, engine):
+    control = machine.ENGINES[engine](memory.DataPath(machine_code, stdin, find_start_of_variables(machine_code)))
+    control.instruction_limit = INSTRUCTION_LIMIT
+    try:
+        _, instructions, ticks = control.run_machine()
+        error = None
+    except Exception as exception:
+        # Counters stop at the crash, the workload is still measured up to it
+        instructions, ticks, error = control.instraction_count, control.tick, str(exception)
+    return instructions, ticks, error
+
+
+def measure(source, stdin, engine, repeats=REPEATS):
+    """Метрики одной нагрузки, запускается в отдельном процессе, чтобы пиковый RSS был только её"""
+    logging.getLogger().setLevel(logging.ERROR)
+    translate_seconds, machine_code = best_time(lambda: translate_text(source), repeats)
+    run_seconds, (instructions, ticks, error) = best_time(lambda: execute(machine_code, stdin, engine), repeats)
+    metrics = {
+        "translate_seconds": translate_seconds,
+        "run_seconds": run_seconds,
+        "ticks_per_second": ticks / run_seconds if run_seconds else 0,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "instructions": instructions,
+        "ticks": ticks,
+    }
+    if error is not None:
+        metrics["error"] = error
+    return metrics
+
+
+def run_suite(engine=DEFAULT_ENGINE, names=None, repeats=REPEATS):
+    results = {}
+    for name, (source, stdin) in workloads().items():
+        if names and name not in names:
+            continue
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+            results[name] = executor.submit(measure, source, stdin, engine, repeats).result()
+    return results
+
+
+def regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Сообщения о метриках, которые хуже базовых больше чем на tolerance"""
+    messages = []
+    for name, metrics in results.items():
+        if name not in baseline:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            old, new = baseline[name].get(metric), metrics[metric]
+            if old is None:
+                continue
+            if metric == "ticks_per_second" and min(baseline[name]["run_seconds"], metrics["run_seconds"]) < MIN_THROUGHPUT_SECONDS:
+                continue
+            allowed = 0 if metric in EXACT_METRICS else tolerance
+            slack = MIN_SECONDS if metric in TIME_METRICS else 0
+            if higher_is_better:
+                worse = new * (1 + allowed) < old
+            else:
+                worse = new > old * (1 + allowed) + slack
+            if worse:
+                messages.append(f"{name}: {metric} {old:.6g} -> {new:.6g}")
+    return messages
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def save_baseline(path, baseline):
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(baseline, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+
+def print_results(results):
+    print(f"{'workload':<16} {'translate s':>12} {'run s':>10} {'ticks/s':>12} {'peak RSS KiB':>13} {'ticks':>12}")
+    for name, metrics in results.items():
+        print(
+            f"{name:<16} {metrics['translate_seconds']:>12.4f} {metrics['run_seconds']:>10.4f} {metrics['ticks_per_second']:>12.0f} "
+            f"{metrics['peak_rss_kb']:>13} {metrics['ticks']:>12}" + (f"  ({metrics['error']})" if "error" in metrics else "")
+        )
+
+
+def main(argv):
+    names, options = machine.parse_arguments(argv)
+    engine = options.get("engine", DEFAULT_ENGINE)
+    path = options.get("baseline") or BASELINE_FILE
+    if engine not in machine.ENGINES:
+        sys.exit(f"unknown engine {engine}")
+    results = run_suite(engine, names, int(options.get("repeats") or REPEATS))
+    print_results(results)
+    baseline = load_baseline(path)
+    if "update" in options:
+        baseline.setdefault(engine, {}).update(results)
+        save_baseline(path, baseline)
+        return
+    messages = regressions(results, baseline.get(engine, {}), float(options.get("tolerance") or DEFAULT_TOLERANCE))
+    if messages:
+        sys.exit("regressions against " + path + ":\n" + "\n".join(messages))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
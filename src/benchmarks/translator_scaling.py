@@ -0,0 +1,33 @@
+import sys
+import time
+
+sys.path.append(".")
+
+from benchmarks.generate_program import generate_program
+from language.translator import translate_text
+
+DEFAULT_SIZES = [1_000, 4_000, 16_000, 64_000, 256_000]
+REPEATS = 3
+
+
+def measure(lines, repeats=REPEATS):
+    """Лучшее из repeats время трансляции синтетической программы из lines строк"""
+    source = generate_program(lines)
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        translate_text(source)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(source.splitlines()), best
+
+
+def main(sizes):
+    print(f"{'lines':>10} {'seconds':>10} {'us/line':>10}")
+    for size in sizes:
+        lines, seconds = measure(size)
+        print(f"{lines:>10} {seconds:>10.4f} {seconds / lines * 1e6:>10.2f}")
+
+
+if __name__ == "__main__":
+    main([int(size) for size in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,346 @@
+import json
+import sys
+
+sys.path.append(".")
+
+try:
+    import numpy as np
+except ImportError:  # numpy is an optional dependency, only this engine needs it
+    np = None
+
+from computer import memory
+from computer.alu import MAX_INT, MIN_INT
+from computer.fast_engine import ALU_OPCODES, COMPARE_JUMP_OPCODES, FETCH_INSTRUCTIONS, FETCH_TICKS, OPCODE_TICKS, FastEngine
+from computer.machine import load_program
+from exceptions import BatchEmulatorArgumentsError, BatchEmulatorUnavailableError
+from language.instruction import DATA_OPCODE, OPCODE_NUMBERS, Opcode
+
+RUNNING = 0
+HALTED = 1
+LIMIT = 2
+# The lane hit something the vector engine does not model exactly and is rerun alone by FastEngine
+FALLBACK = 3
+
+# Operands beyond these bounds could overflow int64 before the ALU wraps the result
+ADD_OPERAND_BOUND = 1 << 62
+MUL_OPERAND_BOUND = 1 << 31
+MAX_CHAR = 0x10FFFF
+
+ARITHMETIC_OPERATIONS = {0, 1, 2, 3, 4}
+
+
+def read_input_text(input_file):
+    """Ввод в том виде, в каком его видит машина: весь файл без ведущих и хвостовых пробелов"""
+    with memory.open_input_device(input_file) as device:
+        return "".join(chr(char) for char in iter(device.read_char, None))
+
+
+def out_of_bound(values, bound):
+    return (values >= bound) | (values <= -bound)
+
+
+def format_value(value, is_none, is_bool):
+    if is_none:
+        return "None"
+    if is_bool:
+        return str(bool(value))
+    return str(value)
+
+
+class BatchEmulator:
+    """Исполняет одну программу сразу на многих вводах: состояние каждой машины — строка массивов NumPy.
+
+    Машины шагают по одной инструкции ISA вместе, на каждом шаге дорожки группируются по опкоду.
+    Дорожка, дошедшая до того, что векторная модель не воспроизводит точно (исключение, выход за int64,
+    запись в код, неизвестный опкод), целиком перезапускается FastEngine, поэтому результат каждой
+    дорожки совпадает с run_machine.
+    """
+
+    def __init__(self, code, var_memory_start, inputs, instruction_limit=None):
+        if np is None:
+            raise BatchEmulatorUnavailableError
+        self.instruction_limit = memory.INSTRUCTION_LIMIT if instruction_limit is None else instruction_limit
+        self.code = code
+        self.var_memory_start = var_memory_start
+        self.inputs = list(inputs)
+        program = memory.Memory(code, var_memory_start)
+        lanes = len(self.inputs)
+        self.opcodes = np.frombuffer(program.opcodes, dtype=np.uint8)
+        self.args = np.frombuffer(program.args, dtype=np.int64)
+        self.data = np.tile(np.array(program.data, dtype=np.int64), (lanes, 1))
+
+        self.pc = np.ones(lanes, dtype=np.int64)
+        self.tos = np.zeros(lanes, dtype=np.int64)
+        self.tos_none = np.ones(lanes, dtype=bool)
+        self.tos_bool = np.zeros(lanes, dtype=bool)
+        self.zero_flag = np.zeros(lanes, dtype=bool)
+        self.stack = np.zeros((lanes, memory.STACK_SIZE), dtype=np.int64)
+        self.stack_bool = np.zeros((lanes, memory.STACK_SIZE), dtype=bool)
+        self.depth = np.zeros(lanes, dtype=np.int64)
+        self.instraction_count = np.zeros(lanes, dtype=np.int64)
+        self.tick = np.zeros(lanes, dtype=np.int64)
+        self.state = np.full(lanes, RUNNING, dtype=np.int8)
+
+        width = max((len(text) for text in self.inputs), default=0) or 1
+        self.input_chars = np.zeros((lanes, width), dtype=np.int64)
+        for lane, text in enumerate(self.inputs):
+            self.input_chars[lane, : len(text)] = [ord(char) for char in text]
+        self.input_length = np.array([len(text) for text in self.inputs], dtype=np.int64)
+        self.input_cursor = np.zeros(lanes, dtype=np.int64)
+        self.output = [[] for _ in range(lanes)]
+
+        handlers = {
+            **{opcode: self.alu_handler(operation.value) for opcode, operation in ALU_OPCODES.items()},
+            Opcode.DUP: self.execute_dup,
+            Opcode.DROP: self.execute_drop,
+            Opcode.SWAP: self.execute_swap,
+            Opcode.PUSH: self.execute_push,
+            Opcode.ADDR_ON_TOP: self.execute_addr_on_top,
+            Opcode.SAVE_VAR: self.execute_save_var,
+            Opcode.VAR_ON_TOP: self.execute_var_on_top,
+            Opcode.JZS: self.execute_jzs,
+            Opcode.JMP: self.execute_jmp,
+            Opcode.PRINT: self.execute_print,
+            Opcode.READ: self.execute_read,
+            Opcode.EMIT: self.execute_emit,
+            Opcode.LOAD_VAR: self.execute_load_var,
+            Opcode.STORE_VAR: self.execute_store_var,
+            **{opcode: self.compare_jzs_handler(operation.value) for opcode, operation in COMPARE_JUMP_OPCODES.items()},
+        }
+        self.opcode_handlers = {OPCODE_NUMBERS[opcode]: handler for opcode, handler in handlers.items()}
+        self.opcode_ticks = {OPCODE_NUMBERS[opcode]: ticks for opcode, ticks in OPCODE_TICKS.items()}
+
+    def fallback(self, lanes, mask):
+        self.state[lanes[mask]] = FALLBACK
+
+    def push(self, lanes, values, is_none, is_bool):
+        # Stack.push checks for overflow before it drops a None
+        overflow = self.depth[lanes] == memory.STACK_SIZE
+        self.fallback(lanes, overflow)
+        keep = ~overflow & ~is_none
+        target = lanes[keep]
+        depth = self.depth[target]
+        self.stack[target, depth] = values[keep]
+        self.stack_bool[target, depth] = is_bool[keep]
+        self.depth[target] += 1
+
+    def push_tos(self, lanes):
+        self.push(lanes, self.tos[lanes], self.tos_none[lanes], self.tos_bool[lanes])
+
+    def pop(self, lanes):
+        """Снимает вершину стека: (значения, маска None для пустого стека, маска bool)"""
+        depth = self.depth[lanes]
+        empty = depth == 0
+        top = np.maximum(depth - 1, 0)
+        values = np.where(empty, 0, self.stack[lanes, top])
+        is_bool = self.stack_bool[lanes, top] & ~empty
+        self.depth[lanes] = top
+        return values, empty, is_bool
+
+    def set_tos(self, lanes, values, is_none=False, is_bool=False):
+        self.tos[lanes] = values
+        self.tos_none[lanes] = is_none
+        self.tos_bool[lanes] = is_bool
+
+    def pop_to_tos(self, lanes):
+        self.set_tos(lanes, *self.pop(lanes))
+
+    def alu_handler(self, operation):
+        def execute_alu(lanes, args):
+            second, second_none, _ = self.pop(lanes)
+            first = self.tos[lanes]
+            invalid = self.tos_none[lanes] | second_none
+            if operation in (0, 1):
+                invalid |= out_of_bound(first, ADD_OPERAND_BOUND) | out_of_bound(second, ADD_OPERAND_BOUND)
+            elif operation == 2:
+                invalid |= out_of_bound(first, MUL_OPERAND_BOUND) | out_of_bound(second, MUL_OPERAND_BOUND)
+            elif operation in (3, 4):
+                invalid |= second == 0
+            self.fallback(lanes, invalid)
+            second = np.where(invalid, 1, second)
+            match operation:
+                case 0:
+                    result = first + second
+                case 1:
+                    result = first - second
+                case 2:
+                    result = first * second
+                case 3:
+                    result = np.floor_divide(first, second)
+                case 4:
+                    result = np.remainder(first, second)
+                case 5:
+                    result = first != second
+                case 6:
+                    result = first == second
+                case 7:
+                    result = first < second
+                case _:
+                    result = first > second
+            self.zero_flag[lanes] = result == 0
+            if operation in ARITHMETIC_OPERATIONS:
+                # Same wrap-around as ALU.apply_flags
+                result = np.where(result < MIN_INT, np.remainder(result, -MIN_INT), result)
+                result = np.where(result > MAX_INT, np.remainder(result, MAX_INT), result)
+                self.set_tos(lanes, result)
+            else:
+                self.set_tos(lanes, result.astype(np.int64), is_bool=True)
+
+        return execute_alu
+
+    def execute_dup(self, lanes, args):
+        self.push_tos(lanes)
+
+    def execute_drop(self, lanes, args):
+        self.pop(lanes)
+
+    def execute_swap(self, lanes, args):
+        second = self.pop(lanes)
+        self.push_tos(lanes)
+        self.set_tos(lanes, *second)
+
+    def execute_push(self, lanes, args):
+        self.push_tos(lanes)
+        self.set_tos(lanes, args)
+
+    def execute_addr_on_top(self, lanes, args):
+        self.push_tos(lanes)
+        self.set_tos(lanes, args + self.var_memory_start)
+
+    def checked_address(self, lanes, addresses, is_none):
+        invalid = is_none | (addresses < 0) | (addresses >= self.data.shape[1])
+        self.fallback(lanes, invalid)
+        return np.where(invalid, 0, addresses)
+
+    def execute_save_var(self, lanes, args):
+        addresses = self.checked_address(lanes, self.tos[lanes], self.tos_none[lanes])
+        values, values_none, _ = self.pop(lanes)
+        # Writing into code turns the cell into data, which only the scalar engines model
+        self.fallback(lanes, values_none | (self.opcodes[addresses] != DATA_OPCODE))
+        self.data[lanes, addresses] = values
+        self.pop_to_tos(lanes)
+
+    def execute_var_on_top(self, lanes, args):
+        addresses = self.checked_address(lanes, self.tos[lanes], self.tos_none[lanes])
+        self.set_tos(lanes, self.data[lanes, addresses])
+
+    def execute_load_var(self, lanes, args):
+        self.push_tos(lanes)
+        addresses = self.checked_address(lanes, args + self.var_memory_start, np.zeros(lanes.size, dtype=bool))
+        self.set_tos(lanes, self.data[lanes, addresses])
+
+    def execute_store_var(self, lanes, args):
+        addresses = self.checked_address(lanes, args + self.var_memory_start, np.zeros(lanes.size, dtype=bool))
+        self.fallback(lanes, self.tos_none[lanes] | (self.opcodes[addresses] != DATA_OPCODE))
+        self.data[lanes, addresses] = self.tos[lanes]
+        self.pop_to_tos(lanes)
+
+    def compare_jzs_handler(self, operation):
+        execute_alu = self.alu_handler(operation)
+
+        def execute_compare_jzs(lanes, args):
+            execute_alu(lanes, args)
+            self.pc[lanes] = np.where(self.zero_flag[lanes], args, self.pc[lanes])
+            self.pop_to_tos(lanes)
+
+        return execute_compare_jzs
+
+    def execute_jzs(self, lanes, args):
+        self.push_tos(lanes)
+        self.pc[lanes] = np.where(self.zero_flag[lanes], args, self.pc[lanes])
+        self.pop(lanes)
+        self.pop_to_tos(lanes)
+
+    def execute_jmp(self, lanes, args):
+        self.push_tos(lanes)
+        self.pc[lanes] = args
+        self.pop_to_tos(lanes)
+
+    def execute_print(self, lanes, args):
+        for lane, value, is_none, is_bool in zip(
+            lanes.tolist(), self.tos[lanes].tolist(), self.tos_none[lanes].tolist(), self.tos_bool[lanes].tolist()
+        ):
+            self.output[lane].append(" " + format_value(value, is_none, is_bool))
+        self.pop_to_tos(lanes)
+
+    def execute_read(self, lanes, args):
+        self.push_tos(lanes)
+        cursor = self.input_cursor[lanes]
+        available = cursor < self.input_length[lanes]
+        chars = self.input_chars[lanes, np.minimum(cursor, self.input_chars.shape[1] - 1)]
+        self.set_tos(lanes, np.where(available, chars, 0))
+        self.input_cursor[lanes] = cursor + available
+
+    def execute_emit(self, lanes, args):
+        values = self.tos[lanes]
+        invalid = self.tos_none[lanes] | (values < 0) | (values > MAX_CHAR)
+        self.fallback(lanes, invalid)
+        for lane, value in zip(lanes[~invalid].tolist(), values[~invalid].tolist()):
+            self.output[lane].append(chr(value))
+        self.pop_to_tos(lanes)
+
+    def step(self, lanes):
+        pcs = self.pc[lanes]
+        opcodes = self.opcodes[pcs]
+        self.fallback(lanes, opcodes == DATA_OPCODE)
+        self.instraction_count[lanes] += FETCH_INSTRUCTIONS
+        self.tick[lanes] += FETCH_TICKS
+        reached = self.instraction_count[lanes] >= self.instruction_limit
+        self.state[lanes[reached & (opcodes != DATA_OPCODE)]] = LIMIT
+        for opcode in np.unique(opcodes).tolist():
+            group = (opcodes == opcode) & ~reached & (self.state[lanes] == RUNNING)
+            selected = lanes[group]
+            if selected.size == 0:
+                continue
+            ticks, instructions = self.opcode_ticks.get(opcode, (0, 0))
+            if opcode == OPCODE_NUMBERS[Opcode.HALT]:
+                self.state[selected] = HALTED
+            elif opcode in self.opcode_handlers:
+                self.opcode_handlers[opcode](selected, self.args[pcs[group]])
+                self.pc[selected] += 1
+            else:
+                self.state[selected] = FALLBACK
+            self.instraction_count[selected] += instructions
+            self.tick[selected] += ticks
+
+    def run_lane(self, lane):
+        datapath = memory.DataPath(self.code, self.inputs[lane], self.var_memory_start)
+        engine = FastEngine(datapath)
+        engine.instruction_limit = self.instruction_limit
+        try:
+            return engine.run_machine()
+        except Exception as error:
+            return error
+
+    def run(self):
+        """Результат каждой дорожки: (вывод, счётчик инструкций, такты) или исключение, с которым она упала"""
+        while True:
+            self.state[(self.state == RUNNING) & (self.instraction_count >= self.instruction_limit)] = LIMIT
+            lanes = np.flatnonzero(self.state == RUNNING)
+            if lanes.size == 0:
+                break
+            self.step(lanes)
+        results = []
+        for lane, state in enumerate(self.state.tolist()):
+            if state == FALLBACK:
+                results.append(self.run_lane(lane))
+            else:
+                results.append(("".join(self.output[lane]), int(self.instraction_count[lane]), int(self.tick[lane])))
+        return results
+
+
+def run_batch(code_file, input_files):
+    code, start_of_variables = load_program(code_file)
+    inputs = [read_input_text(input_file) for input_file in input_files]
+    return BatchEmulator(code, start_of_variables, inputs).run()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        raise BatchEmulatorArgumentsError
+    for input_name, result in zip(sys.argv[2:], run_batch(sys.argv[1], sys.argv[2:])):
+        if isinstance(result, Exception):
+            print(json.dumps({"input": input_name, "error": str(result)}))
+        else:
+            output, inst_count, tick_count = result
+            print(json.dumps({"input": input_name, "output": output, "instraction_count": inst_count, "tick": tick_count}))
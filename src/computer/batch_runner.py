@@ -0,0 +1,122 @@
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+sys.path.append(".")
+
+from computer import memory
+from computer.machine import ENGINES, load_program, parse_arguments
+from exceptions import BatchRunnerArgumentsError, ManifestError
+from language import translator
+
+DEFAULT_ENGINE = "block"
+DEFAULT_CHUNK_SIZE = 16
+
+# Programs of the manifest, filled once per worker process by init_worker
+programs = {}
+
+
+def read_manifest(manifest_file):
+    """Задания из файла JSON lines: {"code" или "source": путь, "input": путь, "instruction_limit": n, "id": ...}"""
+    jobs = []
+    with contextlib.ExitStack() as stack:
+        file = sys.stdin if manifest_file == "-" else stack.enter_context(open(manifest_file, encoding="utf-8"))
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as error:
+                raise ManifestError(line_number, error.msg) from None
+            if not isinstance(job, dict) or "input" not in job or ("code" in job) == ("source" in job):
+                raise ManifestError(line_number, 'a job needs "input" and exactly one of "code" or "source"')
+            limit = job.get("instruction_limit", memory.INSTRUCTION_LIMIT)
+            if not isinstance(limit, int) or limit < 0:
+                raise ManifestError(line_number, '"instruction_limit" must be a non-negative integer')
+            job.setdefault("id", line_number)
+            jobs.append(job)
+    return jobs
+
+
+def program_key(job):
+    return ("source", job["source"]) if "source" in job else ("code", job["code"])
+
+
+def translate_program(source_file):
+    with tempfile.TemporaryDirectory() as directory:
+        target = os.path.join(directory, "code")
+        with contextlib.redirect_stdout(io.StringIO()):
+            translator.main(source_file, target)
+        return load_program(target)
+
+
+def load_programs(jobs):
+    """Транслирует или загружает каждую различную программу манифеста один раз"""
+    loaded = {}
+    for job in jobs:
+        key = program_key(job)
+        if key not in loaded:
+            kind, path = key
+            loaded[key] = translate_program(path) if kind == "source" else load_program(path)
+    return loaded
+
+
+def init_worker(loaded_programs):
+    programs.update(loaded_programs)
+    logging.getLogger().setLevel(logging.ERROR)
+
+
+def run_job(job, engine):
+    code, start_of_variables = programs[program_key(job)]
+    result = {"id": job["id"], "input": job["input"]}
+    try:
+        with memory.open_input_device(job["input"]) as input_device:
+            control = ENGINES[engine](memory.DataPath(code, input_device, start_of_variables))
+            control.instruction_limit = job.get("instruction_limit", memory.INSTRUCTION_LIMIT)
+            output, inst_count, tick_count = control.run_machine()
+    except Exception as error:
+        result["error"] = str(error)
+        return result
+    result.update(output=output, instraction_count=inst_count, tick=tick_count)
+    return result
+
+
+def run_jobs(jobs, engine):
+    return [run_job(job, engine) for job in jobs]
+
+
+def run_batch(jobs, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, engine=DEFAULT_ENGINE):
+    """Раздаёт задания пачками по chunk_size процессам и отдаёт результаты по мере готовности"""
+    loaded = load_programs(jobs)
+    chunks = [jobs[start : start + chunk_size] for start in range(0, len(jobs), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(loaded,)) as executor:
+        pending = {executor.submit(run_jobs, chunk, engine) for chunk in chunks}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+
+
+def main(manifest_file, output=sys.stdout, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, engine=DEFAULT_ENGINE):
+    for result in run_batch(read_manifest(manifest_file), workers, chunk_size, engine):
+        output.write(json.dumps(result) + "\n")
+        output.flush()
+
+
+if __name__ == "__main__":
+    arguments, options = parse_arguments(sys.argv[1:])
+    if len(arguments) != 1 or not set(options) <= {"workers", "chunk", "engine"}:
+        raise BatchRunnerArgumentsError
+    engine_name = options.get("engine", DEFAULT_ENGINE)
+    workers_option = options.get("workers", "")
+    chunk_option = options.get("chunk", str(DEFAULT_CHUNK_SIZE))
+    if engine_name not in ENGINES or not chunk_option.isdigit() or int(chunk_option) == 0:
+        raise BatchRunnerArgumentsError
+    if workers_option and (not workers_option.isdigit() or int(workers_option) == 0):
+        raise BatchRunnerArgumentsError
+    main(arguments[0], sys.stdout, int(workers_option) if workers_option else None, int(chunk_option), engine_name)
@@ -0,0 +1,298 @@
+from computer.controls import IOOperation, LoopControl
+from computer.fast_engine import ALU_OPCODES, COMPARE_JUMP_OPCODES, FETCH_INSTRUCTIONS, FETCH_TICKS, OPCODE_TICKS, FastEngine
+from exceptions import ReturnStackUnderflowError, StackOverflowError
+from language.instruction import DATA_OPCODE, OPCODE_NUMBERS, OPCODES, Opcode
+
+# Same order as computer.alu.ALU_OPERATIONS, the first operand is TOS, the second one is popped from the stack
+ALU_EXPRESSIONS = [
+    "tos + second",
+    "tos - second",
+    "tos * second",
+    "tos // second",
+    "tos % second",
+    "tos != second",
+    "tos == second",
+    "tos < second",
+    "tos > second",
+]
+
+BRANCH_OPCODES = {Opcode.JZS, Opcode.JMP, Opcode.CALL, Opcode.LOOP, *COMPARE_JUMP_OPCODES}
+BLOCK_END_OPCODES = {*BRANCH_OPCODES, Opcode.RET, Opcode.HALT}
+IO_OPCODES = {
+    Opcode.PRINT: "PRINT",
+    Opcode.READ: "READ",
+    Opcode.EMIT: "EMIT",
+    Opcode.PRINT_STR: "EMIT_STRING",
+    Opcode.READ_NUM: "READ_NUMBER",
+    Opcode.READ_LINE: "READ_LINE",
+}
+COMPILABLE_OPCODES = {
+    *ALU_OPCODES,
+    *BLOCK_END_OPCODES,
+    *IO_OPCODES,
+    Opcode.DUP,
+    Opcode.DROP,
+    Opcode.SWAP,
+    Opcode.PUSH,
+    Opcode.ADDR_ON_TOP,
+    Opcode.SAVE_VAR,
+    Opcode.VAR_ON_TOP,
+    Opcode.LOAD_VAR,
+    Opcode.STORE_VAR,
+    Opcode.DO,
+    Opcode.UNLOOP,
+    Opcode.LOOP_INDEX,
+}
+
+PUSH_TOS = ["if len(stack) == max_size:", "    raise StackOverflowError(max_size)", "if tos is not None:", "    stack.append(tos)"]
+POP_TO = "{} = stack.pop() if stack else None"
+
+
+class Block:
+    def __init__(self, start, function, budget):
+        self.start = start
+        self.function = function
+        # The block runs whole only while instraction_count + budget stays below INSTRUCTION_LIMIT,
+        # budget is every counter increment of the block except the last instruction's routine
+        self.budget = budget
+
+
+class BlockCompiler:
+    """Делит загруженный код на базовые блоки и собирает каждый блок в одну функцию Python"""
+
+    def __init__(self, control_unit):
+        self.control_unit = control_unit
+        self.datapath = control_unit.datapath
+        opcodes = self.datapath.memory.opcodes
+        args = self.datapath.memory.args
+        jumps = {OPCODE_NUMBERS[opcode] for opcode in BRANCH_OPCODES}
+        ret = OPCODE_NUMBERS[Opcode.RET]
+        self.code_end = max((address for address, opcode in enumerate(opcodes) if opcode != DATA_OPCODE), default=0)
+        self.leaders = set()
+        for address, opcode in enumerate(opcodes):
+            if opcode in jumps:
+                self.leaders.add(args[address] + 1)
+                self.leaders.add(address + 1)
+            elif opcode == ret:
+                self.leaders.add(address + 1)
+
+    def collect(self, start):
+        opcodes = self.datapath.memory.opcodes
+        args = self.datapath.memory.args
+        instructions = []
+        address = start
+        while address < len(opcodes) and opcodes[address] < len(OPCODES):
+            opcode = OPCODES[opcodes[address]]
+            if opcode not in COMPILABLE_OPCODES:
+                break
+            if instructions and address in self.leaders:
+                break
+            instructions.append((opcode, args[address]))
+            if opcode in BLOCK_END_OPCODES:
+                break
+            address += 1
+        return instructions
+
+    def compile(self, start):
+        instructions = self.collect(start)
+        if not instructions:
+            return None
+        lines = []
+        pending_ticks = 0
+        pending_instructions = 0
+
+        def flush():
+            nonlocal pending_ticks, pending_instructions
+            if pending_ticks:
+                lines.append(f"cu.tick += {pending_ticks}")
+                lines.append(f"cu.instraction_count += {pending_instructions}")
+            pending_ticks = 0
+            pending_instructions = 0
+
+        next_pc = start + len(instructions)
+        for address, (opcode, arg) in enumerate(instructions, start):
+            ticks, routine_instructions = OPCODE_TICKS[opcode]
+            pending_ticks += FETCH_TICKS
+            pending_instructions += FETCH_INSTRUCTIONS
+            if opcode in IO_OPCODES:
+                # Counters and PC are brought up to date before IO, as FastEngine has them at that point
+                flush()
+                lines.append(f"dp.pc = {address}")
+            pending_ticks += ticks
+            pending_instructions += routine_instructions
+            match opcode:
+                case _ if opcode in ALU_OPCODES:
+                    lines.append(POP_TO.format("second"))
+                    expression = ALU_EXPRESSIONS[ALU_OPCODES[opcode].value]
+                    lines.append(f"tos = alu.result = alu.apply_flags({expression})")
+                case Opcode.DUP:
+                    lines.extend(PUSH_TOS)
+                case Opcode.DROP:
+                    lines.append("if stack:")
+                    lines.append("    stack.pop()")
+                case Opcode.SWAP:
+                    lines.append(POP_TO.format("second"))
+                    lines.extend(PUSH_TOS)
+                    lines.append("tos = second")
+                case Opcode.PUSH:
+                    lines.extend(PUSH_TOS)
+                    lines.append(f"tos = {arg}")
+                case Opcode.ADDR_ON_TOP:
+                    lines.extend(PUSH_TOS)
+                    lines.append(f"tos = {arg + self.datapath.memory.var_memory_start}")
+                case Opcode.SAVE_VAR | Opcode.STORE_VAR:
+                    if opcode is Opcode.SAVE_VAR:
+                        lines.append("address = tos")
+                        lines.append(POP_TO.format("value"))
+                    else:
+                        lines.append(f"address = {arg + self.datapath.memory.var_memory_start}")
+                        lines.append("value = tos")
+                    lines.append("data[address] = int(value)")
+                    lines.append(POP_TO.format("tos"))
+                    lines.append(f"if address <= {self.code_end} and opcodes[address] != DATA_OPCODE:")
+                    lines.append("    opcodes[address] = DATA_OPCODE")
+                    # A write into the code region ends the block and hands the rest of the run to the interpreter
+                    lines.append(f"    cu.tick += {pending_ticks}")
+                    lines.append(f"    cu.instraction_count += {pending_instructions}")
+                    lines.append("    dp.top_of_stack = tos")
+                    lines.append(f"    dp.pc = {address + 1}")
+                    lines.append("    compiler.invalidate()")
+                    lines.append("    return")
+                case Opcode.VAR_ON_TOP:
+                    lines.append("tos = data[tos]")
+                case Opcode.LOAD_VAR:
+                    lines.extend(PUSH_TOS)
+                    lines.append(f"tos = data[{arg + self.datapath.memory.var_memory_start}]")
+                case Opcode.PRINT | Opcode.EMIT:
+                    lines.append("dp.top_of_stack = tos")
+                    lines.append(f"dp.control_io(IOOperation.{IO_OPCODES[opcode]})")
+                    lines.append(POP_TO.format("tos"))
+                case Opcode.PRINT_STR:
+                    # Adds the ticks of the burst beyond the first character itself
+                    lines.append(f"cu.execute_print_str({arg})")
+                case Opcode.READ | Opcode.READ_NUM:
+                    lines.extend(PUSH_TOS)
+                    lines.append(f"dp.control_io(IOOperation.{IO_OPCODES[opcode]})")
+                    lines.append("tos = dp.top_of_stack")
+                case Opcode.READ_LINE:
+                    lines.append("dp.top_of_stack = tos")
+                    lines.append("address = tos")
+                    # Adds the ticks of the burst beyond the first character itself
+                    lines.append("cu.execute_read_line(0)")
+                    lines.append("tos = dp.top_of_stack")
+                    # A line read into the code region ends the block as a store does
+                    lines.append(f"if tos and address <= {self.code_end}:")
+                    lines.append(f"    cu.tick += {pending_ticks}")
+                    lines.append(f"    cu.instraction_count += {pending_instructions}")
+                    lines.append("    dp.top_of_stack = tos")
+                    lines.append(f"    dp.pc = {address + 1}")
+                    lines.append("    compiler.invalidate()")
+                    lines.append("    return")
+                case Opcode.JZS:
+                    lines.extend(PUSH_TOS)
+                    lines.append(f"next_pc = {arg + 1} if alu.zero_flag == 1 else {address + 1}")
+                    lines.append("if stack:")
+                    lines.append("    stack.pop()")
+                    lines.append(POP_TO.format("tos"))
+                    next_pc = "next_pc"
+                case _ if opcode in COMPARE_JUMP_OPCODES:
+                    lines.append(POP_TO.format("second"))
+                    expression = ALU_EXPRESSIONS[COMPARE_JUMP_OPCODES[opcode].value]
+                    lines.append(f"alu.result = alu.apply_flags({expression})")
+                    lines.append(f"next_pc = {arg + 1} if alu.zero_flag == 1 else {address + 1}")
+                    lines.append(POP_TO.format("tos"))
+                    next_pc = "next_pc"
+                case Opcode.DO:
+                    lines.append("dp.control_loop(LoopControl.PUSH_LIMIT)")
+                    lines.append("dp.control_loop(LoopControl.PUSH_INDEX)")
+                    lines.append("dp.loop_index = tos")
+                    lines.append(POP_TO.format("dp.loop_limit"))
+                    lines.append(POP_TO.format("tos"))
+                case Opcode.UNLOOP:
+                    lines.append("dp.control_loop(LoopControl.POP_INDEX)")
+                    lines.append("dp.control_loop(LoopControl.POP_LIMIT)")
+                case Opcode.LOOP_INDEX:
+                    lines.extend(PUSH_TOS)
+                    lines.append("tos = dp.loop_index")
+                case Opcode.LOOP:
+                    lines.append("dp.loop_index += 1")
+                    lines.append(f"next_pc = {arg + 1} if dp.loop_index < dp.loop_limit else {address + 1}")
+                    next_pc = "next_pc"
+                case Opcode.CALL:
+                    lines.append(f"dp.return_stack.push({address})")
+                    next_pc = arg + 1
+                case Opcode.RET:
+                    lines.append("next_pc = dp.return_stack.pop()")
+                    lines.append("if next_pc is None:")
+                    lines.append("    raise ReturnStackUnderflowError")
+                    lines.append("next_pc += 1")
+                    next_pc = "next_pc"
+                case Opcode.JMP:
+                    lines.extend(PUSH_TOS)
+                    lines.append(POP_TO.format("tos"))
+                    next_pc = arg + 1
+                case Opcode.HALT:
+                    flush()
+                    lines.append("dp.top_of_stack = tos")
+                    lines.append("raise StopIteration")
+        if instructions[-1][0] is not Opcode.HALT:
+            flush()
+            lines.append("dp.top_of_stack = tos")
+            lines.append(f"dp.pc = {next_pc}")
+
+        source = (
+            f"def block_{start}():\n"
+            "    tos = dp.top_of_stack\n"
+            + "".join(f"    {line}\n" for line in lines)
+        )
+        namespace = {
+            "cu": self.control_unit,
+            "dp": self.datapath,
+            "alu": self.datapath.alu,
+            "stack": self.datapath.data_stack.stack,
+            "max_size": self.datapath.data_stack.max_size,
+            "opcodes": self.datapath.memory.opcodes,
+            "data": self.datapath.memory.data,
+            "DATA_OPCODE": DATA_OPCODE,
+            "compiler": self,
+            "IOOperation": IOOperation,
+            "LoopControl": LoopControl,
+            "StackOverflowError": StackOverflowError,
+            "ReturnStackUnderflowError": ReturnStackUnderflowError,
+        }
+        exec(compile(source, f"<block {start}>", "exec"), namespace)
+
+        total = len(instructions) * FETCH_INSTRUCTIONS + sum(OPCODE_TICKS[opcode][1] for opcode, _ in instructions)
+        last = OPCODE_TICKS[instructions[-1][0]][1]
+        return Block(start, namespace[f"block_{start}"], total - last)
+
+    def invalidate(self):
+        self.control_unit.blocks = None
+
+
+class BlockEngine(FastEngine):
+    """Исполняет базовые блоки, собранные в функции Python и закешированные по адресу начала.
+
+    Всё, что не собирается в блок, и остаток прогона после записи в область кода исполняются FastEngine.
+    """
+
+    def __init__(self, datapath):
+        super().__init__(datapath)
+        self.compiler = BlockCompiler(self)
+        self.blocks = {}
+
+    def execute_program(self):
+        limit = self.instruction_limit
+        datapath = self.datapath
+        while self.instraction_count < limit:
+            if self.blocks is None:
+                self.step()
+                continue
+            pc = datapath.pc
+            if pc not in self.blocks:
+                self.blocks[pc] = self.compiler.compile(pc)
+            block = self.blocks[pc]
+            if block is not None and self.instraction_count + block.budget < limit:
+                block.function()
+            else:
+                self.step()
@@ -0,0 +1,96 @@
+import base64
+import hashlib
+import json
+import os
+import socket
+import sys
+import tempfile
+
+sys.path.append(".")
+
+from exceptions import WrongMachineArgumentsError
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "csa-machine.sock")
+CLIENT_OPTIONS = {"socket", "engine", "instruction-limit", "source", "optimize", "fuse"}
+
+
+def program_hash(program):
+    return hashlib.sha256(program).hexdigest()
+
+
+def send(stream, message):
+    stream.write(json.dumps(message).encode("utf-8") + b"\n")
+    stream.flush()
+
+
+def receive(stream):
+    line = stream.readline()
+    if not line:
+        raise ConnectionError("server closed the connection")
+    return json.loads(line)
+
+
+def run_remote(program, stdin, socket_path=DEFAULT_SOCKET, source=False, **options):
+    """Исполняет программу на сервере: program — байты машинного кода (JSON или образ) или исходника при source=True.
+
+    Машинный код сначала отправляется только хешем, содержимое досылается, если сервер его ещё не видел.
+    """
+    message = {"input": stdin, **options}
+    if source:
+        message["source"] = program.decode("utf-8")
+    else:
+        message["hash"] = program_hash(program)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        with connection.makefile("rwb") as stream:
+            send(stream, message)
+            response = receive(stream)
+            if response.get("missing"):
+                send(stream, {**message, "program": base64.b64encode(program).decode("ascii")})
+                response = receive(stream)
+    return response
+
+
+# Same as machine.parse_arguments, machine.py is not imported so that the client starts without loading the emulator
+def parse_arguments(argv):
+    positional = []
+    options = {}
+    for argument in argv:
+        if argument.startswith("--"):
+            key, _, value = argument[2:].partition("=")
+            options[key] = value
+        else:
+            positional.append(argument)
+    return positional, options
+
+
+def main(code_file, input_file, log_file, options):
+    with open(code_file, "rb") as file:
+        program = file.read()
+    if input_file == "-":
+        stdin = sys.stdin.read()
+    else:
+        with open(input_file, encoding="utf-8") as file:
+            stdin = file.read()
+    request = {"engine": options.get("engine", "microcode")}
+    if options.get("instruction-limit"):
+        request["instruction_limit"] = int(options["instruction-limit"])
+    if "source" in options:
+        request.update(optimize="optimize" in options, fuse="fuse" in options)
+    response = run_remote(program, stdin, options.get("socket") or DEFAULT_SOCKET, "source" in options, **request)
+    # The log is written by the server process, the file is kept for the machine.py interface
+    with open(log_file, "w", encoding="utf-8") as file:
+        if "error" in response:
+            file.write(f"[ERROR]  {response['error']}\n")
+    if "error" in response:
+        sys.exit(response["error"])
+    print(f"{response['output']}\n\ninstraction count -> {response['instruction_count']!s}\ntick -> {response['ticks']!s}")
+
+
+if __name__ == "__main__":
+    arguments, client_options = parse_arguments(sys.argv[1:])
+    if len(arguments) != 3 or not set(client_options) <= CLIENT_OPTIONS:
+        raise WrongMachineArgumentsError
+    if not client_options.get("instruction-limit", "0").isdigit():
+        raise WrongMachineArgumentsError
+    main(*arguments, client_options)
@@ -1,11 +1,11 @@
 import logging
+from functools import partial
 from typing import ClassVar
-import sys
-
 
 
 from computer import memory
-from exceptions import InvalidSignalError
+from computer.tracing import Tracer, format_tick, snapshot
+from exceptions import DataExecutionError, InvalidSignalError
 from language.instruction import Opcode
 from computer.controls import (
     JumpOperation,
@@ -14,42 +14,69 @@ from computer.controls import (
     ALUValuesControl,
     AddressRegisterControl,
     BufferRegisterControl,
+    CounterControl,
     DataStackControl,
     InstructionControl,
     IOOperation,
     InstructionRegisterControl,
+    LoopControl,
     MicrocodeAddressControl,
     MemoryControl,
     InstractionPointerControl,
+    ReturnStackControl,
     TopOfStackControl,
 )
 
 
-def opcode2microcode(opcode):
-    return {
-        Opcode.SUM: 2,
-        Opcode.SUB: 4,
-        Opcode.MUL: 6,
-        Opcode.DIV: 8,
-        Opcode.MOD: 10,
-        Opcode.DUP: 12,
-        Opcode.DROP: 14,
-        Opcode.SWAP: 16,
-        Opcode.EQ: 19,
-        Opcode.MORE: 21,
-        Opcode.LESS: 23,
-        Opcode.PUSH: 25,
-        Opcode.ADDR_ON_TOP: 27,
-        Opcode.SAVE_VAR: 29,
-        Opcode.VAR_ON_TOP: 32,
-        Opcode.JZS: 35,
-        Opcode.JMP: 38,
-        Opcode.PRINT: 41,
-        Opcode.READ: 44,
-        Opcode.EMIT: 46,
-        Opcode.HALT: 49,
-        Opcode.NOT_EQ: 50,
-    }.get(opcode)
+OPCODE_MICROCODE = {
+    Opcode.SUM: 2,
+    Opcode.SUB: 4,
+    Opcode.MUL: 6,
+    Opcode.DIV: 8,
+    Opcode.MOD: 10,
+    Opcode.DUP: 12,
+    Opcode.DROP: 14,
+    Opcode.SWAP: 16,
+    Opcode.EQ: 19,
+    Opcode.MORE: 21,
+    Opcode.LESS: 23,
+    Opcode.PUSH: 25,
+    Opcode.ADDR_ON_TOP: 27,
+    Opcode.SAVE_VAR: 29,
+    Opcode.VAR_ON_TOP: 32,
+    Opcode.JZS: 35,
+    Opcode.JMP: 38,
+    Opcode.PRINT: 41,
+    Opcode.READ: 44,
+    Opcode.EMIT: 46,
+    Opcode.HALT: 49,
+    Opcode.NOT_EQ: 50,
+    Opcode.LOAD_VAR: 52,
+    Opcode.STORE_VAR: 54,
+    Opcode.EQ_JZS: 57,
+    Opcode.NOT_EQ_JZS: 60,
+    Opcode.MORE_JZS: 63,
+    Opcode.LESS_JZS: 66,
+    Opcode.CALL: 69,
+    Opcode.RET: 72,
+    Opcode.PRINT_STR: 74,
+    Opcode.READ_NUM: 77,
+    Opcode.READ_LINE: 79,
+    Opcode.DO: 83,
+    Opcode.LOOP: 88,
+    Opcode.UNLOOP: 90,
+    Opcode.LOOP_INDEX: 92,
+}
+
+
+# Microcode entry address indexed by opcode number
+MICROCODE_ENTRY = [OPCODE_MICROCODE[opcode] for opcode in Opcode]
+
+
+def opcode2microcode(opcode_number, address=None):
+    if opcode_number >= len(MICROCODE_ENTRY):
+        raise DataExecutionError(address)
+    return MICROCODE_ENTRY[opcode_number]
 
 
 microcode = [
@@ -98,7 +125,7 @@ microcode = [
     [InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
     # SAVE_VAR - 29
     [AddressRegisterControl.TOS, BufferRegisterControl.DS, TopOfStackControl.BR, MemoryControl.TOS, MicrocodeAddressControl.INC],
-    [MemoryControl.WRITE, BufferRegisterControl.DS, TopOfStackControl.BR, MicrocodeAddressControl.INC],
+    [BufferRegisterControl.DS, TopOfStackControl.BR, MemoryControl.WRITE, MicrocodeAddressControl.INC],
     [InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
     # VAR_ON_TOP - 32
     [AddressRegisterControl.TOS, MemoryControl.READ, MicrocodeAddressControl.INC],
@@ -118,7 +145,7 @@ microcode = [
     [InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
     # READ - 44
     [DataStackControl.Push, MicrocodeAddressControl.INC],
-    [IOOperation.READ, InstructionControl.INC, InstractionPointerControl.INC, MicrocodeAddressControl.ZERO],
+    [IOOperation.READ, InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
     # EMIT - 46
     [IOOperation.EMIT, MicrocodeAddressControl.INC],
     [BufferRegisterControl.DS, TopOfStackControl.BR, MicrocodeAddressControl.INC],
@@ -128,6 +155,62 @@ microcode = [
     # NOT_EQ - 50
     [ALUValuesControl.VAR, AluOperation.NOT_EQ, MicrocodeAddressControl.INC],
     [TopOfStackControl.ALU, InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
+    # LOAD_VAR - 52
+    [DataStackControl.Push, TopOfStackControl.IR_VAR, MicrocodeAddressControl.INC],
+    [AddressRegisterControl.TOS, TopOfStackControl.MEM, InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
+    # STORE_VAR - 54
+    [MemoryControl.TOS, MicrocodeAddressControl.INC],
+    [TopOfStackControl.IR_VAR, MicrocodeAddressControl.INC],
+    [AddressRegisterControl.TOS, BufferRegisterControl.DS, TopOfStackControl.BR, MemoryControl.WRITE, InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
+    # EQ_JZS - 57
+    [ALUValuesControl.VAR, AluOperation.EQ, MicrocodeAddressControl.INC],
+    [TopOfStackControl.IR, JumpOperation.JZS, MicrocodeAddressControl.INC],
+    [BufferRegisterControl.DS, TopOfStackControl.BR, InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
+    # NOT_EQ_JZS - 60
+    [ALUValuesControl.VAR, AluOperation.NOT_EQ, MicrocodeAddressControl.INC],
+    [TopOfStackControl.IR, JumpOperation.JZS, MicrocodeAddressControl.INC],
+    [BufferRegisterControl.DS, TopOfStackControl.BR, InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
+    # MORE_JZS - 63
+    [ALUValuesControl.VAR, AluOperation.MORE, MicrocodeAddressControl.INC],
+    [TopOfStackControl.IR, JumpOperation.JZS, MicrocodeAddressControl.INC],
+    [BufferRegisterControl.DS, TopOfStackControl.BR, InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
+    # LESS_JZS - 66
+    [ALUValuesControl.VAR, AluOperation.LESS, MicrocodeAddressControl.INC],
+    [TopOfStackControl.IR, JumpOperation.JZS, MicrocodeAddressControl.INC],
+    [BufferRegisterControl.DS, TopOfStackControl.BR, InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
+    # CALL - 69
+    [MicrocodeAddressControl.INC, ReturnStackControl.PUSH],
+    [InstractionPointerControl.IR, MicrocodeAddressControl.INC],
+    [InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
+    # RET - 72
+    [MicrocodeAddressControl.INC, ReturnStackControl.POP],
+    [InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
+    # PRINT_STR - 74, the length is loaded into the counter register, then one character per pass of the burst row
+    [AddressRegisterControl.IR_VAR, MemoryControl.READ, MicrocodeAddressControl.INC, CounterControl.LOAD],
+    [IOOperation.EMIT_STRING, MicrocodeAddressControl.REPEAT],
+    [InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
+    # READ_NUM - 77
+    [DataStackControl.Push, MicrocodeAddressControl.INC],
+    [IOOperation.READ_NUMBER, InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
+    # READ_LINE - 79, the buffer address is on top and the limit under it, one character per pass of the burst row
+    [AddressRegisterControl.TOS, BufferRegisterControl.DS, MicrocodeAddressControl.INC],
+    [TopOfStackControl.ZERO, MicrocodeAddressControl.INC, CounterControl.BR],
+    [IOOperation.READ_LINE, MicrocodeAddressControl.REPEAT],
+    [InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
+    # DO - 83, the start is on top and the limit under it, the enclosing pair goes to the return stack
+    [MicrocodeAddressControl.INC, LoopControl.PUSH_LIMIT],
+    [MicrocodeAddressControl.INC, LoopControl.PUSH_INDEX],
+    [MicrocodeAddressControl.INC, LoopControl.INDEX_TOS],
+    [BufferRegisterControl.DS, MicrocodeAddressControl.INC, LoopControl.LIMIT_BR],
+    [BufferRegisterControl.DS, TopOfStackControl.BR, InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
+    # LOOP - 88
+    [MicrocodeAddressControl.INC, LoopControl.INC],
+    [JumpOperation.LOOP, InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
+    # UNLOOP - 90
+    [MicrocodeAddressControl.INC, LoopControl.POP_INDEX],
+    [InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO, LoopControl.POP_LIMIT],
+    # LOOP_INDEX - 92
+    [DataStackControl.Push, TopOfStackControl.INDEX, InstractionPointerControl.INC, InstructionControl.INC, MicrocodeAddressControl.ZERO],
 ]
 
 
@@ -143,6 +226,9 @@ class ControlUnit:
         self.datapath = datapath
         self.tick = 0
         self.instraction_count = 0
+        self.instruction_limit = memory.INSTRUCTION_LIMIT
+        self.tracer = Tracer()
+        self.profiler = None
         self.signal_handlers = {
             AddressRegisterControl: [getattr(self.datapath, "control_address_register"), 2],
             MemoryControl: [getattr(self.datapath, "control_memory"), 2],
@@ -157,20 +243,13 @@ class ControlUnit:
             IOOperation: [getattr(self.datapath, "control_io"), 2],
             JumpOperation: [getattr(self.datapath, "handle_jump"), 2],
             InstructionControl: [getattr(self, "inc_instraction_count"), 1],
+            ReturnStackControl: [getattr(self.datapath, "control_return_stack"), 2],
+            CounterControl: [getattr(self.datapath, "control_counter"), 2],
+            LoopControl: [getattr(self.datapath, "control_loop"), 2],
         }
 
     def __repr__(self, signal):
-        return (
-            "tick -> {:4} ip -> {:3} addr -> {:3} mc -> {:2} control -> {:15} tos -> {:6}\n" "stack -> {}"
-        ).format(
-            str(self.tick),
-            str(self.datapath.pc),
-            str(self.datapath.address_register),
-            str(self.mc_adr),
-            str(signal),
-            str(self.datapath.top_of_stack) if self.datapath.top_of_stack is not None else "0",
-            self.datapath.data_stack.stack,
-        )
+        return format_tick(snapshot(self, signal))
 
     def inc_tick(self):
         self.tick += 1
@@ -190,29 +269,151 @@ class ControlUnit:
                 if isinstance(signal, ProgramControl):
                     raise StopIteration
                 raise InvalidSignalError(signal)
-            logging.debug("%s", self.__repr__(signal))
+            self.inc_tick()
+
+    def execute_traced_instraction(self, signals):
+        tracer = self.tracer
+        for signal in signals:
+            handler_name = self.signal_handlers.get(type(signal))
+            if handler_name:
+                if handler_name[1] == 2:
+                    handler_name[0](signal)
+                else:
+                    handler_name[0]()
+            else:
+                if isinstance(signal, ProgramControl):
+                    raise StopIteration
+                raise InvalidSignalError(signal)
+            tracer.tick(self, signal)
             self.inc_tick()
 
     def control_microcode_address(self, signal):
         match signal:
             case MicrocodeAddressControl.IR:
-                self.mc_adr = opcode2microcode(self.datapath.instruction_register["opcode"])
+                self.mc_adr = opcode2microcode(self.datapath.instruction_opcode, self.datapath.address_register)
             case MicrocodeAddressControl.INC:
                 self.mc_adr += 1
             case MicrocodeAddressControl.ZERO:
                 self.mc_adr = 0
+            case MicrocodeAddressControl.REPEAT:
+                if self.datapath.counter_register <= 0:
+                    self.mc_adr += 1
 
-    def run_machine(self):
+    def execute_program(self):
+        while self.instraction_count < self.instruction_limit:
+            self.execute_instraction(microcode[self.mc_adr])
+
+    def execute_traced_program(self):
+        """Микрокод с трассировкой, для любого движка: состояние у всех движков общее"""
+        trace_ticks = self.tracer.records_ticks
+        trace_instructions = self.tracer.traces_instructions
+        while self.instraction_count < self.instruction_limit:
+            address = self.mc_adr
+            if trace_ticks:
+                self.execute_traced_instraction(microcode[address])
+            else:
+                self.execute_instraction(microcode[address])
+            if trace_instructions and address == 1:
+                self.tracer.instruction(self)
+
+    def execute_profiled_program(self):
+        """Микрокод с записью профиля, для любого движка: тики инструкции, включая выборку, относятся к её адресу"""
+        profiler = self.profiler
+        datapath = self.datapath
+        address = datapath.pc
+        start = self.tick
         try:
-            while self.instraction_count < memory.INSTRUCTION_LIMIT:
+            while self.instraction_count < self.instruction_limit:
                 self.execute_instraction(microcode[self.mc_adr])
+                if self.mc_adr == 0:
+                    profiler.record(address, self.tick - start)
+                    address = datapath.pc
+                    start = self.tick
+        finally:
+            # halt and crashes stop in the middle of an instruction
+            if self.tick != start:
+                profiler.record(address, self.tick - start)
+
+    def run_machine(self):
+        if self.profiler is not None:
+            execute = ControlUnit.execute_profiled_program
+        elif self.tracer.enabled:
+            execute = ControlUnit.execute_traced_program
+        else:
+            execute = type(self).execute_program
+        try:
+            execute(self)
+            self.tracer.dump("instruction limit")
         except StopIteration:
             pass
         except OSError:
-            pass
-        output = ""
-        for stroka in "".join(self.datapath.output_buffer).split("\n"):
-            tabs = 4 * '\t'
-            output += f"{tabs}{stroka}\n"
-        logging.debug("output_buffer: \n" + output[0:-1])
-        return self.datapath.output_buffer, self.instraction_count, self.tick
+            self.tracer.dump("IO error")
+        except Exception:
+            self.tracer.dump("crash")
+            raise
+        output = self.datapath.output_device.getvalue()
+        if output and logging.getLogger().isEnabledFor(logging.DEBUG):
+            tabs = 4 * "\t"
+            logging.debug("output_buffer: \n" + "\n".join(f"{tabs}{stroka}" for stroka in output.split("\n")))
+        return output, self.instraction_count, self.tick
+
+
+def fuse_microinstruction(control_unit, address, signals):
+    """Собирает одну строку микрокода в функцию без диспетчеризации по типу сигнала"""
+    namespace = {"cu": control_unit, "dp": control_unit.datapath, "opcode2microcode": opcode2microcode}
+    lines = []
+    pending_ticks = 0
+    for number, signal in enumerate(signals):
+        if isinstance(signal, ProgramControl):
+            break
+        if isinstance(signal, IOOperation) and pending_ticks:
+            # IO may raise OSError, which run_machine reports, so ticks must be exact at that point
+            lines.append(f"cu.tick += {pending_ticks}")
+            pending_ticks = 0
+        match signal:
+            case MicrocodeAddressControl.INC:
+                lines.append(f"cu.mc_adr = {address + 1}")
+            case MicrocodeAddressControl.ZERO:
+                lines.append("cu.mc_adr = 0")
+            case MicrocodeAddressControl.IR:
+                lines.append("cu.mc_adr = opcode2microcode(dp.instruction_opcode, dp.address_register)")
+            case MicrocodeAddressControl.REPEAT:
+                lines.append(f"cu.mc_adr = {address} if dp.counter_register > 0 else {address + 1}")
+            case InstructionControl.INC:
+                lines.append("cu.instraction_count += 1")
+            case _:
+                handler = control_unit.signal_handlers.get(type(signal))
+                if handler is None:
+                    raise InvalidSignalError(signal)
+                namespace[f"step{number}"] = partial(handler[0], signal) if handler[1] == 2 else handler[0]
+                lines.append(f"step{number}()")
+        pending_ticks += 1
+    if pending_ticks:
+        lines.append(f"cu.tick += {pending_ticks}")
+    if any(isinstance(signal, ProgramControl) for signal in signals):
+        lines.append("raise StopIteration")
+
+    source = f"def microinstruction_{address}():\n" + "".join(f"    {line}\n" for line in lines)
+    exec(compile(source, f"<microcode {address}>", "exec"), namespace)
+    return namespace[f"microinstruction_{address}"]
+
+
+def compile_microcode(control_unit):
+    return [fuse_microinstruction(control_unit, address, signals) for address, signals in enumerate(microcode)]
+
+
+class CompiledControlUnit(ControlUnit):
+    """Исполняет микрокод, заранее собранный в функции по одной на микрокоманду.
+
+    Тики и счётчик инструкций совпадают с ControlUnit, потактовый лог не пишется.
+    """
+
+    def __init__(self, datapath):
+        super().__init__(datapath)
+        self.compiled_microcode = compile_microcode(self)
+
+    def execute_program(self):
+        compiled_microcode = self.compiled_microcode
+        limit = self.instruction_limit
+        while self.instraction_count < limit:
+            compiled_microcode[self.mc_adr]()
@@ -9,6 +9,7 @@ class DataStackControl(Enum):
 class AddressRegisterControl(Enum):
     PC = 0
     TOS = 1
+    IR_VAR = 2
 
 
 class InstructionRegisterControl(Enum):
@@ -27,6 +28,8 @@ class TopOfStackControl(Enum):
     ALU = 3
     IR_VAR = 4
     IO = 5
+    ZERO = 6
+    INDEX = 7
 
 
 class ALUValuesControl(Enum):
@@ -55,6 +58,8 @@ class MicrocodeAddressControl(Enum):
     IR = 0
     INC = 1
     ZERO = 2
+    # Stays on the same microinstruction while the counter register is positive
+    REPEAT = 3
 
 
 class BufferRegisterControl(Enum):
@@ -70,12 +75,18 @@ class FlagCheck(Enum):
 class JumpOperation(Enum):
     JMP = 0
     JZS = 1
+    # To the IR argument while the loop index is below the limit
+    LOOP = 2
 
 
 class IOOperation(Enum):
     PRINT = 0
     READ = 1
     EMIT = 2
+    EMIT_STRING = 3
+    # Whole decimal number, and one character of a line into memory per pass of a REPEAT row
+    READ_NUMBER = 4
+    READ_LINE = 5
 
 
 class ProgramControl(Enum):
@@ -84,3 +95,25 @@ class ProgramControl(Enum):
 
 class InstructionControl(Enum):
     INC = 0
+
+
+class ReturnStackControl(Enum):
+    # Push PC, pop the return stack into PC
+    PUSH = 0
+    POP = 1
+
+
+class CounterControl(Enum):
+    LOAD = 0
+    BR = 1
+
+
+class LoopControl(Enum):
+    # The pair of the enclosing loop is saved on the return stack while an inner loop runs
+    PUSH_LIMIT = 0
+    PUSH_INDEX = 1
+    POP_INDEX = 2
+    POP_LIMIT = 3
+    INDEX_TOS = 4
+    LIMIT_BR = 5
+    INC = 6
@@ -0,0 +1,288 @@
+from functools import partial
+
+from computer.alu import ALU_OPERATIONS
+from computer.control_unit import MICROCODE_ENTRY, OPCODE_MICROCODE, ControlUnit, compile_microcode, microcode
+from computer.controls import AluOperation, InstructionControl, IOOperation, LoopControl, MicrocodeAddressControl, ProgramControl
+from exceptions import DataExecutionError, ReturnStackUnderflowError
+from language.instruction import OPCODE_NUMBERS, Opcode
+
+ALU_OPCODES = {
+    Opcode.SUM: AluOperation.SUM,
+    Opcode.SUB: AluOperation.SUB,
+    Opcode.MUL: AluOperation.MUL,
+    Opcode.DIV: AluOperation.DIV,
+    Opcode.MOD: AluOperation.MOD,
+    Opcode.NOT_EQ: AluOperation.NOT_EQ,
+    Opcode.EQ: AluOperation.EQ,
+    Opcode.MORE: AluOperation.MORE,
+    Opcode.LESS: AluOperation.LESS,
+}
+# Comparison + jzs superinstructions
+COMPARE_JUMP_OPCODES = {
+    Opcode.EQ_JZS: AluOperation.EQ,
+    Opcode.NOT_EQ_JZS: AluOperation.NOT_EQ,
+    Opcode.MORE_JZS: AluOperation.MORE,
+    Opcode.LESS_JZS: AluOperation.LESS,
+}
+
+
+def count_routine(entry):
+    """Проходит микропрограмму от адреса entry до сброса mc_adr или останова: (тики, инкременты счётчика инструкций)
+
+    Строка с MicrocodeAddressControl.REPEAT считается за один проход, остальные проходы добавляет обработчик опкода.
+    """
+    ticks = 0
+    instructions = 0
+    address = entry
+    while True:
+        row = microcode[address]
+        ticks += sum(1 for signal in row if not isinstance(signal, ProgramControl))
+        instructions += row.count(InstructionControl.INC)
+        if MicrocodeAddressControl.INC not in row and MicrocodeAddressControl.REPEAT not in row:
+            return ticks, instructions
+        address += 1
+
+
+# Ticks of the fetch cycle (rows up to the IR decode) and of every opcode routine, JZS/JMP take the
+# same microcode path whether the jump is taken or not, so one number per opcode is exact
+FETCH_TICKS, FETCH_INSTRUCTIONS = count_routine(0)
+OPCODE_TICKS = {opcode: count_routine(entry) for opcode, entry in OPCODE_MICROCODE.items()}
+HALT = OPCODE_NUMBERS[Opcode.HALT]
+
+
+def repeat_pass_ticks(opcode):
+    """Тики одного прохода строки с MicrocodeAddressControl.REPEAT в микропрограмме опкода"""
+    return next(len(row) for row in microcode[OPCODE_MICROCODE[opcode] :] if MicrocodeAddressControl.REPEAT in row)
+
+
+# Ticks of one more pass of the print_str and read_line burst rows, one pass per character
+STRING_PASS_TICKS = repeat_pass_ticks(Opcode.PRINT_STR)
+LINE_PASS_TICKS = repeat_pass_ticks(Opcode.READ_LINE)
+
+
+class FastEngine(ControlUnit):
+    """Исполняет по одной инструкции ISA за шаг, добавляя тики из таблицы, выведенной из микрокода.
+
+    Вывод, счётчик инструкций и тики совпадают с ControlUnit, потактовый лог не пишется.
+    Опкоды без собственного обработчика исполняются своей микропрограммой.
+    """
+
+    def __init__(self, datapath):
+        super().__init__(datapath)
+        self.compiled_microcode = None
+        handlers = {
+            **{opcode: partial(self.execute_alu, ALU_OPERATIONS[operation.value]) for opcode, operation in ALU_OPCODES.items()},
+            Opcode.DUP: self.execute_dup,
+            Opcode.DROP: self.execute_drop,
+            Opcode.SWAP: self.execute_swap,
+            Opcode.PUSH: self.execute_push,
+            Opcode.ADDR_ON_TOP: self.execute_addr_on_top,
+            Opcode.SAVE_VAR: self.execute_save_var,
+            Opcode.VAR_ON_TOP: self.execute_var_on_top,
+            Opcode.JZS: self.execute_jzs,
+            Opcode.JMP: self.execute_jmp,
+            Opcode.PRINT: self.execute_print,
+            Opcode.READ: self.execute_read,
+            Opcode.EMIT: self.execute_emit,
+            Opcode.LOAD_VAR: self.execute_load_var,
+            Opcode.STORE_VAR: self.execute_store_var,
+            Opcode.CALL: self.execute_call,
+            Opcode.RET: self.execute_ret,
+            Opcode.PRINT_STR: self.execute_print_str,
+            Opcode.READ_NUM: self.execute_read_num,
+            Opcode.READ_LINE: self.execute_read_line,
+            Opcode.DO: self.execute_do,
+            Opcode.LOOP: self.execute_loop,
+            Opcode.UNLOOP: self.execute_unloop,
+            Opcode.LOOP_INDEX: self.execute_loop_index,
+            **{opcode: partial(self.execute_compare_jzs, ALU_OPERATIONS[operation.value]) for opcode, operation in COMPARE_JUMP_OPCODES.items()},
+        }
+        # Handlers and (ticks, instruction counter increments) indexed by opcode number
+        self.opcode_handlers = [handlers.get(opcode) for opcode in Opcode]
+        self.opcode_ticks = [OPCODE_TICKS[opcode] for opcode in Opcode]
+
+    def execute_alu(self, operation, arg):
+        datapath = self.datapath
+        second_operand = datapath.data_stack.pop()
+        datapath.alu.result = datapath.alu.apply_flags(operation(datapath.top_of_stack, second_operand))
+        datapath.top_of_stack = datapath.alu.result
+
+    def execute_dup(self, arg):
+        self.datapath.data_stack.push(self.datapath.top_of_stack)
+
+    def execute_drop(self, arg):
+        self.datapath.data_stack.pop()
+
+    def execute_swap(self, arg):
+        datapath = self.datapath
+        buffer_register = datapath.data_stack.pop()
+        datapath.data_stack.push(datapath.top_of_stack)
+        datapath.top_of_stack = buffer_register
+
+    def execute_push(self, arg):
+        datapath = self.datapath
+        datapath.data_stack.push(datapath.top_of_stack)
+        datapath.top_of_stack = arg
+
+    def execute_addr_on_top(self, arg):
+        datapath = self.datapath
+        datapath.data_stack.push(datapath.top_of_stack)
+        datapath.top_of_stack = arg + datapath.memory.var_memory_start
+
+    def execute_save_var(self, arg):
+        datapath = self.datapath
+        address = datapath.top_of_stack
+        datapath.memory.current_value = datapath.data_stack.pop()
+        datapath.memory.write(address)
+        datapath.top_of_stack = datapath.data_stack.pop()
+
+    def execute_var_on_top(self, arg):
+        datapath = self.datapath
+        datapath.top_of_stack = datapath.memory.data[datapath.top_of_stack]
+
+    def execute_jzs(self, arg):
+        datapath = self.datapath
+        datapath.data_stack.push(datapath.top_of_stack)
+        if datapath.alu.zero_flag == 1:
+            datapath.pc = arg
+        datapath.data_stack.pop()
+        datapath.top_of_stack = datapath.data_stack.pop()
+
+    def execute_jmp(self, arg):
+        datapath = self.datapath
+        datapath.data_stack.push(datapath.top_of_stack)
+        datapath.pc = arg
+        datapath.top_of_stack = datapath.data_stack.pop()
+
+    def execute_load_var(self, arg):
+        datapath = self.datapath
+        datapath.data_stack.push(datapath.top_of_stack)
+        datapath.top_of_stack = datapath.memory.data[arg + datapath.memory.var_memory_start]
+
+    def execute_store_var(self, arg):
+        datapath = self.datapath
+        datapath.memory.current_value = datapath.top_of_stack
+        datapath.memory.write(arg + datapath.memory.var_memory_start)
+        datapath.top_of_stack = datapath.data_stack.pop()
+
+    def execute_compare_jzs(self, operation, arg):
+        datapath = self.datapath
+        second_operand = datapath.data_stack.pop()
+        datapath.alu.result = datapath.alu.apply_flags(operation(datapath.top_of_stack, second_operand))
+        if datapath.alu.zero_flag == 1:
+            datapath.pc = arg
+        datapath.top_of_stack = datapath.data_stack.pop()
+
+    def execute_call(self, arg):
+        datapath = self.datapath
+        datapath.return_stack.push(datapath.pc)
+        datapath.pc = arg
+
+    def execute_ret(self, arg):
+        address = self.datapath.return_stack.pop()
+        if address is None:
+            raise ReturnStackUnderflowError
+        self.datapath.pc = address
+
+    def execute_print(self, arg):
+        self.datapath.control_io(IOOperation.PRINT)
+        self.datapath.top_of_stack = self.datapath.data_stack.pop()
+
+    def execute_read(self, arg):
+        self.datapath.data_stack.push(self.datapath.top_of_stack)
+        self.datapath.control_io(IOOperation.READ)
+
+    def execute_emit(self, arg):
+        self.datapath.control_io(IOOperation.EMIT)
+        self.datapath.top_of_stack = self.datapath.data_stack.pop()
+
+    def execute_print_str(self, arg):
+        datapath = self.datapath
+        data = datapath.memory.data
+        address = arg + datapath.memory.var_memory_start
+        length = data[address]
+        datapath.output_device.write("".join(chr(data[address + offset]) for offset in range(1, length + 1)))
+        self.tick += STRING_PASS_TICKS * max(length - 1, 0)
+
+    def execute_read_num(self, arg):
+        self.datapath.data_stack.push(self.datapath.top_of_stack)
+        self.datapath.control_io(IOOperation.READ_NUMBER)
+
+    def execute_read_line(self, arg):
+        datapath = self.datapath
+        datapath.address_register = datapath.top_of_stack
+        datapath.write_to_buffer_register()
+        datapath.top_of_stack = 0
+        datapath.counter_register = datapath.buffer_register
+        datapath.control_io(IOOperation.READ_LINE)
+        passes = 1
+        while datapath.counter_register > 0:
+            datapath.control_io(IOOperation.READ_LINE)
+            passes += 1
+        self.tick += LINE_PASS_TICKS * (passes - 1)
+
+    def execute_do(self, arg):
+        datapath = self.datapath
+        datapath.control_loop(LoopControl.PUSH_LIMIT)
+        datapath.control_loop(LoopControl.PUSH_INDEX)
+        datapath.loop_index = datapath.top_of_stack
+        datapath.loop_limit = datapath.data_stack.pop()
+        datapath.top_of_stack = datapath.data_stack.pop()
+
+    def execute_loop(self, arg):
+        datapath = self.datapath
+        datapath.loop_index += 1
+        if datapath.loop_index < datapath.loop_limit:
+            datapath.pc = arg
+
+    def execute_unloop(self, arg):
+        self.datapath.control_loop(LoopControl.POP_INDEX)
+        self.datapath.control_loop(LoopControl.POP_LIMIT)
+
+    def execute_loop_index(self, arg):
+        datapath = self.datapath
+        datapath.data_stack.push(datapath.top_of_stack)
+        datapath.top_of_stack = datapath.loop_index
+
+    def execute_microcode_routine(self, opcode_number):
+        if self.compiled_microcode is None:
+            self.compiled_microcode = compile_microcode(self)
+        self.mc_adr = MICROCODE_ENTRY[opcode_number]
+        while self.mc_adr != 0 and self.instraction_count < self.instruction_limit:
+            self.compiled_microcode[self.mc_adr]()
+
+    def fetch(self):
+        datapath = self.datapath
+        pc = datapath.pc
+        opcode_number = datapath.memory.opcodes[pc]
+        if opcode_number >= len(self.opcode_handlers):
+            raise DataExecutionError(pc)
+        datapath.instruction_opcode = opcode_number
+        datapath.instruction_arg = datapath.memory.args[pc]
+        return opcode_number
+
+    def step(self):
+        opcode_number = self.fetch()
+        self.instraction_count += FETCH_INSTRUCTIONS
+        self.tick += FETCH_TICKS
+        if self.instraction_count >= self.instruction_limit:
+            return
+        if opcode_number == HALT:
+            ticks, instructions = self.opcode_ticks[opcode_number]
+            self.instraction_count += instructions
+            self.tick += ticks
+            raise StopIteration
+        handler = self.opcode_handlers[opcode_number]
+        if handler is None:
+            self.execute_microcode_routine(opcode_number)
+            return
+        handler(self.datapath.instruction_arg)
+        ticks, instructions = self.opcode_ticks[opcode_number]
+        self.datapath.pc += 1
+        self.instraction_count += instructions
+        self.tick += ticks
+
+    def execute_program(self):
+        limit = self.instruction_limit
+        while self.instraction_count < limit:
+            self.step()
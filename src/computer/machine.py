@@ -1,43 +1,110 @@
+import contextlib
 import logging
 import sys
 sys.path.append('.')
 
-from computer import control_unit, memory
+from computer import block_compiler, control_unit, fast_engine, memory, microcode_rom, profiler, trace_file, tracing
 from exceptions import WrongMachineArgumentsError
-from language.instruction import load_instructions_from_file
+from language.image import MachineImage, is_image_file, load_image
+from language.instruction import find_start_of_variables, load_instructions_from_file
 
+ENGINES = {
+    "microcode": control_unit.ControlUnit,
+    "compiled": control_unit.CompiledControlUnit,
+    "rom": microcode_rom.RomControlUnit,
+    "fast": fast_engine.FastEngine,
+    "block": block_compiler.BlockEngine,
+}
 
-def main(code_file, input_file):
-    code = load_instructions_from_file(code_file)
-    with open(input_file, encoding="utf-8") as file:
-        inputs = file.read().strip()
-        input_token = []
-        for char in inputs:
-            input_token.append(char)
-    for line_number, line in enumerate(code, 0):
-        if line["opcode"] == "halt":
-            start_of_variables = line_number + 1
-            break
-    data_path = memory.DataPath(code, input_token, start_of_variables)
-    control = control_unit.ControlUnit(data_path)
-    output, inst_count, tick_count = control.run_machine()
 
-    print(f"{''.join(output)}\n\ninstraction count -> {inst_count!s}\ntick -> {tick_count!s}")
+def parse_arguments(argv):
+    positional = []
+    options = {}
+    for argument in argv:
+        if argument.startswith("--"):
+            key, _, value = argument[2:].partition("=")
+            options[key] = value
+        else:
+            positional.append(argument)
+    return positional, options
+
+
+def start_of_variables(code):
+    """Адрес начала переменных: из заголовка образа или по первому halt в списке инструкций"""
+    if isinstance(code, MachineImage):
+        return code.start_of_variables
+    return find_start_of_variables(code)
+
+
+def load_program(code_file):
+    code = load_image(code_file) if is_image_file(code_file) else load_instructions_from_file(code_file)
+    return code, start_of_variables(code)
+
+
+INPUT_MODES = {"buffered": False, "mmap": True}
+PROFILE_OPTIONS = {"profile", "profile-stacks", "profile-source", "profile-top"}
+
+
+def write_profile(program_profile, report_file, stacks_file, top):
+    if report_file:
+        with open(report_file, "w", encoding="utf-8") as file:
+            file.write(program_profile.report(top) + "\n")
+    if stacks_file:
+        with open(stacks_file, "w", encoding="utf-8") as file:
+            file.writelines(line + "\n" for line in program_profile.collapsed())
+
+
+def main(code_file, input_file, engine="microcode", input_mode="buffered", tracer=None, program_profile=None):
+    code, start_of_variables = load_program(code_file)
+    tracer = tracing.Tracer() if tracer is None else tracer
+    with (
+        contextlib.closing(tracer),
+        memory.open_input_device(input_file, INPUT_MODES[input_mode]) as input_device,
+        memory.OutputDevice(sys.stdout, tee_log=tracer.level is not tracing.TraceLevel.OFF) as output_device,
+    ):
+        data_path = memory.DataPath(code, input_device, start_of_variables, output_device)
+        control = ENGINES[engine](data_path)
+        control.tracer = tracer
+        control.profiler = program_profile
+        output, inst_count, tick_count = control.run_machine()
+
+    print(f"{output}\n\ninstraction count -> {inst_count!s}\ntick -> {tick_count!s}")
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
+    arguments, options = parse_arguments(sys.argv[1:])
+    if len(arguments) != 3 or not set(options) <= PROFILE_OPTIONS | {"engine", "input", "trace", "trace-history", "trace-file", "trace-compression"}:
         raise WrongMachineArgumentsError
-    _, code_input, input_file_name, log_name = sys.argv
-    logging.getLogger().setLevel(logging.DEBUG)
+    engine_name = options.get("engine", "microcode")
+    input_mode = options.get("input", "buffered")
+    trace_level = options.get("trace", "off")
+    trace_history = options.get("trace-history", "0")
+    if engine_name not in ENGINES or input_mode not in INPUT_MODES or trace_level not in tracing.TRACE_LEVELS:
+        raise WrongMachineArgumentsError
+    trace_compression = options.get("trace-compression", "none")
+    profile_top = options.get("profile-top", str(profiler.DEFAULT_TOP))
+    if not trace_history.isdigit() or trace_compression not in trace_file.COMPRESSIONS or not profile_top.isdigit():
+        raise WrongMachineArgumentsError
+    code_input, input_file_name, log_name = arguments
+    writer = trace_file.TraceWriter(options["trace-file"], trace_compression) if "trace-file" in options else None
+    tracer = tracing.Tracer(tracing.TRACE_LEVELS[trace_level], int(trace_history), writer)
 
     formatter = logging.Formatter("[%(levelname)s]  %(message)s")
     logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(logging.INFO if tracer.level is tracing.TraceLevel.OFF else logging.DEBUG)
 
     file_handler = logging.FileHandler(log_name, mode="w", encoding="utf-8")
     file_handler.setFormatter(formatter)
-    file_handler.setLevel(logging.DEBUG)
     logger.addHandler(file_handler)
 
-    main(code_input, input_file_name)
+    program_profile = None
+    if options.keys() & PROFILE_OPTIONS:
+        source = None
+        if options.get("profile-source"):
+            with open(options["profile-source"], encoding="utf-8") as source_file:
+                source = source_file.read()
+        program_profile = profiler.Profiler(load_program(code_input)[0], source)
+
+    main(code_input, input_file_name, engine_name, input_mode, tracer, program_profile)
+    if program_profile is not None:
+        write_profile(program_profile, options.get("profile"), options.get("profile-stacks"), int(profile_top))
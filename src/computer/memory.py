@@ -1,11 +1,25 @@
+import codecs
+import io
 import logging
+import mmap
+import os
+import stat
+import sys
+from array import array
+
 from computer.alu import ALU
-from computer.controls import JumpOperation, AluOperation, AddressRegisterControl, DataStackControl, IOOperation, MemoryControl, InstractionPointerControl, TopOfStackControl
-from exceptions import StackOverflowError
+from computer.controls import JumpOperation, AluOperation, AddressRegisterControl, CounterControl, DataStackControl, IOOperation, LoopControl, MemoryControl, InstractionPointerControl, ReturnStackControl, TopOfStackControl
+from exceptions import InvalidArgumentError, ReturnStackUnderflowError, StackOverflowError
+from language.image import MachineImage
+from language.instruction import DATA_OPCODE, OPCODE_NUMBERS, Opcode
 
 STACK_SIZE = 64
+RETURN_STACK_SIZE = 64
 VAR_MEMORY_SIZE = 150
 INSTRUCTION_LIMIT = 100000
+INPUT_CHUNK_SIZE = 64 * 1024
+NEWLINE = ord("\n")
+OUTPUT_BUFFER_SIZE = 8 * 1024
 
 class Stack:
     stack = None
@@ -28,33 +42,244 @@ class Stack:
         self.stack.pop()
         return value
 
+class ChunkStream:
+    """Поток байтов поверх итерируемого набора строк, строки кодируются по одной при чтении"""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+
+    def read(self, size=-1):
+        for chunk in self.chunks:
+            if chunk:
+                return chunk.encode("utf-8")
+        return b""
+
+    def close(self):
+        pass
+
+
+class InputDevice:
+    """Потоковый посимвольный ввод: байты читаются порциями по мере срабатывания IOOperation.READ.
+
+    При strip=True ведущие и хвостовые пробельные символы пропускаются, как у str.strip() по всему вводу.
+    """
+
+    def __init__(self, stream, strip=False, chunk_size=INPUT_CHUNK_SIZE, close_stream=True):
+        self.stream = stream
+        self.strip = strip
+        self.chunk_size = chunk_size
+        self.close_stream = close_stream
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.chunk = ""
+        self.position = 0
+        self.end_of_stream = False
+        self.started = False
+        # Whitespace run read ahead to find out whether it is trailing
+        self.pending = ""
+        self.pending_position = 0
+
+    @classmethod
+    def from_text(cls, text):
+        return cls(io.BytesIO("".join(text).encode("utf-8")))
+
+    @classmethod
+    def from_chunks(cls, chunks, strip=False):
+        """Ввод из строки или итерируемого набора строк, набор читается по мере срабатывания IOOperation.READ"""
+        if isinstance(chunks, str):
+            return cls(io.BytesIO(chunks.encode("utf-8")), strip)
+        return cls(ChunkStream(chunks), strip)
+
+    def next_char(self):
+        while self.position >= len(self.chunk):
+            if self.end_of_stream:
+                return None
+            data = self.stream.read(self.chunk_size)
+            if not data:
+                self.end_of_stream = True
+            self.chunk = self.decoder.decode(data, final=not data)
+            self.position = 0
+        char = self.chunk[self.position]
+        self.position += 1
+        return char
+
+    def read_char(self):
+        """Код следующего символа или None, если ввод закончился"""
+        if self.pending_position < len(self.pending):
+            char = self.pending[self.pending_position]
+            self.pending_position += 1
+            return ord(char)
+        char = self.next_char()
+        if self.strip and char is not None and char.isspace():
+            run = []
+            while char is not None and char.isspace():
+                run.append(char)
+                char = self.next_char()
+            if char is None:
+                return None
+            if self.started:
+                run.append(char)
+                self.pending = "".join(run)
+                self.pending_position = 1
+                char = run[0]
+        if char is None:
+            return None
+        self.started = True
+        return ord(char)
+
+    def read_number(self):
+        """Десятичное число со знаком после пробельных символов или None, если цифр нет.
+
+        Символ, на котором число закончилось, тоже считывается: заглядывать вперёд потоковый ввод не умеет.
+        """
+        char = self.read_char()
+        while char is not None and chr(char).isspace():
+            char = self.read_char()
+        sign = 1
+        if char in {ord("-"), ord("+")}:
+            sign = -1 if char == ord("-") else 1
+            char = self.read_char()
+        value = None
+        while char is not None and ord("0") <= char <= ord("9"):
+            value = (value or 0) * 10 + char - ord("0")
+            char = self.read_char()
+        return None if value is None else sign * value
+
+    def close(self):
+        if self.close_stream:
+            self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_input_device(source, use_mmap=False, strip=True):
+    """Открывает ввод машины: "-" — stdin, иначе файл или канал; обычный файл можно отобразить через mmap"""
+    if source == "-":
+        return InputDevice(sys.stdin.buffer, strip, close_stream=False)
+    file = open(source, "rb")
+    info = os.fstat(file.fileno())
+    if use_mmap and stat.S_ISREG(info.st_mode) and info.st_size > 0:
+        with file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return InputDevice(mapped, strip)
+    return InputDevice(file, strip)
+
+
+class OutputDevice:
+    """Потоковый вывод через ограниченный буфер в sink (любой объект с write), с необязательной копией в лог.
+
+    Весь вывод хранится в памяти только при capture=True.
+    """
+
+    def __init__(self, sink=None, capture=False, tee_log=False, buffer_size=OUTPUT_BUFFER_SIZE):
+        self.sink = sink
+        self.capture = capture
+        self.tee_log = tee_log
+        self.buffer_size = buffer_size
+        self.pending = []
+        self.pending_size = 0
+        self.captured = []
+
+    def write(self, text):
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.tee_log:
+            logging.debug("Output << %s", text)
+        if self.pending_size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        text = "".join(self.pending)
+        self.pending.clear()
+        self.pending_size = 0
+        if self.sink is not None:
+            self.sink.write(text)
+        if self.capture:
+            self.captured.append(text)
+
+    def getvalue(self):
+        """Захваченный вывод, пустая строка без capture"""
+        self.flush()
+        if len(self.captured) > 1:
+            self.captured[:] = ["".join(self.captured)]
+        return self.captured[0] if self.captured else ""
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def decode_instructions(code):
+    """Раскладывает инструкции в параллельные массивы опкодов и аргументов, проверяя аргументы один раз"""
+    opcodes = array("B")
+    args = array("q")
+    for index, instruction in enumerate(code):
+        opcodes.append(OPCODE_NUMBERS[Opcode(instruction["opcode"])] if "opcode" in instruction else DATA_OPCODE)
+        try:
+            args.append(int(instruction.get("arg", 0)))
+        except (TypeError, ValueError, OverflowError):
+            raise InvalidArgumentError(index, instruction["arg"]) from None
+    return opcodes, args
+
+
 class Memory:
+    """Память в виде параллельных массивов: номер опкода, аргумент инструкции и слово данных каждой ячейки.
+
+    Для ячеек кода слово данных совпадает с аргументом, запись в ячейку кода превращает её в ячейку данных.
+    """
+
     def __init__(self, code, var_memory_start):
         self.var_memory_start = var_memory_start
-        self.memory = [0] * (len(code) + 1)
+        if isinstance(code, MachineImage):
+            opcodes, args = code.opcodes(), code.args()
+        else:
+            opcodes, args = decode_instructions(code)
+        self.opcodes = array("B", [DATA_OPCODE]) + opcodes
+        self.args = array("q", [var_memory_start]) + args
+        # Data words are unbounded Python ints, as the ALU results written back to memory
+        self.data = list(self.args)
         self.current_value = 0
-        self.memory[0] = var_memory_start
-        for index, instruction in enumerate(code, 1):
-            self.memory[index] = instruction
 
     def read(self, address):
-        self.current_value = self.memory[address]
+        self.current_value = self.data[address]
 
     def write(self, address):
-        self.memory[address] = self.current_value
+        self.data[address] = int(self.current_value)
+        if self.opcodes[address] != DATA_OPCODE:
+            self.opcodes[address] = DATA_OPCODE
 
 class DataPath:
-    def __init__(self, code, input_buffer, var_memory_start):
+    def __init__(self, code, input_buffer, var_memory_start, output_device=None):
         self.data_stack = Stack(STACK_SIZE)
+        # Addresses of the call instructions waiting for their ret
+        self.return_stack = Stack(RETURN_STACK_SIZE)
         self.alu = ALU()
-        self.instruction_register = {}
+        self.instruction_opcode = DATA_OPCODE
+        self.instruction_arg = 0
         self.buffer_register = 0
+        # Characters of the string left to print or of the line left to read
+        self.counter_register = 0
+        # Index and limit of the innermost do ... loop
+        self.loop_index = 0
+        self.loop_limit = 0
         self.memory = Memory(code, var_memory_start)
         self.address_register = None
         self.pc = 1
         self.top_of_stack = None
-        self.input_buffer = input_buffer
-        self.output_buffer = []
+        if not isinstance(input_buffer, InputDevice):
+            input_buffer = InputDevice.from_text(input_buffer)
+        self.input_device = input_buffer
+        self.output_device = OutputDevice(capture=True) if output_device is None else output_device
 
     def push_to_stack(self):
         self.data_stack.push(self.top_of_stack)
@@ -66,10 +291,8 @@ class DataPath:
         self.buffer_register = self.pop_from_stack()
 
     def load_memory_to_instruction_register(self):
-        if isinstance(self.memory.current_value, int):
-            self.instruction_register = {"arg": self.memory.current_value}
-        else:
-            self.instruction_register = self.memory.current_value
+        self.instruction_opcode = self.memory.opcodes[self.address_register]
+        self.instruction_arg = self.memory.current_value
 
     def control_top_of_stack(self, signal):
         match signal:
@@ -78,16 +301,20 @@ class DataPath:
             case TopOfStackControl.BR:
                 self.top_of_stack = self.buffer_register
             case TopOfStackControl.MEM:
-                self.top_of_stack = self.memory.memory[self.address_register]
+                self.top_of_stack = self.memory.data[self.address_register]
             case TopOfStackControl.IR:
-                self.top_of_stack = int(self.instruction_register["arg"])
+                self.top_of_stack = self.instruction_arg
             case TopOfStackControl.IR_VAR:
-                self.top_of_stack = int(self.instruction_register["arg"]) + self.memory.var_memory_start
+                self.top_of_stack = self.instruction_arg + self.memory.var_memory_start
+            case TopOfStackControl.ZERO:
+                self.top_of_stack = 0
+            case TopOfStackControl.INDEX:
+                self.top_of_stack = self.loop_index
 
     def control_instruction_pointer(self, signal):
         match signal:
             case InstractionPointerControl.IR:
-                self.pc = self.instruction_register["arg"]
+                self.pc = self.instruction_arg
             case InstractionPointerControl.INC:
                 self.pc += 1
 
@@ -104,6 +331,8 @@ class DataPath:
                 self.address_register = self.pc
             case AddressRegisterControl.TOS:
                 self.address_register = self.top_of_stack
+            case AddressRegisterControl.IR_VAR:
+                self.address_register = self.instruction_arg + self.memory.var_memory_start
 
     def control_data_stack(self, signal):
         match signal:
@@ -112,6 +341,16 @@ class DataPath:
             case DataStackControl.Pop:
                 self.pop_from_stack()
 
+    def control_return_stack(self, signal):
+        match signal:
+            case ReturnStackControl.PUSH:
+                self.return_stack.push(self.pc)
+            case ReturnStackControl.POP:
+                address = self.return_stack.pop()
+                if address is None:
+                    raise ReturnStackUnderflowError
+                self.pc = address
+
     def control_memory(self, signal):
         match signal:
             case MemoryControl.READ:
@@ -124,18 +363,71 @@ class DataPath:
     def control_io(self, signal):
         match signal:
             case IOOperation.PRINT:
-                self.output_buffer.append(" " + str(self.top_of_stack))
-                logging.debug(f"Output: {''.join(self.output_buffer)} << {str(self.top_of_stack)}")
+                self.output_device.write(" " + str(self.top_of_stack))
             case IOOperation.READ:
-                if not self.input_buffer:
+                char = self.input_device.read_char()
+                if char is None:
                     logging.warning("No input from user!")
                     self.top_of_stack = 0
                 else:
-                    self.top_of_stack = ord(self.input_buffer.pop(0))
-                    logging.debug(f"Input: {chr(self.top_of_stack)}")
+                    self.top_of_stack = char
+                    logging.debug("Input: %s", chr(self.top_of_stack))
             case IOOperation.EMIT:
-                self.output_buffer.append(chr(self.top_of_stack))
-                logging.debug(f"Output: {''.join(self.output_buffer)} << {chr(self.top_of_stack)}")
+                self.output_device.write(chr(self.top_of_stack))
+            case IOOperation.EMIT_STRING:
+                if self.counter_register > 0:
+                    self.address_register += 1
+                    self.memory.read(self.address_register)
+                    self.output_device.write(chr(self.memory.current_value))
+                    self.counter_register -= 1
+            case IOOperation.READ_NUMBER:
+                number = self.input_device.read_number()
+                if number is None:
+                    logging.warning("No number in input!")
+                    self.top_of_stack = 0
+                else:
+                    self.top_of_stack = number
+                    logging.debug("Input: %d", number)
+            case IOOperation.READ_LINE:
+                # AR walks the buffer, TOS counts the stored characters, the newline ends the line and is not stored
+                if self.counter_register > 0:
+                    char = self.input_device.read_char()
+                    if char is None or char == NEWLINE:
+                        self.counter_register = 0
+                    else:
+                        self.memory.current_value = char
+                        self.memory.write(self.address_register)
+                        self.address_register += 1
+                        self.top_of_stack += 1
+                        self.counter_register -= 1
+
+    def control_counter(self, signal):
+        match signal:
+            case CounterControl.LOAD:
+                self.counter_register = self.memory.current_value
+            case CounterControl.BR:
+                self.counter_register = self.buffer_register
+
+    def control_loop(self, signal):
+        match signal:
+            case LoopControl.PUSH_LIMIT:
+                self.return_stack.push(self.loop_limit)
+            case LoopControl.PUSH_INDEX:
+                self.return_stack.push(self.loop_index)
+            case LoopControl.POP_INDEX | LoopControl.POP_LIMIT:
+                value = self.return_stack.pop()
+                if value is None:
+                    raise ReturnStackUnderflowError
+                if signal is LoopControl.POP_INDEX:
+                    self.loop_index = value
+                else:
+                    self.loop_limit = value
+            case LoopControl.INDEX_TOS:
+                self.loop_index = self.top_of_stack
+            case LoopControl.LIMIT_BR:
+                self.loop_limit = self.buffer_register
+            case LoopControl.INC:
+                self.loop_index += 1
 
     def handle_jump(self, signal):
         match signal:
@@ -143,4 +435,7 @@ class DataPath:
                 if self.alu.zero_flag == 1:
                     self.pc = self.top_of_stack
             case JumpOperation.JMP:
-                self.pc = self.top_of_stack
\ No newline at end of file
+                self.pc = self.top_of_stack
+            case JumpOperation.LOOP:
+                if self.loop_index < self.loop_limit:
+                    self.pc = self.instruction_arg
\ No newline at end of file
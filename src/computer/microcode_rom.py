@@ -0,0 +1,192 @@
+import sys
+from array import array
+from functools import partial
+
+sys.path.append(".")
+
+from computer.control_unit import OPCODE_MICROCODE, ControlUnit, microcode
+from computer.controls import (
+    JumpOperation,
+    ProgramControl,
+    AluOperation,
+    ALUValuesControl,
+    AddressRegisterControl,
+    BufferRegisterControl,
+    CounterControl,
+    DataStackControl,
+    InstructionControl,
+    IOOperation,
+    InstructionRegisterControl,
+    LoopControl,
+    MicrocodeAddressControl,
+    MemoryControl,
+    InstractionPointerControl,
+    ReturnStackControl,
+    TopOfStackControl,
+)
+from exceptions import DataExecutionError, InvalidSignalError, MicrocodeOrderError
+from language.instruction import OPCODE_NUMBERS, Opcode
+
+# Signal groups in the order their fields fire inside one microinstruction.
+SIGNAL_GROUPS = [
+    AddressRegisterControl,
+    DataStackControl,
+    BufferRegisterControl,
+    ALUValuesControl,
+    AluOperation,
+    InstructionRegisterControl,
+    TopOfStackControl,
+    MemoryControl,
+    JumpOperation,
+    IOOperation,
+    InstractionPointerControl,
+    InstructionControl,
+    MicrocodeAddressControl,
+    ProgramControl,
+    # Appended last so signal ids of the binary trace keep their values, no microinstruction mixes it with IP signals
+    ReturnStackControl,
+    # Loads the counter from the memory read of the same microinstruction, so it fires after MemoryControl
+    CounterControl,
+    # Loop registers are read and written after the stack, BR and jump fields of the same microinstruction
+    LoopControl,
+]
+
+
+def build_fields(groups):
+    """Раскладывает группы сигналов по битовым полям: (группа, сдвиг, маска), код 0 - нет сигнала"""
+    fields = []
+    shift = 0
+    for group in groups:
+        width = len(group).bit_length()
+        fields.append((group, shift, (1 << width) - 1))
+        shift += width
+    return fields
+
+
+FIELDS = build_fields(SIGNAL_GROUPS)
+FIELD_BY_GROUP = {group: (shift, mask) for group, shift, mask in FIELDS}
+# Per-field decode tables: code -> signal
+DECODE_TABLES = [[None, *group] for group in SIGNAL_GROUPS]
+
+
+def encode_signal(signal):
+    shift, _ = FIELD_BY_GROUP[type(signal)]
+    return (list(type(signal)).index(signal) + 1) << shift
+
+
+def encode_microinstruction(signals):
+    word = 0
+    for signal in signals:
+        if type(signal) not in FIELD_BY_GROUP:
+            raise InvalidSignalError(signal)
+        shift, mask = FIELD_BY_GROUP[type(signal)]
+        if (word >> shift) & mask:
+            raise InvalidSignalError(signal)
+        word |= encode_signal(signal)
+    return word
+
+
+def decode_microinstruction(word):
+    signals = []
+    for (_, shift, mask), table in zip(FIELDS, DECODE_TABLES):
+        code = (word >> shift) & mask
+        if code:
+            signals.append(table[code])
+    return signals
+
+
+def compile_rom(rows):
+    """Упаковывает строки микрокода; порядок сигналов строки должен совпадать с порядком полей ПЗУ"""
+    rom = array("Q")
+    for address, signals in enumerate(rows):
+        word = encode_microinstruction(signals)
+        # The ROM fires fields in group order, a row listed otherwise would run differently on the microcode engine
+        if decode_microinstruction(word) != list(signals):
+            raise MicrocodeOrderError(address)
+        rom.append(word)
+    return rom
+
+
+def compile_opcode_table(opcode_microcode):
+    table = array("H", [0] * len(OPCODE_NUMBERS))
+    for opcode, address in opcode_microcode.items():
+        table[OPCODE_NUMBERS[opcode]] = address
+    return table
+
+
+MICROCODE_ROM = compile_rom(microcode)
+OPCODE_ENTRY = compile_opcode_table(OPCODE_MICROCODE)
+
+
+def dump_rom(rom=MICROCODE_ROM, opcode_entry=OPCODE_ENTRY):
+    lines = [f"; fields: {', '.join(f'{group.__name__}[{shift}:{shift + mask.bit_length()}]' for group, shift, mask in FIELDS)}"]
+    for address, word in enumerate(rom):
+        signals = " ".join(f"{type(signal).__name__}.{signal.name}" for signal in decode_microinstruction(word))
+        lines.append(f"{address:3}: {word:016x}  {signals}")
+    lines.append("; opcode entry table")
+    for number, opcode in enumerate(Opcode):
+        lines.append(f"{number:3}: {opcode_entry[number]:3}  {opcode.value}")
+    return "\n".join(lines)
+
+
+def stop_program():
+    raise StopIteration
+
+
+class RomControlUnit(ControlUnit):
+    """Исполняет микрокод из упакованного ПЗУ, декодируя поля управляющего слова через таблицы"""
+
+    def __init__(self, datapath):
+        super().__init__(datapath)
+        self.rom = MICROCODE_ROM
+        self.opcode_entry = OPCODE_ENTRY
+        special = {
+            MicrocodeAddressControl.IR: self.decode_opcode,
+            MicrocodeAddressControl.INC: self.next_microinstruction,
+            MicrocodeAddressControl.ZERO: self.reset_microcode_address,
+            MicrocodeAddressControl.REPEAT: self.repeat_microinstruction,
+            InstructionControl.INC: self.inc_instraction_count,
+            ProgramControl.HALT: stop_program,
+        }
+        self.field_handlers = []
+        for group, shift, mask in FIELDS:
+            handlers = [None]
+            for signal in group:
+                if signal in special:
+                    handlers.append(special[signal])
+                    continue
+                handler, arity = self.signal_handlers[group]
+                handlers.append(partial(handler, signal) if arity == 2 else handler)
+            self.field_handlers.append((shift, mask, handlers))
+
+    def decode_opcode(self):
+        opcode_number = self.datapath.instruction_opcode
+        if opcode_number >= len(self.opcode_entry):
+            raise DataExecutionError(self.datapath.address_register)
+        self.mc_adr = self.opcode_entry[opcode_number]
+
+    def next_microinstruction(self):
+        self.mc_adr += 1
+
+    def reset_microcode_address(self):
+        self.mc_adr = 0
+
+    def repeat_microinstruction(self):
+        if self.datapath.counter_register <= 0:
+            self.mc_adr += 1
+
+    def execute_program(self):
+        rom = self.rom
+        field_handlers = self.field_handlers
+        limit = self.instruction_limit
+        while self.instraction_count < limit:
+            word = rom[self.mc_adr]
+            for shift, mask, handlers in field_handlers:
+                code = (word >> shift) & mask
+                if code:
+                    handlers[code]()
+                    self.tick += 1
+
+
+if __name__ == "__main__":
+    print(dump_rom())
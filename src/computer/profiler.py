@@ -0,0 +1,159 @@
+from collections import defaultdict
+
+from language.image import MachineImage
+from language.instruction import OPCODES, Instruction, Opcode
+from language.parser import TokenKind, tokenize
+
+MAIN_FRAME = "main"
+DEFAULT_TOP = 10
+
+
+def debug_terms(code):
+    """Отображение индекс инструкции -> Instruction(номер строки, номер слова, символ)"""
+    if isinstance(code, MachineImage):
+        return code.debug_info()
+    return {index: Instruction(*instruction["term"]) for index, instruction in enumerate(code) if "term" in instruction}
+
+
+def opcode_names(code):
+    if isinstance(code, MachineImage):
+        return [OPCODES[number].value if number < len(OPCODES) else "data" for number in code.opcodes()]
+    return [Opcode(instruction["opcode"]).value if "opcode" in instruction else "data" for instruction in code]
+
+
+def procedure_lines(source):
+    """Отображение номер строки -> имя процедуры, в определении которой лежит строка"""
+    lines = {}
+    start = name = None
+    waiting_for_name = False
+    for token in tokenize(source):
+        if waiting_for_name:
+            name = token.text
+            waiting_for_name = False
+        elif token.kind is TokenKind.PROCEDURE_START:
+            start = token.line_number
+            waiting_for_name = True
+        elif token.kind is TokenKind.PROCEDURE_END and name is not None:
+            for line_number in range(start, token.line_number + 1):
+                lines[line_number] = name
+            name = None
+    return lines
+
+
+def source_line_numbers(terms, size):
+    """Номер строки исходника каждой инструкции: переходы ветвлений и циклов без term относятся к строке предыдущей"""
+    lines = []
+    line_number = None
+    for index in range(size):
+        term = terms.get(index)
+        if term is not None:
+            line_number = term.line_number
+        lines.append(line_number)
+    return lines
+
+
+class Profiler:
+    """Профиль исполнения: число исполнений и тики по адресу инструкции и стеку вызовов процедур.
+
+    ControlUnit вызывает record после каждой инструкции. Отчёты по строкам исходника, опкодам и процедурам
+    строятся из накопленных данных только по запросу. Без исходника процедуры видны только по call,
+    с исходником к ним относятся и подставленные на место вызова тела.
+    """
+
+    def __init__(self, code, source=None):
+        self.terms = debug_terms(code)
+        self.opcode_names = opcode_names(code)
+        self.lines = source_line_numbers(self.terms, len(self.opcode_names))
+        self.source_lines = source.splitlines() if source is not None else None
+        self.procedures = procedure_lines(source) if source is not None else {}
+        self.stack = (MAIN_FRAME,)
+        # (call stack, instruction index) -> [executions, ticks]
+        self.samples = defaultdict(lambda: [0, 0])
+
+    def record(self, address, ticks):
+        index = address - 1
+        sample = self.samples[self.stack, index]
+        sample[0] += 1
+        sample[1] += ticks
+        opcode = self.opcode_names[index] if 0 <= index < len(self.opcode_names) else "data"
+        if opcode == Opcode.CALL.value:
+            term = self.terms.get(index)
+            self.stack += (term.symbol if term is not None else f"call@{index}",)
+        elif opcode == Opcode.RET.value and len(self.stack) > 1:
+            self.stack = self.stack[:-1]
+
+    def line_of(self, index):
+        return self.lines[index] if 0 <= index < len(self.lines) else None
+
+    def frames(self, stack, index):
+        """Стек вызовов инструкции вместе с подставленной процедурой, в теле которой она лежит"""
+        procedure = self.procedures.get(self.line_of(index))
+        if procedure is not None and procedure != stack[-1]:
+            return (*stack, procedure)
+        return stack
+
+    def totals(self):
+        return sum(count for count, _ in self.samples.values()), sum(ticks for _, ticks in self.samples.values())
+
+    def by_key(self, key):
+        result = defaultdict(lambda: [0, 0])
+        for (_, index), (count, ticks) in self.samples.items():
+            entry = result[key(index)]
+            entry[0] += count
+            entry[1] += ticks
+        return dict(result)
+
+    def by_address(self):
+        """Индекс инструкции -> [исполнения, тики]"""
+        return self.by_key(lambda index: index)
+
+    def by_opcode(self):
+        return self.by_key(lambda index: self.opcode_names[index] if 0 <= index < len(self.opcode_names) else "data")
+
+    def by_line(self):
+        """Номер строки исходника (None для инструкций до первой с term) -> [исполнения, тики]"""
+        return self.by_key(self.line_of)
+
+    def by_procedure(self):
+        """Процедура -> [исполнения, собственные тики, тики вместе с вызванными процедурами]"""
+        result = defaultdict(lambda: [0, 0, 0])
+        for (stack, index), (count, ticks) in self.samples.items():
+            frames = self.frames(stack, index)
+            result[frames[-1]][0] += count
+            result[frames[-1]][1] += ticks
+            for frame in set(frames):
+                result[frame][2] += ticks
+        return dict(result)
+
+    def collapsed(self):
+        """Строки "main;proc;line N тики" в формате collapsed stacks для flamegraph.pl и speedscope"""
+        result = defaultdict(int)
+        for (stack, index), (_, ticks) in self.samples.items():
+            line = self.line_of(index)
+            leaf = f"line {line}" if line is not None else f"address {index + 1}"
+            result[";".join((*self.frames(stack, index), leaf))] += ticks
+        return [f"{stack} {ticks}" for stack, ticks in sorted(result.items())]
+
+    def line_text(self, line_number):
+        if line_number is None:
+            return ""
+        if self.source_lines is not None and 0 < line_number <= len(self.source_lines):
+            return self.source_lines[line_number - 1].strip()
+        words = sorted({term.word_number: term.symbol for term in self.terms.values() if term.line_number == line_number}.items())
+        return " ".join(str(symbol) for _, symbol in words)
+
+    def report(self, top=DEFAULT_TOP):
+        count, ticks = self.totals()
+        lines = [f"instructions -> {count}  ticks -> {ticks}", "", f"top {top} lines by ticks:"]
+        lines.append(f"{'line':>6} {'ticks':>10} {'%':>7} {'instructions':>13}  source")
+        hot_lines = sorted(self.by_line().items(), key=lambda item: (-item[1][1], item[0] or 0))[:top]
+        for line_number, (line_count, line_ticks) in hot_lines:
+            share = line_ticks / ticks * 100 if ticks else 0
+            lines.append(f"{line_number or '-':>6} {line_ticks:>10} {share:>6.1f}% {line_count:>13}  {self.line_text(line_number)}")
+        lines += ["", "procedures:", f"{'procedure':<16} {'instructions':>13} {'self ticks':>12} {'total ticks':>12}"]
+        for name, (procedure_count, self_ticks, total_ticks) in sorted(self.by_procedure().items(), key=lambda item: -item[1][2]):
+            lines.append(f"{name:<16} {procedure_count:>13} {self_ticks:>12} {total_ticks:>12}")
+        lines += ["", "opcodes:", f"{'opcode':<16} {'instructions':>13} {'ticks':>12}"]
+        for name, (opcode_count, opcode_ticks) in sorted(self.by_opcode().items(), key=lambda item: -item[1][1]):
+            lines.append(f"{name:<16} {opcode_count:>13} {opcode_ticks:>12}")
+        return "\n".join(lines)
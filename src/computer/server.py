@@ -0,0 +1,142 @@
+import base64
+import contextlib
+import json
+import logging
+import os
+import socketserver
+import sys
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+sys.path.append(".")
+
+import api
+from computer import memory
+from computer.client import DEFAULT_SOCKET, parse_arguments, program_hash
+from computer.machine import ENGINES
+from exceptions import WrongMachineArgumentsError
+from language.cache import cache_key
+from language.image import IMAGE_MAGIC, parse_image
+from language.instruction import parse_instructions
+from language.translator import TRANSLATOR_VERSION
+
+DEFAULT_CACHE_SIZE = 256
+DEFAULT_WORKERS = 4
+
+
+class ProgramCache:
+    """LRU-кэш готовых к исполнению программ: списков инструкций и образов по ключу"""
+
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            program = self.entries.get(key)
+            if program is not None:
+                self.entries.move_to_end(key)
+            return program
+
+    def put(self, key, program):
+        with self.lock:
+            self.entries[key] = program
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+def decode_program(data):
+    """Машинный код из байтов файла: образ по сигнатуре, иначе JSON транслятора"""
+    if data.startswith(IMAGE_MAGIC):
+        return parse_image(data)
+    return parse_instructions(data.decode("utf-8"))
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Читает запросы построчно, исполняет их в пуле сервера и отвечает по мере завершения"""
+
+    def handle(self):
+        lock = threading.Lock()
+        futures = [self.server.executor.submit(self.answer, line, lock) for line in self.rfile if line.strip()]
+        wait(futures)
+
+    def answer(self, line, lock):
+        response = self.server.execute(line)
+        with lock:
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class MachineServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Сервер исполнения на Unix-сокете, транслированные и декодированные программы держатся в LRU-кэше.
+
+    Запрос — строка JSON: "source" (исходник) или "hash" (SHA-256 байтов машинного кода) с необязательным "program"
+    (base64 этих байтов), "input", "engine", "instruction_limit", "optimize", "fuse" и "id".
+    Ответ — строка JSON с тем же "id": "output", "instruction_count", "ticks", либо "error",
+    либо "missing", если программы с таким хешем нет в кэше и её нужно дослать.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path=DEFAULT_SOCKET, cache_size=DEFAULT_CACHE_SIZE, workers=DEFAULT_WORKERS):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        self.programs = ProgramCache(cache_size)
+        self.executor = ThreadPoolExecutor(workers)
+        super().__init__(path, RequestHandler)
+
+    def program(self, request):
+        """Программа запроса из кэша, с трансляцией или декодированием при промахе, None — нужно дослать байты"""
+        if "source" in request:
+            optimize, fuse = bool(request.get("optimize")), bool(request.get("fuse"))
+            key = cache_key(request["source"], TRANSLATOR_VERSION, f"optimize={optimize},fuse={fuse}")
+            program = self.programs.get(key)
+            if program is None:
+                program = api.translate(request["source"], optimize, fuse)
+                self.programs.put(key, program)
+            return program
+        program = self.programs.get(request["hash"])
+        if program is None and "program" in request:
+            data = base64.b64decode(request["program"])
+            if program_hash(data) != request["hash"]:
+                raise ValueError("program does not match its hash")
+            program = decode_program(data)
+            self.programs.put(request["hash"], program)
+        return program
+
+    def execute(self, line):
+        request = {}
+        try:
+            request = json.loads(line)
+            engine = request.get("engine", "microcode")
+            if engine not in ENGINES:
+                raise WrongMachineArgumentsError
+            program = self.program(request)
+            if program is None:
+                return {"id": request.get("id"), "missing": True}
+            limit = int(request.get("instruction_limit", memory.INSTRUCTION_LIMIT))
+            result = api.run(program, request.get("input", ""), engine, limit)
+        except Exception as exception:
+            logging.exception("request failed")
+            return {"id": request.get("id"), "error": str(exception)}
+        return {"id": request.get("id"), "output": result.output, "instruction_count": result.instruction_count, "ticks": result.ticks}
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.server_address)
+
+
+if __name__ == "__main__":
+    arguments, options = parse_arguments(sys.argv[1:])
+    if arguments or not set(options) <= {"socket", "cache-size", "workers"}:
+        raise WrongMachineArgumentsError
+    cache_size, workers = options.get("cache-size", str(DEFAULT_CACHE_SIZE)), options.get("workers", str(DEFAULT_WORKERS))
+    if not cache_size.isdigit() or not workers.isdigit():
+        raise WrongMachineArgumentsError
+    logging.basicConfig(format="[%(levelname)s]  %(message)s", level=logging.WARNING)
+    with MachineServer(options.get("socket") or DEFAULT_SOCKET, int(cache_size), int(workers)) as server:
+        server.serve_forever()
@@ -0,0 +1,46 @@
+import sys
+
+sys.path.append(".")
+
+from computer.machine import parse_arguments
+from computer.trace_file import read_records
+from computer.tracing import format_tick
+from exceptions import TraceDecoderArgumentsError
+from language.instruction import OPCODE_NUMBERS, Opcode
+
+
+def parse_tick_range(value):
+    start, separator, end = value.partition(":")
+    if not separator:
+        return int(start), int(start) + 1
+    return int(start) if start else 0, int(end) if end else None
+
+
+def decode(trace_file, ticks=(0, None), pc=None, opcode=None, output=sys.stdout):
+    """Печатает записи трассы в текстовом формате лога, отбирая по диапазону тактов [from, to), pc и опкоду"""
+    start, end = ticks
+    opcode_number = None if opcode is None else OPCODE_NUMBERS[Opcode(opcode)]
+    for record in read_records(trace_file):
+        tick, record_pc = record[0], record[1]
+        if end is not None and tick >= end:
+            break
+        if tick < start:
+            continue
+        if pc is not None and record_pc != pc:
+            continue
+        if opcode_number is not None and record[7] != opcode_number:
+            continue
+        output.write(format_tick(record[:7]) + "\n")
+
+
+if __name__ == "__main__":
+    arguments, options = parse_arguments(sys.argv[1:])
+    if len(arguments) != 1 or not set(options) <= {"ticks", "pc", "opcode"}:
+        raise TraceDecoderArgumentsError
+    try:
+        tick_range = parse_tick_range(options.get("ticks", ":"))
+        pc_filter = int(options["pc"]) if "pc" in options else None
+        opcode_filter = Opcode(options["opcode"]).value if "opcode" in options else None
+    except ValueError:
+        raise TraceDecoderArgumentsError from None
+    decode(arguments[0], tick_range, pc_filter, opcode_filter)
@@ -0,0 +1,165 @@
+import gzip
+import lzma
+import queue
+import struct
+import threading
+
+from computer.microcode_rom import SIGNAL_GROUPS
+from exceptions import TraceFormatError
+
+TRACE_MAGIC = b"CSAT"
+TRACE_VERSION = 1
+
+# magic, version, record size
+HEADER = struct.Struct("<4sHH")
+# tick, pc, address register, mc address, signal id, opcode number, stack depth, flags, TOS, stack top
+RECORD = struct.Struct("<QiiHHBBBxqq")
+
+FLAG_ADDRESS_NONE = 1
+FLAG_TOS_NONE = 2
+FLAG_TOS_BOOL = 4
+FLAG_TOP_BOOL = 8
+
+# Signal id: index of the ROM signal group in the high bits, position inside the group in the low ones
+SIGNAL_GROUP_SHIFT = 4
+SIGNAL_IDS = {
+    signal: (group_index << SIGNAL_GROUP_SHIFT) | position
+    for group_index, group in enumerate(SIGNAL_GROUPS)
+    for position, signal in enumerate(group)
+}
+SIGNALS_BY_ID = {signal_id: signal for signal, signal_id in SIGNAL_IDS.items()}
+
+COMPRESSIONS = {"none": open, "gzip": gzip.open, "xz": lzma.open}
+BATCH_RECORDS = 4096
+QUEUE_BATCHES = 16
+INT64_MASK = (1 << 64) - 1
+
+
+def to_int64(value):
+    value = int(value) & INT64_MASK
+    return value - (1 << 64) if value >> 63 else value
+
+
+class TraceWriter:
+    """Пишет потактовые записи фиксированного размера в файл из фонового потока.
+
+    Записи копятся пачками, пачки передаются потоку через ограниченную очередь, так что при медленном
+    диске эмулятор ждёт, а не копит память.
+    """
+
+    def __init__(self, filename, compression="none", batch_records=BATCH_RECORDS, queue_batches=QUEUE_BATCHES):
+        self.file = COMPRESSIONS[compression](filename, "wb")
+        self.file.write(HEADER.pack(TRACE_MAGIC, TRACE_VERSION, RECORD.size))
+        self.batch_size = batch_records * RECORD.size
+        self.batch = bytearray(self.batch_size)
+        self.offset = 0
+        self.queue = queue.Queue(maxsize=queue_batches)
+        self.error = None
+        self.thread = threading.Thread(target=self.write_batches, name="trace-writer", daemon=True)
+        self.thread.start()
+
+    def write_batches(self):
+        try:
+            while (batch := self.queue.get()) is not None:
+                self.file.write(batch)
+        except Exception as error:
+            # Not only OSError: a failing compressor must not leave the emulator blocked on a full queue
+            self.error = error
+            # Keep draining so the emulator thread never blocks on a dead writer
+            while self.queue.get() is not None:
+                pass
+        finally:
+            self.file.close()
+
+    def write(self, control_unit, signal):
+        datapath = control_unit.datapath
+        stack = datapath.data_stack.stack
+        address = datapath.address_register
+        top_of_stack = datapath.top_of_stack
+        top = stack[-1] if stack else 0
+        flags = (
+            (FLAG_ADDRESS_NONE if address is None else 0)
+            | (FLAG_TOS_NONE if top_of_stack is None else 0)
+            | (FLAG_TOS_BOOL if isinstance(top_of_stack, bool) else 0)
+            | (FLAG_TOP_BOOL if isinstance(top, bool) else 0)
+        )
+        RECORD.pack_into(
+            self.batch,
+            self.offset,
+            control_unit.tick,
+            datapath.pc,
+            0 if address is None else address,
+            control_unit.mc_adr,
+            SIGNAL_IDS[signal],
+            datapath.instruction_opcode,
+            len(stack),
+            flags,
+            0 if top_of_stack is None else to_int64(top_of_stack),
+            to_int64(top),
+        )
+        self.offset += RECORD.size
+        if self.offset == self.batch_size:
+            self.queue.put(bytes(self.batch))
+            self.offset = 0
+
+    def close(self):
+        if self.offset:
+            self.queue.put(bytes(self.batch[: self.offset]))
+            self.offset = 0
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def open_trace(filename):
+    """Открывает файл трассы, сжатие определяется по сигнатуре"""
+    with open(filename, "rb") as file:
+        signature = file.read(6)
+    if signature.startswith(b"\x1f\x8b"):
+        return gzip.open(filename, "rb")
+    if signature.startswith(b"\xfd7zXZ"):
+        return lzma.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def read_records(filename):
+    """Восстанавливает снимки (tick, pc, addr, mc, signal, tos, stack, opcode) по записям трассы.
+
+    Стек меняется не больше чем на одно значение за такт, поэтому он собирается из глубины и вершины.
+    """
+    with open_trace(filename) as file:
+        header = file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise TraceFormatError("file is too short for a trace header")
+        magic, version, record_size = HEADER.unpack(header)
+        if magic != TRACE_MAGIC:
+            raise TraceFormatError("bad magic")
+        if version != TRACE_VERSION or record_size != RECORD.size:
+            raise TraceFormatError(f"unsupported trace version {version}")
+        stack = []
+        while chunk := file.read(RECORD.size * BATCH_RECORDS):
+            if len(chunk) % RECORD.size:
+                raise TraceFormatError("trace is truncated")
+            for tick, pc, address, mc_adr, signal_id, opcode, depth, flags, tos, top in RECORD.iter_unpack(chunk):
+                del stack[depth:]
+                if depth:
+                    top = bool(top) if flags & FLAG_TOP_BOOL else top
+                    if len(stack) < depth:
+                        stack.append(top)
+                    else:
+                        stack[-1] = top
+                if flags & FLAG_TOS_NONE:
+                    tos = None
+                elif flags & FLAG_TOS_BOOL:
+                    tos = bool(tos)
+                yield (
+                    tick,
+                    pc,
+                    None if flags & FLAG_ADDRESS_NONE else address,
+                    mc_adr,
+                    SIGNALS_BY_ID[signal_id],
+                    tos,
+                    tuple(stack),
+                    opcode,
+                )
@@ -0,0 +1,109 @@
+import logging
+from collections import deque
+from enum import Enum
+
+from language.instruction import OPCODES
+
+
+class TraceLevel(Enum):
+    OFF = 0
+    INSTRUCTION = 1
+    TICK = 2
+
+
+TRACE_LEVELS = {level.name.lower(): level for level in TraceLevel}
+
+
+def snapshot(control_unit, signal):
+    """Состояние машины после такта: (tick, pc, addr, mc, signal, tos, stack)"""
+    datapath = control_unit.datapath
+    return (
+        control_unit.tick,
+        datapath.pc,
+        datapath.address_register,
+        control_unit.mc_adr,
+        signal,
+        datapath.top_of_stack,
+        tuple(datapath.data_stack.stack),
+    )
+
+
+def format_tick(record):
+    tick, pc, address, mc_adr, signal, top_of_stack, stack = record
+    return (
+        "tick -> {:4} ip -> {:3} addr -> {:3} mc -> {:2} control -> {:15} tos -> {:6}\n" "stack -> {}"
+    ).format(
+        str(tick),
+        str(pc),
+        str(address),
+        str(mc_adr),
+        str(signal),
+        str(top_of_stack) if top_of_stack is not None else "0",
+        list(stack),
+    )
+
+
+def format_instruction(control_unit):
+    datapath = control_unit.datapath
+    opcode_number = datapath.instruction_opcode
+    opcode = OPCODES[opcode_number].value if opcode_number < len(OPCODES) else "data"
+    return "instruction -> {:6} ip -> {:3} opcode -> {:11} arg -> {:6} tos -> {:6}\nstack -> {}".format(
+        str(control_unit.instraction_count),
+        str(datapath.pc),
+        opcode,
+        str(datapath.instruction_arg),
+        str(datapath.top_of_stack) if datapath.top_of_stack is not None else "0",
+        datapath.data_stack.stack,
+    )
+
+
+class Tracer:
+    """Трассировка исполнения с уровнем off / instruction / tick и кольцевым буфером последних тактов.
+
+    Буфер хранит сырые снимки состояния, форматируются они только при сбросе в лог.
+    Если передан writer, каждый такт дополнительно пишется им в двоичную трассу.
+    """
+
+    def __init__(self, level=TraceLevel.OFF, history=0, writer=None):
+        self.level = level
+        self.history = deque(maxlen=history) if history > 0 else None
+        self.writer = writer
+
+    @property
+    def enabled(self):
+        return self.level is not TraceLevel.OFF or self.records_ticks
+
+    @property
+    def traces_instructions(self):
+        return self.level is TraceLevel.INSTRUCTION
+
+    @property
+    def records_ticks(self):
+        return self.level is TraceLevel.TICK or self.history is not None or self.writer is not None
+
+    def instruction(self, control_unit):
+        logging.debug("%s", format_instruction(control_unit))
+
+    def tick(self, control_unit, signal):
+        if self.writer is not None:
+            self.writer.write(control_unit, signal)
+        if self.history is None and self.level is not TraceLevel.TICK:
+            return
+        record = snapshot(control_unit, signal)
+        if self.history is not None:
+            self.history.append(record)
+        if self.level is TraceLevel.TICK:
+            logging.debug("%s", format_tick(record))
+
+    def dump(self, reason):
+        """Пишет в лог последние такты из кольцевого буфера"""
+        if not self.history:
+            return
+        logging.info("last %d ticks before %s:", len(self.history), reason)
+        for record in self.history:
+            logging.info("%s", format_tick(record))
+        self.history.clear()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
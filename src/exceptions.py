@@ -42,17 +42,17 @@ class BranchesNotBalancedError(Exception):
 
 class LoopError(Exception):
     def __init__(self):
-        super().__init__("Error: not balanced count of 'begin' and 'until'")
+        super().__init__("Error: not balanced count of 'begin' and 'until' or 'do' and 'loop'")
 
 
 class TranslatorArgumentsError(Exception):
     def __init__(self):
-        super().__init__("Error: wrong number of arguments (translator.py <input_file> <output_file>)")
+        super().__init__("Error: wrong number of arguments (translator.py <input_file> <output_file> [--format=json|image|both] [--cache=<dir>] [--cache-size=<bytes>] [--optimize] [--fuse])")
 
 
 class WrongMachineArgumentsError(Exception):
     def __init__(self):
-        super().__init__("Error: wrong number of arguments (machine.py <machine_code_file> <input_file> <log_file>")
+        super().__init__("Error: wrong number of arguments (machine.py <machine_code_file> <input_file> <log_file> [--engine=<name>] [--input=buffered|mmap] [--trace=off|instruction|tick] [--trace-history=<n>] [--trace-file=<file>] [--trace-compression=none|gzip|xz] [--profile=<file>] [--profile-stacks=<file>] [--profile-source=<source_file>] [--profile-top=<n>])")
 
 
 class StackOverflowError(Exception):
@@ -60,6 +60,11 @@ class StackOverflowError(Exception):
         super().__init__(f"Error: stack is overflowed (max_size is {max_size})")
 
 
+class ReturnStackUnderflowError(Exception):
+    def __init__(self):
+        super().__init__("Error: return without a matching call")
+
+
 class StackUnderflowError(Exception):
     def __init__(self):
         super().__init__("Error: stack is underflow")
@@ -70,6 +75,57 @@ class InvalidSignalError(Exception):
         super().__init__(f"Error: signal {signal} does not exist")
 
 
+class MicrocodeOrderError(Exception):
+    def __init__(self, address):
+        super().__init__(f"Error: microinstruction {address} lists its signals out of ROM field order")
+
+
 class BufferError(Exception):
     def __init__(self):
         super().__init__("Error: cannot make new buffer in procedure")
+
+
+class ImageFormatError(Exception):
+    def __init__(self, reason):
+        super().__init__(f"Error: invalid machine code image ({reason})")
+
+
+class InvalidArgumentError(Exception):
+    def __init__(self, index, arg):
+        super().__init__(f"Error: instruction {index} has non-integer argument {arg!r}")
+
+
+class DataExecutionError(Exception):
+    def __init__(self, address):
+        super().__init__(f"Error: memory cell {address} holds data, not an instruction")
+
+
+class TraceFormatError(Exception):
+    def __init__(self, reason):
+        super().__init__(f"Error: invalid trace file ({reason})")
+
+
+class TraceDecoderArgumentsError(Exception):
+    def __init__(self):
+        super().__init__("Error: wrong number of arguments (trace_decoder.py <trace_file> [--ticks=<from>:<to>] [--pc=<n>] [--opcode=<name>])")
+
+
+class BatchEmulatorUnavailableError(Exception):
+    def __init__(self):
+        super().__init__("Error: batch emulation needs numpy (pip install numpy)")
+
+
+class BatchEmulatorArgumentsError(Exception):
+    def __init__(self):
+        super().__init__("Error: wrong number of arguments (batch_emulator.py <machine_code_file> <input_file>...)")
+
+
+class ManifestError(Exception):
+    def __init__(self, line_number, reason):
+        super().__init__(f"Error: bad job on line {line_number} of the manifest ({reason})")
+
+
+class BatchRunnerArgumentsError(Exception):
+    def __init__(self):
+        super().__init__("Error: wrong number of arguments (batch_runner.py <manifest_file> [--workers=<n>] [--chunk=<n>] [--engine=<name>])")
+
@@ -1,18 +1,36 @@
 import contextlib
 import io
+import json
 import logging
 import os
 import tempfile
+import threading
+import time
 
 
 
+import api
+import computer.batch_emulator
+import computer.batch_runner
+import computer.client
+import computer.control_unit
 import computer.machine
+import computer.memory
+import computer.microcode_rom
+import computer.profiler
+import computer.server
+import computer.trace_file
+import computer.tracing
+import exceptions
 import pytest
+import language.cache
+import language.instruction
 import language.translator
 
 
+@pytest.mark.parametrize("engine", computer.machine.ENGINES)
 @pytest.mark.golden_test("golden/*.yml")
-def test_program(golden, caplog):
+def test_program(golden, caplog, engine):
     with tempfile.TemporaryDirectory() as tmpdirname:
         code = os.path.join(tmpdirname, "code")
         inputs = os.path.join(tmpdirname, "inputs")
@@ -25,10 +43,441 @@ def test_program(golden, caplog):
         with contextlib.redirect_stdout(io.StringIO()) as stdout:
             language.translator.main(code, target)
             print("============================================================")
-            computer.machine.main(target, inputs)
+            computer.machine.main(target, inputs, engine)
 
         with open(target, encoding="utf-8") as f:
             machine_code = f.read()
 
         assert machine_code == golden.out["out_code"]
-        assert stdout.getvalue()[:-1].replace('\x00','') == golden.out["out_stdout"]
\ No newline at end of file
+        assert stdout.getvalue()[:-1].replace('\x00','') == golden.out["out_stdout"]
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_image(golden, caplog):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        code = os.path.join(tmpdirname, "code")
+        inputs = os.path.join(tmpdirname, "inputs")
+        target = os.path.join(tmpdirname, "target")
+        with open(code, "w", encoding="utf-8") as f:
+            f.write(golden["in_source"])
+        with open(inputs, "w", encoding="utf-8") as f:
+            f.write(golden["in_stdin"])
+
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            language.translator.main(code, target, "both")
+            print("============================================================")
+            computer.machine.main(target + language.translator.IMAGE_SUFFIX, inputs, "fast")
+
+        with open(target, encoding="utf-8") as f:
+            machine_code = f.read()
+
+        assert machine_code == golden.out["out_code"]
+        assert stdout.getvalue()[:-1].replace('\x00','') == golden.out["out_stdout"]
+
+
+@pytest.mark.parametrize("constant", [3000000000, -3000000000, 2**63 - 1, -(2**63)])
+def test_image_wide_arguments(constant):
+    # Every constant the JSON code runs with fits into the 64-bit argument lane of the image
+    source = f"{constant} .\nexit\n"
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        code = os.path.join(tmpdirname, "code")
+        target = os.path.join(tmpdirname, "target")
+        with open(code, "w", encoding="utf-8") as f:
+            f.write(source)
+        with contextlib.redirect_stdout(io.StringIO()):
+            language.translator.main(code, target, "both")
+        image = computer.machine.load_program(target + language.translator.IMAGE_SUFFIX)[0]
+        assert image.instructions()[0]["arg"] == constant
+        assert api.run(image, "").output == api.run(source, "").output == f" {constant}"
+
+
+def machine_stdout(target, inputs):
+    """Вывод machine.py для одного ввода или исключение, с которым упал прогон"""
+    with contextlib.redirect_stdout(io.StringIO()) as stdout:
+        try:
+            computer.machine.main(target, inputs, "fast")
+        except Exception as error:
+            return error
+    return stdout.getvalue()
+
+
+def read_all(input_device):
+    chars = []
+    while (char := input_device.read_char()) is not None:
+        chars.append(chr(char))
+    assert input_device.read_char() is None
+    return "".join(chars)
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["", " \n\t ", "a", "  ab", "ab \n", " \n a  b\t\tc \n ", "\n\nтекст  с\n пробелами\n\n", "x \n"],
+)
+def test_input_strip(text):
+    # One-character chunks and one-byte reads put every whitespace run across chunk boundaries
+    assert read_all(computer.memory.InputDevice.from_chunks(list(text), strip=True)) == text.strip()
+    stream = io.BytesIO(text.encode("utf-8"))
+    assert read_all(computer.memory.InputDevice(stream, strip=True, chunk_size=1)) == text.strip()
+    assert read_all(computer.memory.InputDevice.from_chunks(list(text))) == text
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_batch(golden, caplog):
+    pytest.importorskip("numpy")
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        code = os.path.join(tmpdirname, "code")
+        target = os.path.join(tmpdirname, "target")
+        with open(code, "w", encoding="utf-8") as f:
+            f.write(golden["in_source"])
+        # Lanes of different lengths take different branches and may fall back to FastEngine on their own
+        stdin = golden["in_stdin"]
+        variants = [stdin, stdin, stdin[: len(stdin) // 2], stdin + "\n3 1 -2\nab", "", "x"]
+        input_files = []
+        for number, text in enumerate(variants):
+            input_files.append(os.path.join(tmpdirname, f"inputs{number}"))
+            with open(input_files[-1], "w", encoding="utf-8") as f:
+                f.write(text)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            language.translator.main(code, target)
+        results = computer.batch_emulator.run_batch(target, input_files)
+
+        output, inst_count, tick_count = results[0]
+        stdout = f"============================================================\n{output}\n\ninstraction count -> {inst_count!s}\ntick -> {tick_count!s}"
+        assert stdout.replace('\x00','') == golden.out["out_stdout"]
+        for input_file, result in zip(input_files, results):
+            expected = machine_stdout(target, input_file)
+            if isinstance(expected, Exception):
+                assert type(result) is type(expected)
+                assert str(result) == str(expected)
+            else:
+                output, inst_count, tick_count = result
+                assert f"{output}\n\ninstraction count -> {inst_count!s}\ntick -> {tick_count!s}\n" == expected
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_batch_runner(golden, caplog):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        code = os.path.join(tmpdirname, "code")
+        target = os.path.join(tmpdirname, "target")
+        with open(code, "w", encoding="utf-8") as f:
+            f.write(golden["in_source"])
+        with contextlib.redirect_stdout(io.StringIO()):
+            language.translator.main(code, target)
+        stdin = golden["in_stdin"]
+        input_files = []
+        for number, text in enumerate([stdin, "", stdin[: len(stdin) // 2]]):
+            input_files.append(os.path.join(tmpdirname, f"inputs{number}"))
+            with open(input_files[-1], "w", encoding="utf-8") as f:
+                f.write(text)
+
+        # Source and code jobs of the same program alternate, one job per chunk spreads them over the workers
+        manifest = os.path.join(tmpdirname, "manifest")
+        jobs = []
+        for number in range(9):
+            job = {"source": code} if number % 2 else {"code": target}
+            job["input"] = input_files[number % len(input_files)]
+            if number % 3 == 0:
+                job["id"] = f"job{number}"
+            jobs.append(job)
+        with open(manifest, "w", encoding="utf-8") as f:
+            for job in jobs:
+                f.write(json.dumps(job) + "\n\n")
+
+        jobs = computer.batch_runner.read_manifest(manifest)
+        results = list(computer.batch_runner.run_batch(jobs, workers=3, chunk_size=1))
+
+        # Results come in completion order, each one is matched to its job by id
+        assert [job["id"] for job in jobs][:3] == ["job0", 3, 5]
+        results_by_id = {result["id"]: result for result in results}
+        assert len(results) == len(results_by_id) == len(jobs)
+        for job in jobs:
+            result = results_by_id[job["id"]]
+            assert result["input"] == job["input"]
+            expected = machine_stdout(target, job["input"])
+            if isinstance(expected, Exception):
+                assert result["error"] == str(expected)
+            else:
+                assert f"{result['output']}\n\ninstraction count -> {result['instraction_count']!s}\ntick -> {result['tick']!s}\n" == expected
+
+
+@pytest.mark.parametrize(
+    ("manifest", "reason"),
+    [
+        ('{"code": "a", "input": "b"}\n{"code": \n', "line 2 of the manifest"),
+        ('{"input": "b"}\n', "exactly one of"),
+        ('{"code": "a", "source": "a", "input": "b"}\n', "exactly one of"),
+        ('{"code": "a"}\n', "exactly one of"),
+        ('["code", "input"]\n', "exactly one of"),
+        ('{"code": "a", "input": "b", "instruction_limit": -1}\n', "instruction_limit"),
+    ],
+)
+def test_batch_runner_manifest_errors(manifest, reason):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        manifest_file = os.path.join(tmpdirname, "manifest")
+        with open(manifest_file, "w", encoding="utf-8") as f:
+            f.write(manifest)
+        with pytest.raises(exceptions.ManifestError, match=reason):
+            computer.batch_runner.read_manifest(manifest_file)
+
+
+@pytest.mark.parametrize("engine", computer.machine.ENGINES)
+@pytest.mark.parametrize("options", [{"optimize": True}, {"fuse": True}, {"optimize": True, "fuse": True}])
+@pytest.mark.golden_test("golden/*.yml")
+def test_optimize(golden, caplog, options, engine):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        code = os.path.join(tmpdirname, "code")
+        inputs = os.path.join(tmpdirname, "inputs")
+        target = os.path.join(tmpdirname, "target")
+        with open(code, "w", encoding="utf-8") as f:
+            f.write(golden["in_source"])
+        with open(inputs, "w", encoding="utf-8") as f:
+            f.write(golden["in_stdin"])
+
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            language.translator.main(code, target, **options)
+            computer.machine.main(target, inputs, engine)
+
+        output, _, counters = stdout.getvalue().rpartition("\n\ninstraction count -> ")
+        golden_output, _, golden_counters = golden.out["out_stdout"].rpartition("\n\ninstraction count -> ")
+        inst_count, tick_count = (int(counter.rpartition(" ")[2]) for counter in counters.split("\n")[:2])
+        golden_inst_count, golden_tick_count = (int(counter.rpartition(" ")[2]) for counter in golden_counters.split("\n")[:2])
+
+        assert output.replace('\x00','') == golden_output.removeprefix("============================================================\n")
+        assert inst_count <= golden_inst_count
+        assert tick_count <= golden_tick_count
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_profile(golden, caplog):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        code = os.path.join(tmpdirname, "code")
+        inputs = os.path.join(tmpdirname, "inputs")
+        target = os.path.join(tmpdirname, "target")
+        with open(code, "w", encoding="utf-8") as f:
+            f.write(golden["in_source"])
+        with open(inputs, "w", encoding="utf-8") as f:
+            f.write(golden["in_stdin"])
+
+        profile = None
+        with contextlib.redirect_stdout(io.StringIO()) as stdout:
+            language.translator.main(code, target)
+            profile = computer.profiler.Profiler(computer.machine.load_program(target)[0], golden["in_source"])
+            print("============================================================")
+            computer.machine.main(target, inputs, "fast", program_profile=profile)
+
+        # Profiling must not change the run, and every tick belongs to exactly one line of each report
+        assert stdout.getvalue()[:-1].replace('\x00','') == golden.out["out_stdout"]
+        tick_count = int(golden.out["out_stdout"].rpartition("tick -> ")[2])
+        assert profile.totals()[1] == tick_count
+        assert sum(ticks for _, ticks in profile.by_line().values()) == tick_count
+        assert profile.by_procedure()[computer.profiler.MAIN_FRAME][2] == tick_count
+        assert sum(int(line.rpartition(" ")[2]) for line in profile.collapsed()) == tick_count
+
+
+class RecordingTracer(computer.tracing.Tracer):
+    """Трассировщик, который вдобавок запоминает живые снимки каждого такта"""
+
+    def __init__(self, history=0, writer=None):
+        super().__init__(history=history, writer=writer)
+        self.records = []
+
+    def tick(self, control_unit, signal):
+        super().tick(control_unit, signal)
+        self.records.append(computer.tracing.snapshot(control_unit, signal))
+
+
+@pytest.mark.parametrize("compression", ["none", "xz"])
+@pytest.mark.golden_test("golden/*.yml")
+def test_trace_file(golden, caplog, compression):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        code = os.path.join(tmpdirname, "code")
+        inputs = os.path.join(tmpdirname, "inputs")
+        target = os.path.join(tmpdirname, "target")
+        trace = os.path.join(tmpdirname, "trace")
+        with open(code, "w", encoding="utf-8") as f:
+            f.write(golden["in_source"])
+        with open(inputs, "w", encoding="utf-8") as f:
+            f.write(golden["in_stdin"])
+        with contextlib.redirect_stdout(io.StringIO()):
+            language.translator.main(code, target)
+
+        # Small batches and a short queue make the emulator wait for the writer thread
+        writer = computer.trace_file.TraceWriter(trace, compression, batch_records=7, queue_batches=1)
+        tracer = RecordingTracer(writer=writer)
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                computer.machine.main(target, inputs, "microcode", tracer=tracer)
+            except Exception:
+                pass
+
+        records = [record[:7] for record in computer.trace_file.read_records(trace)]
+        assert tracer.records
+        assert records == tracer.records
+
+
+@pytest.mark.parametrize("history", [1, 7, 100000])
+@pytest.mark.golden_test("golden/*.yml")
+def test_trace_history(golden, caplog, history):
+    caplog.set_level(logging.INFO)
+    code = api.translate(golden["in_source"])
+    data_path = computer.memory.DataPath(code, computer.memory.InputDevice.from_text(golden["in_stdin"]), computer.machine.start_of_variables(code))
+    control = computer.machine.ENGINES["microcode"](data_path)
+    control.tracer = RecordingTracer(history)
+    control.instruction_limit = 10
+    control.run_machine()
+
+    # The ring buffer dumped at the instruction limit holds exactly the last ticks, fewer only if there were fewer
+    expected = [computer.tracing.format_tick(record) for record in control.tracer.records[-history:]]
+    assert len(expected) == min(history, len(control.tracer.records))
+    messages = caplog.messages
+    start = messages.index(f"last {len(expected)} ticks before instruction limit:") + 1
+    dumped = messages[start:]
+    while dumped and not dumped[-1].startswith("tick ->"):
+        dumped.pop()
+    assert dumped == expected
+
+
+class BrokenFile:
+    def write(self, data):
+        raise ValueError("compressor failed")
+
+    def close(self):
+        pass
+
+
+def test_trace_writer_error():
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        writer = computer.trace_file.TraceWriter(os.path.join(tmpdirname, "trace"), queue_batches=1)
+        writer.file.close()
+        writer.file = BrokenFile()
+        # The writer thread keeps draining after the failure, so puts beyond the queue size do not block
+        for _ in range(4):
+            writer.queue.put(bytes(computer.trace_file.RECORD.size))
+        with pytest.raises(ValueError, match="compressor failed"):
+            writer.close()
+
+
+@pytest.mark.parametrize("engine", computer.machine.ENGINES)
+@pytest.mark.golden_test("golden/*.yml")
+def test_api(golden, engine):
+    # Input given as an iterable of chunks is read lazily, with the same result as a file
+    result = api.run(golden["in_source"], iter(golden["in_stdin"].splitlines(keepends=True)), engine)
+
+    stdout = f"============================================================\n{result.output}\n\ninstraction count -> {result.instruction_count!s}\ntick -> {result.ticks!s}"
+    assert stdout.replace('\x00','') == golden.out["out_stdout"]
+    assert api.run(api.translate(golden["in_source"]), golden["in_stdin"], engine) == result
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_cache(golden):
+    dump = language.instruction.dump_instructions
+    variants = [{}, {"optimize": True}, {"fuse": True}, {"optimize": True, "fuse": True}]
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache = language.translator.open_cache(tmpdirname)
+        expected = [dump(language.translator.translate_text(golden["in_source"], **options)) for options in variants]
+        for options, code in zip(variants, expected):
+            assert cache.get(golden["in_source"], "+".join(options)) is None
+            assert dump(language.translator.translate_cached(golden["in_source"], cache, **options)) == code
+        # Every variant has its own entry and is read back from it
+        assert len(cache.entries()) == len(variants)
+        for options, code in zip(variants, expected):
+            assert dump(cache.get(golden["in_source"], "+".join(options))) == code
+        cache.clear()
+        assert cache.entries() == []
+
+
+def test_cache_eviction():
+    sources = ["1 .\nexit\n", "2 .\nexit\n", "3 .\nexit\n"]
+    codes = [api.translate(source) for source in sources]
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        cache = language.translator.open_cache(tmpdirname)
+        for source, code in zip(sources[:2], codes):
+            cache.put(source, code)
+        size = max(entry_size for _, entry_size, _ in cache.entries())
+        # The first entry is read last, so the second one is the least recently read
+        now = time.time()
+        for age, source in ((20, sources[0]), (10, sources[1])):
+            os.utime(cache.entry_path(source), (now - age, now - age))
+        cache.get(sources[0])
+        cache.max_bytes = 2 * size
+        cache.put(sources[2], codes[2])
+        assert cache.get(sources[1]) is None
+        assert cache.get(sources[0]) is not None
+        assert cache.get(sources[2]) is not None
+
+        # A temporary file of a writer that died before the rename is removed once stale, a fresh one is kept
+        stale = os.path.join(tmpdirname, "stale" + language.cache.TEMPORARY_SUFFIX)
+        fresh = os.path.join(tmpdirname, "fresh" + language.cache.TEMPORARY_SUFFIX)
+        for path in (stale, fresh):
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("{")
+        old = now - 2 * language.cache.STALE_TEMPORARY_SECONDS
+        os.utime(stale, (old, old))
+        cache.evict()
+        assert not os.path.exists(stale)
+        assert os.path.exists(fresh)
+        os.utime(fresh, (old, old))
+        cache.clear()
+        assert [name for _, _, files in os.walk(tmpdirname) for name in files] == []
+
+
+@pytest.mark.golden_test("golden/*.yml")
+def test_server(golden, caplog):
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        code = os.path.join(tmpdirname, "code")
+        target = os.path.join(tmpdirname, "target")
+        socket_path = os.path.join(tmpdirname, "socket")
+        with open(code, "w", encoding="utf-8") as f:
+            f.write(golden["in_source"])
+        with contextlib.redirect_stdout(io.StringIO()):
+            language.translator.main(code, target, "both")
+
+        with computer.server.MachineServer(socket_path, cache_size=1) as server:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                responses = []
+                # The JSON code is evicted by the image and sent again
+                for program_file in (target, target + language.translator.IMAGE_SUFFIX, target):
+                    with open(program_file, "rb") as f:
+                        responses.append(computer.client.run_remote(f.read(), golden["in_stdin"], socket_path, engine="fast"))
+                source = golden["in_source"].encode("utf-8")
+                responses.append(computer.client.run_remote(source, golden["in_stdin"], socket_path, source=True, engine="fast"))
+            finally:
+                server.shutdown()
+                thread.join()
+
+        for response in responses:
+            stdout = f"============================================================\n{response['output']}\n\ninstraction count -> {response['instruction_count']!s}\ntick -> {response['ticks']!s}"
+            assert stdout.replace('\x00','') == golden.out["out_stdout"]
+
+
+@pytest.mark.parametrize(
+    ("source", "error"),
+    [
+        ("i .\nexit\n", exceptions.InputError),
+        ("5 0 do\nloop\ni .\nexit\n", exceptions.InputError),
+        ("loop\nexit\n", exceptions.LoopError),
+        ("5 0 do\nuntil\nexit\n", exceptions.LoopError),
+        ("5 0 do\nexit\n", exceptions.LoopError),
+    ],
+)
+def test_counted_loop_errors(source, error):
+    # The loop index exists only inside a do body, do and loop must pair up
+    with pytest.raises(error):
+        api.translate(source)
+
+
+def test_microcode_rom_order():
+    rom = computer.microcode_rom
+    # Every microcode row already lists its signals in ROM field order, a reordered row is rejected
+    for word, signals in zip(rom.MICROCODE_ROM, computer.control_unit.microcode):
+        assert rom.decode_microinstruction(word) == list(signals)
+    with pytest.raises(exceptions.MicrocodeOrderError, match="microinstruction 1"):
+        rom.compile_rom(
+            [
+                [rom.MemoryControl.TOS, rom.MicrocodeAddressControl.INC],
+                [rom.MicrocodeAddressControl.INC, rom.MemoryControl.WRITE],
+            ]
+        )
@@ -0,0 +1,122 @@
+import hashlib
+import os
+import tempfile
+import time
+
+from language.instruction import dump_instructions, parse_instructions
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+ENTRY_SUFFIX = ".json"
+TEMPORARY_SUFFIX = ".tmp"
+# A temporary file this old is left by a writer that died before the rename, younger ones may still be written
+STALE_TEMPORARY_SECONDS = 60
+
+
+def cache_key(source, version, variant=""):
+    """Хеш версии транслятора, варианта трансляции (например, с оптимизацией) и текста исходника"""
+    digest = hashlib.sha256()
+    digest.update(f"{version}\0{variant}\0".encode("utf-8"))
+    digest.update(source.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class TranslationCache:
+    """Кэш машинного кода на диске по хешу исходника, общий для нескольких процессов
+
+    Записи пишутся во временный файл и переименовываются, поэтому читатель видит запись целиком или не видит её.
+    Время доступа записи обновляется при чтении, при превышении max_bytes удаляются записи с самым старым доступом.
+    Временные файлы писателей, упавших до переименования, учитываются в размере и удаляются при evict и clear.
+    """
+
+    def __init__(self, directory, version, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.version = version
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def entry_path(self, source, variant=""):
+        key = cache_key(source, self.version, variant)
+        return os.path.join(self.directory, key[:2], key + ENTRY_SUFFIX)
+
+    def get(self, source, variant=""):
+        """Машинный код с отладочной информацией из кэша или None"""
+        path = self.entry_path(source, variant)
+        try:
+            with open(path, encoding="utf-8") as file:
+                text = file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            # Missing or evicted by another process between open and utime
+            return None
+        return parse_instructions(text)
+
+    def put(self, source, instructions, variant=""):
+        path = self.entry_path(source, variant)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix=TEMPORARY_SUFFIX)
+        try:
+            with os.fdopen(descriptor, "w", encoding="utf-8") as file:
+                file.write(dump_instructions(instructions))
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+        self.evict()
+
+    def files(self, suffix):
+        """Файлы каталога кэша с данным суффиксом: (время доступа, время изменения, размер, путь)"""
+        result = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(suffix):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    status = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                result.append((status.st_atime, status.st_mtime, status.st_size, path))
+        return result
+
+    def entries(self):
+        """Записи кэша: (время доступа, размер, путь)"""
+        return [(atime, size, path) for atime, _, size, path in self.files(ENTRY_SUFFIX)]
+
+    def remove_stale_temporaries(self):
+        """Удаляет брошенные временные файлы, возвращает размер оставшихся"""
+        total = 0
+        deadline = time.time() - STALE_TEMPORARY_SECONDS
+        for _, mtime, size, path in self.files(TEMPORARY_SUFFIX):
+            if mtime > deadline:
+                total += size
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        return total
+
+    def evict(self):
+        """Удаляет брошенные временные файлы и давно не читанные записи, пока размер кэша больше max_bytes"""
+        entries = self.entries()
+        total = self.remove_stale_temporaries() + sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(entries):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # Already evicted by another process
+                pass
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        self.remove_stale_temporaries()
+        for _, _, path in self.entries():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,155 @@
+import mmap
+import struct
+import sys
+from array import array
+
+from exceptions import ImageFormatError
+from language.instruction import DATA_OPCODE, OPCODE_NUMBERS, OPCODES, Instruction, Opcode, find_start_of_variables
+
+IMAGE_MAGIC = b"CSAI"
+IMAGE_VERSION = 3
+
+# magic, version, flags, word count, debug record count, start of variables
+HEADER = struct.Struct("<4sHHIII")
+# address, line number, word number, symbol offset, symbol length
+DEBUG_RECORD = struct.Struct("<IIIII")
+FLAG_DEBUG_INFO = 1
+
+# Machine words are stored as two little-endian lanes, so each is sliced out of the raw bytes whole:
+# signed 64-bit arguments (the width of Memory.args), then a 2-byte tag per word with the opcode number
+# (DATA_OPCODE for data cells) in the low byte and flags in the high one
+ARG_SIZE = 8
+TAG_SIZE = 2
+TAG_HAS_ARG = 1
+ARG_MIN = -(1 << 63)
+ARG_MAX = (1 << 63) - 1
+
+
+def encode_word(instruction):
+    """(аргумент, номер опкода, флаги) одного машинного слова"""
+    opcode = instruction.get("opcode")
+    opcode_number = DATA_OPCODE if opcode is None else OPCODE_NUMBERS[Opcode(opcode)]
+    if "arg" not in instruction:
+        return 0, opcode_number, 0
+    arg = int(instruction["arg"])
+    if not ARG_MIN <= arg <= ARG_MAX:
+        raise ImageFormatError(f"argument {arg} of instruction {instruction.get('index')} does not fit in 64 bits")
+    return arg, opcode_number, TAG_HAS_ARG
+
+
+def decode_word(arg, opcode_number, flags):
+    instruction = {} if opcode_number == DATA_OPCODE else {"opcode": OPCODES[opcode_number]}
+    if flags & TAG_HAS_ARG:
+        instruction["arg"] = arg
+    return instruction
+
+
+def save_image(filename, instructions, debug_info=True):
+    words = [encode_word(instruction) for instruction in instructions]
+    args = array("q", [arg for arg, _, _ in words])
+    if sys.byteorder == "big":
+        args.byteswap()
+    tags = bytes(byte for _, opcode_number, flags in words for byte in (opcode_number, flags))
+    records = []
+    symbols = bytearray()
+    if debug_info:
+        for address, instruction in enumerate(instructions):
+            if "term" not in instruction:
+                continue
+            line_number, word_number, symbol = instruction["term"]
+            encoded = str(symbol).encode("utf-8")
+            records.append(DEBUG_RECORD.pack(address, line_number, word_number, len(symbols), len(encoded)))
+            symbols += encoded
+    header = HEADER.pack(
+        IMAGE_MAGIC,
+        IMAGE_VERSION,
+        FLAG_DEBUG_INFO if debug_info else 0,
+        len(words),
+        len(records),
+        find_start_of_variables(instructions),
+    )
+    with open(filename, "wb") as file:
+        file.write(header)
+        file.write(args.tobytes())
+        file.write(tags)
+        file.write(b"".join(records))
+        file.write(symbols)
+
+
+def is_image_file(filename):
+    with open(filename, "rb") as file:
+        return file.read(len(IMAGE_MAGIC)) == IMAGE_MAGIC
+
+
+class MachineImage:
+    """Загруженный образ машинного кода: сырые дорожки аргументов и тегов и необязательная отладочная секция"""
+
+    def __init__(self, raw_args, raw_tags, start_of_variables, debug_section=b"", debug_count=0):
+        self.raw_args = raw_args
+        self.raw_tags = raw_tags
+        self.start_of_variables = start_of_variables
+        self.debug_section = debug_section
+        self.debug_count = debug_count
+
+    def __len__(self):
+        return len(self.raw_tags) // TAG_SIZE
+
+    def opcodes(self):
+        return array("B", self.raw_tags[0::TAG_SIZE])
+
+    def flags(self):
+        return array("B", self.raw_tags[1::TAG_SIZE])
+
+    def args(self):
+        args = array("q")
+        args.frombytes(self.raw_args)
+        if sys.byteorder == "big":
+            args.byteswap()
+        return args
+
+    def debug_info(self):
+        """Отображение адрес -> Instruction(номер строки, номер слова, символ)"""
+        symbols_offset = self.debug_count * DEBUG_RECORD.size
+        info = {}
+        for address, line_number, word_number, offset, length in DEBUG_RECORD.iter_unpack(
+            self.debug_section[:symbols_offset]
+        ):
+            start = symbols_offset + offset
+            symbol = bytes(self.debug_section[start : start + length]).decode("utf-8")
+            info[address] = Instruction(line_number, word_number, symbol)
+        return info
+
+    def instructions(self):
+        """Разворачивает образ в список словарей в формате load_instructions_from_file"""
+        debug = self.debug_info()
+        instructions = []
+        for index, word in enumerate(zip(self.args(), self.opcodes(), self.flags())):
+            instruction = {"index": index, **decode_word(*word)}
+            if index in debug:
+                instruction["term"] = debug[index]
+            instructions.append(instruction)
+        return instructions
+
+
+def parse_image(buffer):
+    """Образ из байтов образа (bytes или mmap), слова и отладочная секция копируются из буфера"""
+    if len(buffer) < HEADER.size:
+        raise ImageFormatError("file is too short for an image header")
+    magic, version, flags, word_count, debug_count, start_of_variables = HEADER.unpack_from(buffer)
+    if magic != IMAGE_MAGIC:
+        raise ImageFormatError("bad magic")
+    if version != IMAGE_VERSION:
+        raise ImageFormatError(f"unsupported image version {version}")
+    args_end = HEADER.size + word_count * ARG_SIZE
+    words_end = args_end + word_count * TAG_SIZE
+    if len(buffer) < words_end + debug_count * DEBUG_RECORD.size:
+        raise ImageFormatError("image is truncated")
+    raw_args = buffer[HEADER.size : args_end]
+    raw_tags = buffer[args_end:words_end]
+    debug_section = buffer[words_end:] if flags & FLAG_DEBUG_INFO else b""
+    return MachineImage(raw_args, raw_tags, start_of_variables, debug_section, debug_count)
+
+
+def load_image(filename):
+    with open(filename, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        return parse_image(mapped)
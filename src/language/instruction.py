@@ -31,23 +31,51 @@ class Opcode(str, Enum):
     JMP = "jmp"
     HALT = "halt"
 
+    # Superinstructions: addr_on_top + var_on_top, addr_on_top + save_var and a comparison + jzs in one opcode
+    LOAD_VAR = "load_var"
+    STORE_VAR = "store_var"
+    EQ_JZS = "eq_jzs"
+    NOT_EQ_JZS = "not_eq_jzs"
+    MORE_JZS = "more_jzs"
+    LESS_JZS = "less_jzs"
+
+    # Procedure call: push the address of the call to the return stack and jump, ret jumps past the call
+    CALL = "call"
+    RET = "ret"
+    # Prints the length-prefixed string at the variable address
+    PRINT_STR = "print_str"
+    # Reads a decimal number onto the stack, reads a line into a buffer and pushes its length
+    READ_NUM = "read_num"
+    READ_LINE = "read_line"
+    # Counted loop: do moves limit and start into the loop registers, loop increments the index and jumps
+    # back while it is below the limit, unloop restores the enclosing pair, loop_index pushes the index
+    DO = "do"
+    LOOP = "loop"
+    UNLOOP = "unloop"
+    LOOP_INDEX = "loop_index"
+
     def __str__(self):
         return str(self.value)
 
+
+# Opcode numbers used in packed machine words, new opcodes must be appended to the end of Opcode
+OPCODE_NUMBERS = {opcode: number for number, opcode in enumerate(Opcode)}
+OPCODES = list(Opcode)
+# Opcode number of memory cells that hold data instead of an instruction
+DATA_OPCODE = 0xFF
+
+
 class Instruction(namedtuple("Instruction", "line_number word_number symbol")):
     """Описание инструкции в виде (номер строки, номер слова в строке, символ)"""
 
 
-def save_instructions_to_file(filename, instructions):
-    with open(filename, "w", encoding="utf-8") as file:
-        json_instructions = [json.dumps(instruction) for instruction in instructions]
-        file.write("[" + ",\n".join(json_instructions) + "]")
+def dump_instructions(instructions):
+    return "[" + ",\n".join(json.dumps(instruction) for instruction in instructions) + "]"
 
 
-def load_instructions_from_file(filename):
-    with open(filename, encoding="utf-8") as file:
-        instructions = json.loads(file.read())
-    
+def parse_instructions(text):
+    instructions = json.loads(text)
+
     for instruction in instructions:
         if "opcode" in instruction:
             instruction["opcode"] = Opcode(instruction["opcode"])
@@ -57,3 +85,24 @@ def load_instructions_from_file(filename):
                 instruction["term"][0], instruction["term"][1], instruction["term"][2]
             )
     return instructions
+
+
+def save_instructions_to_file(filename, instructions):
+    with open(filename, "w", encoding="utf-8") as file:
+        file.write(dump_instructions(instructions))
+
+
+def load_instructions_from_file(filename):
+    with open(filename, encoding="utf-8") as file:
+        return parse_instructions(file.read())
+
+
+def find_start_of_variables(instructions):
+    """Адрес ячейки перед переменными: транслятор кладёт данные сразу за всем кодом, без данных — первый halt"""
+    for index, instruction in enumerate(instructions):
+        if "opcode" not in instruction:
+            return index
+    for line_number, instruction in enumerate(instructions):
+        if instruction.get("opcode") == Opcode.HALT:
+            return line_number + 1
+    return len(instructions) + 1
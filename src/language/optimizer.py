@@ -0,0 +1,237 @@
+from computer.alu import ALU, ALU_OPERATIONS
+from language.instruction import Opcode
+
+# Comparison + jzs superinstructions by comparison
+FUSED_COMPARISONS = {
+    Opcode.EQ: Opcode.EQ_JZS,
+    Opcode.NOT_EQ: Opcode.NOT_EQ_JZS,
+    Opcode.MORE: Opcode.MORE_JZS,
+    Opcode.LESS: Opcode.LESS_JZS,
+}
+# Opcodes that set the ALU flags, JZS is the only reader of the zero flag that does not set it first
+ALU_OPCODES = {Opcode.SUM, Opcode.SUB, Opcode.MUL, Opcode.DIV, Opcode.MOD, *FUSED_COMPARISONS, *FUSED_COMPARISONS.values()}
+# Arithmetic that folds to an int, comparisons yield bools and are printed as True/False, so they are not folded
+FOLDABLE_OPCODES = {Opcode.SUM: 0, Opcode.SUB: 1, Opcode.MUL: 2, Opcode.DIV: 3, Opcode.MOD: 4}
+# Opcodes whose result on top of the stack is always an int, memory stores int() of the value
+INT_RESULT_OPCODES = {Opcode.PUSH, Opcode.VAR_ON_TOP, *FOLDABLE_OPCODES}
+JUMP_OPCODES = {Opcode.JZS, Opcode.JMP, Opcode.LOOP, *FUSED_COMPARISONS.values()}
+# Opcodes whose argument is an instruction index
+TARGET_OPCODES = {*JUMP_OPCODES, Opcode.CALL}
+NEGATED_COMPARISONS = {Opcode.EQ: Opcode.NOT_EQ, Opcode.NOT_EQ: Opcode.EQ}
+# swap followed by the key is the value applied to the unswapped operands
+SWAPPED_OPERATIONS = {
+    Opcode.SUM: Opcode.SUM,
+    Opcode.MUL: Opcode.MUL,
+    Opcode.EQ: Opcode.EQ,
+    Opcode.NOT_EQ: Opcode.NOT_EQ,
+    Opcode.MORE: Opcode.LESS,
+    Opcode.LESS: Opcode.MORE,
+}
+MAX_PASSES = 32
+
+
+def opcode_of(instruction):
+    opcode = instruction.get("opcode")
+    return None if opcode is None else Opcode(opcode)
+
+
+def is_push_of(instruction, value):
+    return opcode_of(instruction) is Opcode.PUSH and int(instruction["arg"]) == value
+
+
+class Peephole:
+    """Один проход оптимизатора по коду транслятора: переписывает окна инструкций и пересчитывает переходы.
+
+    Адреса переменных отсчитываются от первой ячейки данных, поэтому код можно переписывать целиком.
+    Окно переписывается, только если в его середину нет переходов.
+    """
+
+    def __init__(self, machine_code):
+        self.code = [instruction for instruction in machine_code if "opcode" in instruction]
+        self.data = machine_code[len(self.code):]
+        self.opcodes = [opcode_of(instruction) for instruction in self.code]
+        self.targets = {int(instruction["arg"]) for instruction in self.code if opcode_of(instruction) in TARGET_OPCODES}
+        self.flag_live = self.zero_flag_liveness()
+        # Old index -> list of instructions replacing it, None keeps the instruction
+        self.replacements = {}
+        self.changed = False
+
+    def successors(self, index):
+        opcode = self.opcodes[index]
+        if opcode in {Opcode.HALT, Opcode.RET}:
+            # The instruction after every call is a successor of ret, calls list it themselves
+            return []
+        if opcode is Opcode.CALL:
+            return [int(self.code[index]["arg"]), index + 1]
+        if opcode is Opcode.JMP:
+            return [int(self.code[index]["arg"])]
+        if opcode in JUMP_OPCODES:
+            return [index + 1, int(self.code[index]["arg"])]
+        return [index + 1]
+
+    def zero_flag_liveness(self):
+        """Для каждой инструкции: может ли zero flag после неё быть прочитан jzs"""
+        count = len(self.code)
+        live_in = [False] * count
+        live_out = [False] * count
+        changed = True
+        while changed:
+            changed = False
+            for index in reversed(range(count)):
+                # Jumps outside the code are kept conservative
+                opcode = self.opcodes[index]
+                out = opcode is Opcode.RET or any(live_in[target] if 0 <= target < count else True for target in self.successors(index))
+                entry = opcode is Opcode.JZS or (out and opcode not in ALU_OPCODES)
+                if out != live_out[index] or entry != live_in[index]:
+                    live_out[index], live_in[index] = out, entry
+                    changed = True
+        return live_out
+
+    def reachable(self):
+        seen = set()
+        pending = [0]
+        while pending:
+            index = pending.pop()
+            if index in seen or not 0 <= index < len(self.code):
+                continue
+            seen.add(index)
+            pending.extend(self.successors(index))
+        return seen
+
+    def window(self, index, size):
+        """Опкоды окна или None, если окно выходит за границу или в его середину есть переход"""
+        if index + size > len(self.code) or any(index + offset in self.targets for offset in range(1, size)):
+            return None
+        if any(index + offset in self.replacements for offset in range(size)):
+            return None
+        return self.opcodes[index : index + size]
+
+    def replace(self, index, size, instructions):
+        term = self.code[index].get("term")
+        for offset in range(size):
+            self.replacements[index + offset] = []
+        self.replacements[index] = [{"opcode": opcode.value, **({"arg": arg} if arg is not None else {}), **({"term": term} if term else {})} for opcode, arg in instructions]
+        self.changed = True
+
+    def fold_constants(self, index):
+        window = self.window(index, 3)
+        if window is None or window[:2] != [Opcode.PUSH, Opcode.PUSH] or window[2] not in FOLDABLE_OPCODES:
+            return
+        if self.flag_live[index + 2]:
+            return
+        second, top = int(self.code[index]["arg"]), int(self.code[index + 1]["arg"])
+        if window[2] in {Opcode.DIV, Opcode.MOD} and second == 0:
+            # Keep the division by zero error at run time
+            return
+        value = ALU().apply_flags(ALU_OPERATIONS[FOLDABLE_OPCODES[window[2]]](top, second))
+        self.replace(index, 3, [(Opcode.PUSH, value)])
+
+    def remove_pairs(self, index):
+        window = self.window(index, 2)
+        if window in ([Opcode.DUP, Opcode.DROP], [Opcode.SWAP, Opcode.SWAP]):
+            self.replace(index, 2, [])
+
+    def remove_swap(self, index):
+        window = self.window(index, 2)
+        if window is not None and window[0] is Opcode.SWAP and window[1] in SWAPPED_OPERATIONS:
+            self.replace(index, 2, [(SWAPPED_OPERATIONS[window[1]], None)])
+
+    def forward_store(self, index):
+        """x ! x @ -> dup x !, если сохраняемое значение заведомо целое"""
+        window = self.window(index, 4)
+        if window != [Opcode.ADDR_ON_TOP, Opcode.SAVE_VAR, Opcode.ADDR_ON_TOP, Opcode.VAR_ON_TOP]:
+            return
+        if self.code[index]["arg"] != self.code[index + 2]["arg"] or index in self.targets:
+            return
+        if index == 0 or self.opcodes[index - 1] not in INT_RESULT_OPCODES:
+            return
+        self.replace(index, 4, [(Opcode.DUP, None), (Opcode.ADDR_ON_TOP, self.code[index]["arg"]), (Opcode.SAVE_VAR, None)])
+
+    def negate_comparison(self, index):
+        """= 0 = -> !=, != 0 = -> =, = 0 != -> ="""
+        window = self.window(index, 3)
+        if window is None or window[0] not in NEGATED_COMPARISONS or not is_push_of(self.code[index + 1], 0):
+            return
+        if window[2] is Opcode.EQ:
+            self.replace(index, 3, [(NEGATED_COMPARISONS[window[0]], None)])
+        elif window[2] is Opcode.NOT_EQ:
+            self.replace(index, 3, [(window[0], None)])
+
+    def thread_jump(self, index):
+        if self.opcodes[index] not in JUMP_OPCODES:
+            return
+        target = int(self.code[index]["arg"])
+        visited = {index}
+        while 0 <= target < len(self.code) and self.opcodes[target] is Opcode.JMP and target not in visited:
+            visited.add(target)
+            target = int(self.code[target]["arg"])
+        if target != int(self.code[index]["arg"]):
+            self.code[index] = {**self.code[index], "arg": target}
+            self.changed = True
+        if self.opcodes[index] is Opcode.JMP and target == index + 1:
+            self.replace(index, 1, [])
+
+    def run(self):
+        reachable = self.reachable()
+        for index in range(len(self.code)):
+            if index not in reachable and self.opcodes[index] is not Opcode.HALT:
+                self.replacements[index] = []
+                self.changed = True
+        for index in range(len(self.code)):
+            self.thread_jump(index)
+            for rewrite in (self.fold_constants, self.remove_pairs, self.remove_swap, self.forward_store, self.negate_comparison):
+                if index not in self.replacements:
+                    rewrite(index)
+        return self.emit()
+
+    def emit(self):
+        new_code = []
+        new_index = [0] * (len(self.code) + 1)
+        for index, instruction in enumerate(self.code):
+            new_index[index] = len(new_code)
+            new_code.extend(self.replacements.get(index, [instruction]))
+        new_index[len(self.code)] = len(new_code)
+        result = []
+        for index, instruction in enumerate(new_code):
+            instruction = {"index": index, **{key: value for key, value in instruction.items() if key != "index"}}
+            if opcode_of(instruction) in TARGET_OPCODES:
+                target = int(instruction["arg"])
+                instruction["arg"] = new_index[target] if 0 <= target <= len(self.code) else target - len(self.code) + len(new_code)
+            result.append(instruction)
+        for offset, cell in enumerate(self.data):
+            result.append({**cell, "index": len(new_code) + offset})
+        return result
+
+
+class Fusion(Peephole):
+    """Заменяет пары инструкций суперинструкциями: x @ -> load_var x, x ! -> store_var x, сравнение и jzs -> <сравнение>_jzs"""
+
+    def run(self):
+        for index in range(len(self.code)):
+            if index not in self.replacements:
+                self.fuse(index)
+        return self.emit()
+
+    def fuse(self, index):
+        window = self.window(index, 2)
+        if window == [Opcode.ADDR_ON_TOP, Opcode.VAR_ON_TOP]:
+            self.replace(index, 2, [(Opcode.LOAD_VAR, self.code[index]["arg"])])
+        elif window == [Opcode.ADDR_ON_TOP, Opcode.SAVE_VAR]:
+            self.replace(index, 2, [(Opcode.STORE_VAR, self.code[index]["arg"])])
+        elif window is not None and window[0] in FUSED_COMPARISONS and window[1] is Opcode.JZS:
+            self.replace(index, 2, [(FUSED_COMPARISONS[window[0]], self.code[index + 1]["arg"])])
+
+
+def fuse(machine_code):
+    """Код транслятора с суперинструкциями вместо подходящих пар инструкций"""
+    return Fusion(machine_code).run()
+
+
+def optimize(machine_code):
+    """Peephole-оптимизация кода транслятора до неподвижной точки"""
+    for _ in range(MAX_PASSES):
+        peephole = Peephole(machine_code)
+        machine_code = peephole.run()
+        if not peephole.changed:
+            break
+    return machine_code
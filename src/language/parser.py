@@ -0,0 +1,269 @@
+import re
+from collections import namedtuple
+from enum import Enum
+
+from exceptions import (
+    BranchesNotBalancedError,
+    BufferError,
+    ClosingBranchError,
+    ClosingLoopError,
+    EndingProcedureError,
+    InputError,
+    LoopError,
+    ProcedureError,
+    ProcedureInBranchError,
+    ProcedureInLoopError,
+)
+from language.instruction import Instruction
+
+
+class TokenKind(Enum):
+    NUMBER = 0
+    WORD = 1
+    NAME = 2
+    BUFFER = 3
+    PROCEDURE_START = 4
+    PROCEDURE_END = 5
+    # A word starting with '."', the rest of its line is not parsed
+    STRING_MARK = 6
+    # A whole line starting with '."', emitted after the words of the line
+    STRING = 7
+
+
+WORDS = {
+    "+", "-", "*", "/", "mod", "dup", "drop", "swap", "begin", "until", "=", "!=", ">", "<", ".", "exit", "!", "@", "#", "if", "else", "endif", "emit",
+    "#num", "#line", "do", "loop",
+}
+KEYWORDS = {"buffer": TokenKind.BUFFER, ":": TokenKind.PROCEDURE_START, ";": TokenKind.PROCEDURE_END}
+# Exactly the strings int() accepts
+NUMBER_PATTERN = re.compile(r"\s*[+-]?\d+(?:_\d+)*\s*")
+# "limit buf #line" reads a line into the buffer like "value var !" stores into the variable
+VARIABLE_ACCESS = {"!", "@", "#line"}
+# Index of the innermost do ... loop inside a do body, an ordinary variable name outside of it
+LOOP_INDEX_WORD = "i"
+
+# Line of the source: number, stripped text, words of the stripped text, raw text
+Line = namedtuple("Line", "number text words raw")
+Token = namedtuple("Token", "kind text line_number word_number line")
+
+# AST: leaves keep the source term of the instruction they become
+Push = namedtuple("Push", "term")
+Operation = namedtuple("Operation", "term")
+VariableReference = namedtuple("VariableReference", "term")
+# "a i @ + !" / "a i @ + @": the term holds the whole line
+IndexedAccess = namedtuple("IndexedAccess", "term words")
+StringLiteral = namedtuple("StringLiteral", "term text")
+If = namedtuple("If", "term then_body else_term else_body")
+Loop = namedtuple("Loop", "term body until_term")
+# "limit start do ... loop": the body runs at least once, as in Forth
+CountedLoop = namedtuple("CountedLoop", "term body loop_term")
+# Definition ": name ... ;", a later definition with the same name hides it for the calls after it
+Procedure = namedtuple("Procedure", "term name body")
+# Call of the definition current at the call site, a procedure may call itself
+Call = namedtuple("Call", "term procedure")
+Program = namedtuple("Program", "body variable_table buffer_declarations procedures string_table")
+
+
+def classify(word):
+    if word in WORDS:
+        return TokenKind.WORD
+    kind = KEYWORDS.get(word)
+    if kind is not None:
+        return kind
+    if word.startswith('."'):
+        return TokenKind.STRING_MARK
+    if NUMBER_PATTERN.fullmatch(word):
+        return TokenKind.NUMBER
+    return TokenKind.NAME
+
+
+def tokenize(text):
+    """Поток токенов с позициями (строка, слово) за один проход по исходнику"""
+    for line_number, raw in enumerate(text.split("\n"), 1):
+        stripped = raw.strip()
+        if not stripped:
+            continue
+        words = stripped.split(" ")
+        line = Line(line_number, stripped, words, raw)
+        for word_number, word in enumerate(words, 1):
+            yield Token(classify(word), word, line_number, word_number, line)
+        if raw.startswith('."'):
+            yield Token(TokenKind.STRING, raw, line_number, 1, line)
+
+
+class Frame:
+    """Открытая конструкция if или begin: тело, в которое сейчас добавляются узлы"""
+
+    def __init__(self, kind, term):
+        self.kind = kind
+        self.term = term
+        self.body = []
+        self.else_term = None
+        self.else_body = None
+
+    @property
+    def current_body(self):
+        return self.body if self.else_body is None else self.else_body
+
+
+class Parser:
+    """Разбирает поток токенов в AST, попутно раздавая адреса переменным, буферам и строкам"""
+
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.variable_table = {}
+        self.buffer_declarations = []
+        # Each distinct string literal is stored once: its length, then its characters
+        self.string_table = {}
+        self.variable_counter = 1
+        self.procedures = {}
+        self.procedure_list = []
+        self.main_body = []
+        self.procedure_term = None
+        self.procedure_body = None
+        self.waiting_for_procedure_name = False
+        self.frames = []
+        self.branch_depth = 0
+        self.loop_depth = 0
+        # Number of open do bodies, LOOP_INDEX_WORD is the loop index inside them
+        self.do_depth = 0
+
+    @property
+    def body(self):
+        if self.frames:
+            return self.frames[-1].current_body
+        return self.main_body if self.procedure_body is None else self.procedure_body
+
+    def parse(self):
+        skipped_line = None
+        for token in self.tokens:
+            if token.line_number == skipped_line and token.kind is not TokenKind.STRING:
+                continue
+            if self.waiting_for_procedure_name:
+                procedure = Procedure(self.procedure_term, token.text, [])
+                self.procedures[token.text] = procedure
+                self.procedure_list.append(procedure)
+                self.procedure_body = procedure.body
+                self.waiting_for_procedure_name = False
+                continue
+            if self.parse_token(token, Instruction(token.line_number, token.word_number, token.text)):
+                skipped_line = token.line_number
+        if self.branch_depth:
+            raise BranchesNotBalancedError
+        if self.loop_depth:
+            raise LoopError
+        return Program(self.main_body, self.variable_table, self.buffer_declarations, self.procedure_list, self.string_table)
+
+    def allocate(self, name, size):
+        self.variable_table[name] = self.variable_counter
+        self.variable_counter += size
+
+    def parse_token(self, token, term):
+        """Разбирает токен, True — остаток строки пропускается"""
+        match token.kind:
+            case TokenKind.NUMBER:
+                self.body.append(Push(term))
+            case TokenKind.WORD:
+                self.parse_word(token, term)
+            case TokenKind.BUFFER:
+                name = token.line.words[1]
+                if name not in self.variable_table:
+                    size = int(token.line.words[2])
+                    self.allocate(name, size)
+                    self.buffer_declarations.extend([token.text] * size)
+                    return True
+                if self.procedure_body is not None:
+                    raise BufferError()
+            case TokenKind.PROCEDURE_START:
+                if self.loop_depth:
+                    raise ProcedureInLoopError(*term)
+                if self.branch_depth:
+                    raise ProcedureInBranchError(*term)
+                if self.procedure_body is not None:
+                    raise ProcedureError(*term)
+                self.waiting_for_procedure_name = True
+                self.procedure_term = term
+            case TokenKind.PROCEDURE_END:
+                if self.branch_depth:
+                    raise ClosingBranchError(*term)
+                if self.loop_depth:
+                    raise ClosingLoopError(*term)
+                if self.procedure_body is None:
+                    raise EndingProcedureError(*term)
+                self.procedure_body = None
+            case TokenKind.STRING:
+                text = token.text[3:-1]
+                if text not in self.string_table:
+                    self.string_table[text] = self.variable_counter
+                    self.variable_counter += len(text) + 1
+                self.body.append(StringLiteral(term, text))
+            case TokenKind.NAME if token.text == LOOP_INDEX_WORD and self.do_depth:
+                self.body.append(Operation(term))
+            case _ if token.text in self.procedures:
+                self.body.append(Call(term, self.procedures[token.text]))
+            case TokenKind.STRING_MARK:
+                return True
+            case _:
+                return self.parse_name(token, term)
+        return False
+
+    def parse_word(self, token, term):
+        match token.text:
+            case "if":
+                self.frames.append(Frame("if", term))
+                self.branch_depth += 1
+            case "else":
+                frame = self.frames[-1] if self.frames else None
+                if frame is None or frame.kind != "if" or frame.else_body is not None:
+                    raise BranchesNotBalancedError
+                frame.else_term = term
+                frame.else_body = []
+            case "endif":
+                if not self.frames or self.frames[-1].kind != "if":
+                    raise BranchesNotBalancedError
+                frame = self.frames.pop()
+                self.branch_depth -= 1
+                self.body.append(If(frame.term, frame.body, frame.else_term, frame.else_body))
+            case "begin":
+                self.frames.append(Frame("begin", term))
+                self.loop_depth += 1
+            case "until":
+                if not self.frames or self.frames[-1].kind != "begin":
+                    raise LoopError
+                frame = self.frames.pop()
+                self.loop_depth -= 1
+                self.body.append(Loop(frame.term, frame.body, term))
+            case "do":
+                self.frames.append(Frame("do", term))
+                self.loop_depth += 1
+                self.do_depth += 1
+            case "loop":
+                if not self.frames or self.frames[-1].kind != "do":
+                    raise LoopError
+                frame = self.frames.pop()
+                self.loop_depth -= 1
+                self.do_depth -= 1
+                self.body.append(CountedLoop(frame.term, frame.body, term))
+            case _:
+                self.body.append(Operation(term))
+
+    def parse_name(self, token, term):
+        line = token.line
+        if line.words[-1] not in VARIABLE_ACCESS:
+            raise InputError(*term)
+        if len(line.words) in {2, 3}:
+            if token.text not in self.variable_table:
+                self.allocate(token.text, 1)
+                self.buffer_declarations.append(token.text)
+            self.body.append(VariableReference(term))
+        elif len(line.words) == 5:
+            for name in line.words[:2]:
+                if name not in self.variable_table:
+                    raise InputError(token.line_number, line.words.index(name) + 1, name)
+            self.body.append(IndexedAccess(Instruction(token.line_number, token.word_number, line.text), line.words))
+            return True
+        return False
+
+
+def parse(text):
+    return Parser(text).parse()
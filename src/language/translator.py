@@ -1,269 +1,260 @@
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from exceptions import (
-    BranchesNotBalancedError,
-    ClosingBranchError,
-    ClosingLoopError,
-    EndingProcedureError,
-    InputError,
-    LoopError,
-    ProcedureError,
-    BufferError,
-    ProcedureInBranchError,
-    ProcedureInLoopError,
-    TranslatorArgumentsError,
-)
+from exceptions import TranslatorArgumentsError
+from language.cache import DEFAULT_MAX_BYTES, TranslationCache
+from language.image import save_image
 from language.instruction import Opcode, Instruction, save_instructions_to_file
+from language.optimizer import fuse as fuse_code
+from language.optimizer import optimize as optimize_code
+from language.parser import Call, CountedLoop, If, IndexedAccess, Loop, Operation, Push, StringLiteral, VariableReference, parse
 
-token_set = {
-    "+", "-", "*", "/", "mod", "dup", "drop", "swap", "begin", "until", "=", "!=", ">", "<", ".", "exit", "!", "@", "#", "if", "else", "endif", "emit"
-}
+IMAGE_SUFFIX = ".bin"
+OUTPUT_FORMATS = {"json", "image", "both"}
+# Procedures of at most this many instructions are inlined at every call, call and ret cost two more fetch cycles
+INLINE_SIZE_LIMIT = 8
+# Part of the translation cache key, must change whenever generated code changes for the same source
+TRANSLATOR_VERSION = 5
 
-control_flow_commands = {"if", "else", "endif", "begin", "until"}
+SYMBOL_OPCODES = {
+    "+": Opcode.SUM.value,
+    "-": Opcode.SUB.value,
+    "*": Opcode.MUL.value,
+    "/": Opcode.DIV.value,
+    "mod": Opcode.MOD.value,
+    "dup": Opcode.DUP.value,
+    "drop": Opcode.DROP.value,
+    "swap": Opcode.SWAP.value,
+    "=": Opcode.EQ.value,
+    ">": Opcode.MORE.value,
+    "<": Opcode.LESS.value,
+    ".": Opcode.PRINT.value,
+    "exit": Opcode.HALT.value,
+    "!": Opcode.SAVE_VAR.value,
+    "@": Opcode.VAR_ON_TOP.value,
+    "#": Opcode.READ.value,
+    "#num": Opcode.READ_NUM.value,
+    "#line": Opcode.READ_LINE.value,
+    "emit": Opcode.EMIT.value,
+    "!=": Opcode.NOT_EQ.value,
+    "i": Opcode.LOOP_INDEX.value,
+}
 
-variable_table = {}
-buffer_declaration_list = []
 
-def is_integer(value):
-    try:
-        int(value)
-        return True
-    except ValueError:
-        return False
-    
 def get_opcode_for_symbol(symbol):
-    return {
-        "+": Opcode.SUM.value,
-        "-": Opcode.SUB.value,
-        "*": Opcode.MUL.value,
-        "/": Opcode.DIV.value,
-        "mod": Opcode.MOD.value,
-        "dup": Opcode.DUP.value,
-        "drop": Opcode.DROP.value,
-        "swap": Opcode.SWAP.value,
-        "=": Opcode.EQ.value,
-        ">": Opcode.MORE.value,
-        "<": Opcode.LESS.value,
-        ".": Opcode.PRINT.value,
-        "exit": Opcode.HALT.value,
-        "!": Opcode.SAVE_VAR.value,
-        "@": Opcode.VAR_ON_TOP.value,
-        "#": Opcode.READ.value,
-        "emit": Opcode.EMIT.value,
-        "!=": Opcode.NOT_EQ.value,
-    }.get(symbol)
+    return SYMBOL_OPCODES.get(symbol)
+
+
+class Translator:
+    """Транслятор одной программы: таблица переменных и буферов принадлежат объекту, а не модулю"""
 
-def parse_code_to_terms(text):
-    variable_counter = 1
-    terms = []
-    procedures = {}
-    in_procedure = False
-    waiting_for_procedure_name = False
-    branch_depth = 0
-    loop_depth = 0
-    procedure_name = ""
-    
-    for line_number, line in enumerate(text.split("\n"), 1):
-        if line.strip():
-            tokens = line.strip().split(" ")
-            for word_number, token in enumerate(tokens, 1):
-                if waiting_for_procedure_name:
-                    procedure_name = str(token)
-                    procedures[procedure_name] = []
-                    waiting_for_procedure_name = False
-                elif is_integer(token) or token in token_set:
-                    if in_procedure:
-                        procedures[procedure_name].append(Instruction(line_number, word_number, token))
-                    else:
-                        terms.append(Instruction(line_number, word_number, token))
-                elif token == "buffer":
-                    if tokens[1] not in variable_table:
-                        variable_table[tokens[1]] = variable_counter
-                        buffer_declaration_list.extend([token] * int(tokens[2]))
-                        variable_counter += int(tokens[2])
-                        break
-                    if in_procedure:
-                        raise BufferError()
-                elif token == ":":
-                    if branch_depth == 0 and loop_depth == 0:
-                        if not in_procedure:
-                            in_procedure = True
-                            waiting_for_procedure_name = True
-                        else:
-                            raise ProcedureError(line_number, word_number, token)
-                    else:
-                        if branch_depth == 0:
-                            raise ProcedureInBranchError(line_number, word_number, token)
-                        if loop_depth == 0:
-                            raise ProcedureInLoopError(line_number, word_number, token)
-                elif token == ";":
-                    if branch_depth == 0 and loop_depth == 0:
-                        if in_procedure:
-                            in_procedure = False
-                        else:
-                            raise EndingProcedureError(line_number, word_number, token)
-                    else:
-                        if branch_depth == 0:
-                            raise ClosingBranchError(line_number, word_number, token)
-                        if loop_depth == 0:
-                            raise ClosingLoopError(line_number, word_number, token)
-                elif token in procedures:
-                    for term in procedures[token]:
-                        terms.append(term)
-                elif token.startswith('."'):
-                    break
-                else:
-                    if tokens[-1] in {"!", "@"}:
-                        if len(tokens) in {2, 3}:
-                            if token not in variable_table:
-                                variable_table[token] = variable_counter
-                                buffer_declaration_list.append(token)
-                                variable_counter += 1
-                            if in_procedure:
-                                procedures[procedure_name].append(Instruction(line_number, word_number, token))
-                            else:
-                                terms.append(Instruction(line_number, word_number, token))
-                        if len(tokens) == 5:
-                            if in_procedure:
-                                procedures[procedure_name].append(Instruction(line_number, word_number, line.strip()))
-                                break
-                            terms.append(Instruction(line_number, word_number, line.strip()))
-                            break
-                    else:
-                        raise InputError(line_number, word_number, token)
+    def __init__(self):
+        self.variable_table = {}
+        self.buffer_declaration_list = []
+        self.machine_code = []
+        # Text of a string literal -> address of its length cell, the characters follow it
+        self.string_table = {}
+        # id of a procedure -> True if it is inlined, index of its first instruction otherwise
+        self.inlined = {}
+        self.entries = {}
 
-                if token == "if":
-                    branch_depth -= 1
-                if token == "endif":
-                    branch_depth += 1
-                if token == "begin":
-                    loop_depth -= 1
-                if token == "until":
-                    loop_depth += 1
+    def generate(self, nodes):
+        """Генерирует машинный код узлов AST в self.machine_code, индекс инструкции — её позиция в списке"""
+        machine_code = self.machine_code
+        for node in nodes:
+            index = len(machine_code)
+            match node:
+                case Push(term):
+                    machine_code.append({"index": index, "opcode": Opcode.PUSH.value, "arg": term.symbol, "term": term})
+                case Operation(term):
+                    machine_code.append({"index": index, "opcode": get_opcode_for_symbol(term.symbol), "term": term})
+                case VariableReference(term):
+                    machine_code.append(
+                        {"index": index, "opcode": Opcode.ADDR_ON_TOP.value, "arg": self.variable_table[term.symbol], "term": term}
+                    )
+                case IndexedAccess(term, tokens):
+                    machine_code.extend([
+                        {"index": index, "opcode": Opcode.ADDR_ON_TOP.value, "arg": self.variable_table[tokens[1]], "term": Instruction(term.line_number, 2, tokens[1])},
+                        {"index": index + 1, "opcode": Opcode.VAR_ON_TOP.value, "term": Instruction(term.line_number, 3, tokens[2])},
+                        {"index": index + 2, "opcode": Opcode.ADDR_ON_TOP.value, "arg": self.variable_table[tokens[0]], "term": Instruction(term.line_number, 1, tokens[0])},
+                        {"index": index + 3, "opcode": Opcode.SUM.value, "term": Instruction(term.line_number, 4, tokens[3])},
+                        {"index": index + 4, "opcode": get_opcode_for_symbol(tokens[4]), "term": Instruction(term.line_number, 5, tokens[4])},
+                    ])
+                case StringLiteral(term, text):
+                    machine_code.append({"index": index, "opcode": Opcode.PRINT_STR.value, "arg": self.string_table[text], "term": term})
+                case If(term, then_body, else_term, else_body):
+                    machine_code.append(None)
+                    self.generate(then_body)
+                    if else_body is None:
+                        machine_code[index] = {"index": index, "opcode": Opcode.JZS.value, "arg": len(machine_code)}
+                        continue
+                    else_index = len(machine_code)
+                    machine_code[index] = {"index": index, "opcode": Opcode.JZS.value, "arg": else_index + 1, "term": term}
+                    machine_code.append(None)
+                    self.generate(else_body)
+                    machine_code[else_index] = {"index": else_index, "opcode": Opcode.JMP.value, "arg": len(machine_code)}
+                case Loop(term, body, until_term):
+                    self.generate(body)
+                    machine_code.append({"index": len(machine_code), "opcode": Opcode.JZS.value, "arg": index})
+                case CountedLoop(term, body, loop_term):
+                    machine_code.append({"index": index, "opcode": Opcode.DO.value, "term": term})
+                    self.generate(body)
+                    machine_code.append({"index": len(machine_code), "opcode": Opcode.LOOP.value, "arg": index + 1, "term": loop_term})
+                    # Runs only when the loop is done: the enclosing loop gets its registers back
+                    machine_code.append({"index": len(machine_code), "opcode": Opcode.UNLOOP.value})
+                case Call(term, procedure) if self.inlined[id(procedure)]:
+                    self.generate(procedure.body)
+                case Call(term, procedure):
+                    machine_code.append({"index": index, "opcode": Opcode.CALL.value, "arg": self.entries[id(procedure)], "term": term})
 
-            if line.startswith('."'):
-                variable_table[line[3:-1]] = variable_counter
-                variable_counter += len(line[3:-1])
-                terms.append(Instruction(line_number, 1, line))
+    def size(self, nodes):
+        """Число инструкций, которое сгенерирует generate(nodes)"""
+        total = 0
+        for node in nodes:
+            match node:
+                case IndexedAccess():
+                    total += 5
+                case If(_, then_body, _, else_body):
+                    total += 1 + self.size(then_body) + (0 if else_body is None else 1 + self.size(else_body))
+                case Loop(_, body, _):
+                    total += self.size(body) + 1
+                case CountedLoop(_, body, _):
+                    total += self.size(body) + 3
+                case Call(_, procedure) if self.inlined.get(id(procedure)):
+                    total += self.size(procedure.body)
+                case _:
+                    total += 1
+        return total
 
-    if branch_depth < 0:
-        raise BranchesNotBalancedError
-    if loop_depth < 0:
-        raise LoopError
-    return terms
+    def calls(self, nodes):
+        """Вызываемые в nodes процедуры, не заходя в тела других процедур"""
+        for node in nodes:
+            match node:
+                case Call(_, callee):
+                    yield callee
+                case If(_, then_body, _, else_body):
+                    yield from self.calls(then_body)
+                    yield from self.calls(else_body or [])
+                case Loop(_, body, _) | CountedLoop(_, body, _):
+                    yield from self.calls(body)
 
-def generate_string_translation(string, index):
-    operations = [
-        {"index": index, "opcode": Opcode.ADDR_ON_TOP.value, "arg": variable_table[string]},
-        {"index": index + 1, "opcode": Opcode.PUSH.value, "arg": 1},
-        {"index": index + 2, "opcode": Opcode.SUM.value},
-        {"index": index + 3, "opcode": Opcode.DUP.value},
-        {"index": index + 4, "opcode": Opcode.VAR_ON_TOP.value},
-        {"index": index + 5, "opcode": Opcode.EMIT.value},
-        {"index": index + 6, "opcode": Opcode.DUP.value},
-        {"index": index + 7, "opcode": Opcode.ADDR_ON_TOP.value, "arg": variable_table[string]},
-        {"index": index + 8, "opcode": Opcode.SWAP.value},
-        {"index": index + 9, "opcode": Opcode.SUB.value},
-        {"index": index + 10, "opcode": Opcode.ADDR_ON_TOP.value, "arg": variable_table[string]},
-        {"index": index + 11, "opcode": Opcode.VAR_ON_TOP.value},
-        {"index": index + 12, "opcode": Opcode.SUB.value},
-        {"index": index + 13, "opcode": Opcode.PUSH.value, "arg": 0},
-        {"index": index + 14, "opcode": Opcode.EQ.value},
-        {"index": index + 15, "opcode": Opcode.JZS.value, "arg": index}
-    ]
-    return operations, index + len(operations)
+    def choose_inlining(self, program):
+        """Решает для каждой процедуры: подставлять тело в места вызова или вызывать call/ret.
 
-def translate_string_to_memory(string):
-    memory_init = [{"adr": variable_table[string], "arg": len(string)}]
-    memory_init.extend([{"adr": variable_table[string] + i, "arg": ord(c)} for i, c in enumerate(string, 1)])
-    return memory_init
+        Подставляются процедуры с одним вызовом и короткие, halt в теле вызываемой процедуры допустим:
+        переменные отсчитываются от первой ячейки данных за кодом, а не от первого halt.
+        Рекурсивная процедура всегда вызывается.
+        """
+        call_counts = {}
+        for body in [program.body, *(procedure.body for procedure in program.procedures)]:
+            for callee in self.calls(body):
+                call_counts[id(callee)] = call_counts.get(id(callee), 0) + 1
+        for procedure in program.procedures:
+            recursive = any(callee is procedure for callee in self.calls(procedure.body))
+            small = self.size(procedure.body) <= INLINE_SIZE_LIMIT
+            self.inlined[id(procedure)] = not recursive and (call_counts.get(id(procedure), 0) <= 1 or small)
+        return [
+            procedure for procedure in program.procedures if not self.inlined[id(procedure)] and call_counts.get(id(procedure), 0)
+        ]
 
-def translate_text(text):
-    string_literals = []
-    terms = parse_code_to_terms(text)
-    machine_code = []
-    jump_stack = []
-    is_else_block = False
-    index = 0
+    def generate_procedures(self, procedures):
+        """Тела вызываемых процедур в начале кода, перед ними переход на основную программу"""
+        if not procedures:
+            return
+        machine_code = self.machine_code
+        machine_code.append(None)
+        for procedure in procedures:
+            self.entries[id(procedure)] = len(machine_code)
+            self.generate(procedure.body)
+            machine_code.append({"index": len(machine_code), "opcode": Opcode.RET.value, "term": procedure.term})
+        machine_code[0] = {"index": 0, "opcode": Opcode.JMP.value, "arg": len(machine_code)}
 
-    for term in terms:
-        tokens = term.symbol.split(" ")
-        if tokens[0] == "if":
-            machine_code.append(None)
-            jump_stack.append(index)
-        elif tokens[0] == "else":
-            if_index = jump_stack.pop()
-            machine_code[if_index] = {
-                "index": if_index,
-                "opcode": Opcode.JZS.value,
-                "arg": index + 1,
-                "term": terms[if_index],
-            }
-            machine_code.append(None)
-            jump_stack.append(index)
-            is_else_block = True
-        elif tokens[0] == "endif":
-            if_index = jump_stack.pop()
-            index -= 1
-            if is_else_block:
-                machine_code[if_index] = {"index": if_index, "opcode": Opcode.JMP.value, "arg": index + 1}
-                is_else_block = False
-            else:
-                machine_code[if_index] = {"index": if_index, "opcode": Opcode.JZS.value, "arg": index + 1}
-        elif tokens[0] == "begin":
-            jump_stack.append(index)
-            index -= 1
-        elif tokens[0] == "until":
-            begin_index = jump_stack.pop()
-            machine_code.append({"index": index, "opcode": Opcode.JZS.value, "arg": begin_index})
-        elif is_integer(tokens[0]):
-            machine_code.append({"index": index, "opcode": Opcode.PUSH.value, "arg": tokens[0], "term": term})
-        elif tokens[0] in variable_table:
-            if len(tokens) == 5:
-                machine_code.extend([
-                    {"index": index, "opcode": Opcode.ADDR_ON_TOP.value, "arg": variable_table[tokens[1]], "term": Instruction(term.line_number, 2, tokens[1])},
-                    {"index": index + 1, "opcode": Opcode.VAR_ON_TOP.value, "term": Instruction(term.line_number, 3, tokens[2])},
-                    {"index": index + 2, "opcode": Opcode.ADDR_ON_TOP.value, "arg": variable_table[tokens[0]], "term": Instruction(term.line_number, 1, tokens[0])},
-                    {"index": index + 3, "opcode": Opcode.SUM.value, "term": Instruction(term.line_number, 4, tokens[3])},
-                    {"index": index + 4, "opcode": Opcode.SAVE_VAR if tokens[4] == "!" else Opcode.VAR_ON_TOP.value, "term": Instruction(term.line_number, 5, tokens[4])},
-                ])
-                index += 4
-            else:
-                machine_code.append(
-                    {"index": index, "opcode": Opcode.ADDR_ON_TOP.value, "arg": variable_table[tokens[0]], "term": term}
-                )
-        elif tokens[0] == '."':
-            string_literals.append(" ".join(tokens)[3:-1])
-            operations, index = generate_string_translation(" ".join(tokens)[3:-1], index)
-            machine_code.extend(operations)
-        else:
-            machine_code.append({"index": index, "opcode": get_opcode_for_symbol(tokens[0]), "term": term})
+    def translate_text(self, text):
+        program = parse(text)
+        self.variable_table = program.variable_table
+        self.buffer_declaration_list = program.buffer_declarations
+        self.machine_code = machine_code = []
+        self.string_table = program.string_table
+        self.inlined = {}
+        self.entries = {}
+        self.generate_procedures(self.choose_inlining(program))
+        self.generate(program.body)
 
-        index += 1
+        for address, value in enumerate(self.data_cells(), len(machine_code)):
+            machine_code.append({"index": address, "arg": value})
+        return machine_code
 
-    for buffer_var in buffer_declaration_list:
-        machine_code.append({"index": index, "arg": 0})
-        index += 1
+    def data_cells(self):
+        """Начальные значения ячеек переменных, буферов и строк по порядку адресов"""
+        cells = [0] * (len(self.buffer_declaration_list) + sum(len(text) + 1 for text in self.string_table))
+        for text, address in self.string_table.items():
+            cells[address - 1] = len(text)
+            for offset, char in enumerate(text, 1):
+                cells[address - 1 + offset] = ord(char)
+        return cells
 
-    for string_literal in string_literals:
-        machine_code.append({"index": index, "arg": len(string_literal)})
-        for symbol_index, char in enumerate(string_literal, 1):
-            machine_code.append({"index": index + symbol_index, "arg": ord(char)})
 
+def translate_text(text, optimize=False, fuse=False):
+    """Машинный код программы, optimize — peephole-оптимизация, fuse — суперинструкции (после оптимизации)"""
+    machine_code = Translator().translate_text(text)
+    if optimize:
+        machine_code = optimize_code(machine_code)
+    if fuse:
+        machine_code = fuse_code(machine_code)
     return machine_code
 
-def main(input_filepath, output_filepath):
+
+def open_cache(directory, max_bytes=DEFAULT_MAX_BYTES):
+    return TranslationCache(directory, TRANSLATOR_VERSION, max_bytes)
+
+
+def translate_cached(text, cache=None, optimize=False, fuse=False):
+    """Машинный код из кэша трансляций или свежая трансляция, которая затем кладётся в кэш"""
+    if cache is None:
+        return translate_text(text, optimize, fuse)
+    variant = "+".join(name for name, enabled in (("optimize", optimize), ("fuse", fuse)) if enabled)
+    machine_code = cache.get(text, variant)
+    if machine_code is None:
+        machine_code = translate_text(text, optimize, fuse)
+        cache.put(text, machine_code, variant)
+    return machine_code
+
+
+def translate_many(texts, workers=None, use_processes=False, chunk_size=1):
+    """Транслирует исходники параллельно в потоках или процессах, результат в порядке texts"""
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        if use_processes:
+            return list(executor.map(translate_text, texts, chunksize=chunk_size))
+        return list(executor.map(translate_text, texts))
+
+def main(input_filepath, output_filepath, output_format="json", cache=None, optimize=False, fuse=False):
     with open(input_filepath, encoding="utf-8") as file:
         source_code = file.read()
 
-    compiled_code = translate_text(source_code)
+    compiled_code = translate_cached(source_code, cache, optimize, fuse)
+
+    if output_format == "image":
+        save_image(output_filepath, compiled_code)
+    else:
+        save_instructions_to_file(output_filepath, compiled_code)
+    if output_format == "both":
+        save_image(output_filepath + IMAGE_SUFFIX, compiled_code)
 
-    save_instructions_to_file(output_filepath, compiled_code)
-    variable_table.clear()
-    buffer_declaration_list.clear()
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith("--")]
+    options = dict(argument[2:].partition("=")[::2] for argument in sys.argv[1:] if argument.startswith("--"))
+    if len(arguments) != 2 or not set(options) <= {"format", "cache", "cache-size", "optimize", "fuse"}:
+        raise TranslatorArgumentsError
+    if options.get("optimize", "") or options.get("fuse", ""):
+        raise TranslatorArgumentsError
+    if options.get("format", "json") not in OUTPUT_FORMATS or not options.get("cache-size", "0").isdigit():
+        raise TranslatorArgumentsError
+    if "cache-size" in options and "cache" not in options:
         raise TranslatorArgumentsError
-    _, input_file, output_file = sys.argv
-    main(input_file, output_file)
+    translation_cache = None
+    if "cache" in options:
+        translation_cache = open_cache(options["cache"], int(options.get("cache-size", DEFAULT_MAX_BYTES)))
+    input_file, output_file = arguments
+    main(input_file, output_file, options.get("format", "json"), translation_cache, "optimize" in options, "fuse" in options)